@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+# FILE: aggtrades_backfill.py
+# Tải lịch sử aggTrades từ REST /api/v3/aggTrades theo KHOẢNG ID, chia thành nhiều shard chạy song song.
+# - Ngân sách weight dùng chung (WeightBudget): trừ trước mỗi request, đồng bộ theo header
+#   X-MBX-USED-WEIGHT-1M của sàn, tạm dừng mọi worker khi gặp 429/418 (Retry-After).
+# - Mỗi trang được đổi ngay sang cột NumPy và ghi thẳng vào kho Parquet (trade_archive) theo lô,
+#   không giữ cả lịch sử trong list dict.
+# - Tiến độ từng shard (con trỏ id đã GHI XONG) lưu ở backfill_state.json trong thư mục kho:
+#   chết giữa chừng thì lần chạy sau tiếp tục từ đó (phần ghi trùng được bỏ theo aggTrade id khi đọc / gộp).
+# base_url đổi được để chạy thử với server HTTP giả lập ở máy (xem test_aggtrades_backfill.py, benchmarks.py backfill).
+
+import os
+import json
+import time
+import asyncio
+
+import aiohttp
+
+from trade_archive import records_to_trades, concat_trades, take_trades
+
+BINANCE_API_URL = "https://api.binance.com"
+AGG_TRADES_PATH = "/api/v3/aggTrades"
+PAGE_LIMIT = 1000 # Số trade tối đa mỗi request
+AGG_TRADES_WEIGHT = 2 # Weight của /api/v3/aggTrades
+WEIGHT_LIMIT_1M = 6000 # Giới hạn weight / phút / IP của sàn
+WEIGHT_SAFETY = 0.8 # Chỉ dùng tối đa bấy nhiêu phần ngân sách (chừa cho request khác cùng IP)
+WEIGHT_HEADER = 'X-MBX-USED-WEIGHT-1M'
+SHARD_PAGES = 50 # Số trang (x PAGE_LIMIT id) mỗi shard
+DEFAULT_CONCURRENCY = 8
+FLUSH_ROWS = 100_000 # Ghi xuống kho sau mỗi bấy nhiêu dòng của 1 shard
+RETRY_DELAY_S = 5.0 # Chờ trước khi thử lại khi lỗi mạng / lỗi 5xx
+REQUEST_TIMEOUT_S = 30
+STATE_NAME = 'backfill_state.json'
+HOUR_MS = 60 * 60 * 1000
+
+
+class WeightBudget:
+    """Ngân sách weight theo cửa sổ thời gian (mặc định 1 phút, như đồng hồ của sàn), dùng chung cho mọi worker."""
+
+    def __init__(self, limit=WEIGHT_LIMIT_1M, safety=WEIGHT_SAFETY, window_s=60.0):
+        self.limit = max(int(limit * safety), 1); self.window_s = window_s
+        self.window = None; self.used = 0
+        self.paused_until = 0.0
+        self.waits = 0 # Số lần phải chờ (để thống kê)
+
+    async def acquire(self, weight):
+        while True:
+            now = time.time()
+            wait = self.paused_until - now
+            if wait <= 0:
+                window = int(now // self.window_s)
+                if window != self.window: self.window = window; self.used = 0
+                if self.used + weight <= self.limit:
+                    self.used += weight; return
+                wait = (window + 1) * self.window_s - now
+            self.waits += 1
+            await asyncio.sleep(wait)
+
+    def update(self, used_header):
+        """Số weight sàn báo đã dùng trong cửa sổ hiện tại (tính cả request khác cùng IP) là chuẩn."""
+        if used_header is None: return
+        try: used = int(used_header)
+        except ValueError: return
+        if int(time.time() // self.window_s) == self.window and used > self.used: self.used = used
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.time() + seconds)
+
+
+class AggTradesBackfill:
+    """Tải aggTrades [id đầu, id cuối] bằng nhiều shard song song, ghi vào 1 TradeArchive."""
+
+    def __init__(self, symbol, archive, base_url=BINANCE_API_URL, concurrency=DEFAULT_CONCURRENCY,
+                 budget=None, shard_pages=SHARD_PAGES, flush_rows=FLUSH_ROWS, log=print):
+        self.symbol = symbol; self.archive = archive
+        self.url = base_url.rstrip('/') + AGG_TRADES_PATH
+        self.concurrency = max(int(concurrency), 1)
+        self.budget = budget or WeightBudget()
+        self.shard_size = shard_pages * PAGE_LIMIT; self.flush_rows = flush_rows
+        self.log = log
+        self.state_path = os.path.join(archive.archive_dir, STATE_NAME)
+        self.state = None
+        self.stats = {'requests': 0, 'rows': 0, 'rate_limited': 0, 'retries': 0}
+
+    # --- HTTP ---
+    async def _get(self, session, params):
+        """1 request aggTrades (trừ ngân sách trước). Tự chờ khi bị giới hạn, thử lại khi lỗi mạng / 5xx."""
+        params = dict(params, symbol=self.symbol)
+        while True:
+            await self.budget.acquire(AGG_TRADES_WEIGHT)
+            self.stats['requests'] += 1
+            try:
+                async with session.get(self.url, params=params) as response:
+                    self.budget.update(response.headers.get(WEIGHT_HEADER))
+                    if response.status == 200: return await response.json(content_type=None)
+                    if response.status in (418, 429):
+                        retry_after = float(response.headers.get('Retry-After', 60))
+                        self.stats['rate_limited'] += 1; self.budget.pause(retry_after)
+                        self.log(f"Bị giới hạn tốc độ ({response.status}). Tạm dừng mọi shard {retry_after:.0f} giây...")
+                        continue
+                    text = await response.text()
+                    if response.status < 500: raise RuntimeError(f"Lỗi khi lấy aggTrades: {response.status} - {text[:200]}")
+                    self.log(f"Lỗi máy chủ {response.status}. Thử lại sau {RETRY_DELAY_S:.0f} giây...")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.log(f"Lỗi kết nối: {e}. Thử lại sau {RETRY_DELAY_S:.0f} giây...")
+            self.stats['retries'] += 1
+            await asyncio.sleep(RETRY_DELAY_S)
+
+    async def latest_id(self, session):
+        page = await self._get(session, {'limit': 1})
+        return int(page[-1]['a']) if page else None
+
+    async def first_id_at(self, session, start_ms, end_ms):
+        """id của trade đầu tiên có T >= start_ms (tìm theo từng cửa sổ 1 giờ, giới hạn của startTime/endTime)."""
+        window_start = int(start_ms)
+        while window_start <= end_ms:
+            page = await self._get(session, {'startTime': window_start, 'endTime': min(window_start + HOUR_MS - 1, int(end_ms)), 'limit': 1})
+            if page: return int(page[0]['a'])
+            window_start += HOUR_MS
+        return None
+
+    # --- Trạng thái (resume) ---
+    def _load_state(self):
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f: state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return state if state.get('symbol') == self.symbol else None
+
+    def _save_state(self):
+        os.makedirs(self.archive.archive_dir, exist_ok=True)
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(self.state, f, separators=(',', ':'))
+        os.replace(tmp_path, self.state_path)
+
+    def _clear_state(self):
+        self.state = None
+        try: os.remove(self.state_path)
+        except FileNotFoundError: pass
+
+    def _plan(self, first_id, last_id):
+        shards = [{'start': lo, 'end': min(lo + self.shard_size - 1, last_id), 'cursor': lo, 'done': False}
+                  for lo in range(first_id, last_id + 1, self.shard_size)]
+        self.state = {'symbol': self.symbol, 'first_id': first_id, 'last_id': last_id, 'shards': shards}
+        self._save_state()
+
+    # --- Tải ---
+    async def _persist(self, shard, chunks, cursor):
+        """Ghi các trang đã tải của shard vào kho (trên executor), RỒI mới tiến con trỏ đã lưu.
+        Bị hủy giữa chừng (shard khác lỗi) thì vẫn chờ ghi xong rồi mới dừng: kho và con trỏ luôn khớp nhau."""
+        write = asyncio.ensure_future(self._write(shard, chunks, cursor))
+        try: await asyncio.shield(write)
+        except asyncio.CancelledError:
+            await write; raise
+
+    async def _write(self, shard, chunks, cursor):
+        if chunks:
+            trades = concat_trades(chunks)
+            await asyncio.get_running_loop().run_in_executor(None, self.archive.append, trades)
+            self.stats['rows'] += len(trades['T'])
+        shard['cursor'] = cursor
+        self._save_state()
+
+    async def _run_shard(self, session, shard):
+        chunks = []; n_rows = 0
+        cursor = shard['cursor']
+        while cursor <= shard['end']:
+            page = await self._get(session, {'fromId': cursor, 'limit': PAGE_LIMIT})
+            if not page: break # Hết trade (id cuối chưa tồn tại)
+            trades = records_to_trades(page) # Đổi sang cột ngay, không giữ list dict
+            if trades['a'][-1] > shard['end']: trades = take_trades(trades, trades['a'] <= shard['end'])
+            cursor = int(page[-1]['a']) + 1
+            chunks.append(trades); n_rows += len(trades['T'])
+            if n_rows >= self.flush_rows:
+                await self._persist(shard, chunks, cursor); chunks = []; n_rows = 0
+        shard['done'] = True
+        await self._persist(shard, chunks, cursor)
+
+    async def _run_plan(self, session):
+        queue = asyncio.Queue()
+        for shard in self.state['shards']:
+            if not shard['done']: queue.put_nowait(shard)
+        pending = queue.qsize()
+        if not pending: return
+
+        async def worker():
+            while True:
+                try: shard = queue.get_nowait()
+                except asyncio.QueueEmpty: return
+                await self._run_shard(session, shard)
+
+        self.log(f"Tải id {self.state['first_id']} -> {self.state['last_id']}: {pending} shard, {min(self.concurrency, pending)} luồng song song.")
+        workers = [asyncio.ensure_future(worker()) for _ in range(min(self.concurrency, pending))]
+        try: await asyncio.gather(*workers)
+        finally:
+            # 1 shard lỗi (vd. 4xx) -> hủy các luồng còn lại và chờ chúng dừng hẳn trước khi báo lỗi / đóng session
+            # (không để worker mồ côi tiếp tục ghi kho / backfill_state.json sau khi run() đã trả về)
+            for task in workers: task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def run(self, start_ms, end_ms=None, session=None):
+        """Tải mọi aggTrade từ sau dữ liệu đã có trong kho (hoặc từ start_ms nếu kho trống) tới trade mới nhất.
+        Có backfill_state.json dở dang thì làm nốt trước. Trả về số dòng đã ghi."""
+        if end_ms is None: end_ms = int(time.time() * 1000)
+        own_session = session is None
+        if own_session: session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_S))
+        started = time.perf_counter()
+        try:
+            self.state = self._load_state()
+            if self.state is not None:
+                self.log("Tiếp tục lần tải lịch sử trước (backfill_state.json)...")
+                await self._run_plan(session)
+            last_id = await self.latest_id(session)
+            archived_id = self.archive.last_id()
+            if archived_id is not None: first_id = archived_id + 1
+            else:
+                archived_ms = self.archive.last_time()
+                first_id = await self.first_id_at(session, start_ms if archived_ms is None else archived_ms + 1, end_ms)
+            if last_id is not None and first_id is not None and first_id <= last_id:
+                self._plan(first_id, last_id)
+                await self._run_plan(session)
+            self._clear_state()
+        finally:
+            if own_session: await session.close()
+        elapsed = time.perf_counter() - started
+        self.log(f"Tải xong {self.stats['rows']} giao dịch trong {elapsed:.1f} giây ({self.stats['requests']} request, "
+                 f"{self.stats['rate_limited']} lần bị giới hạn, {self.budget.waits} lần chờ ngân sách).")
+        return self.stats['rows']
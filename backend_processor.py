@@ -11,12 +11,20 @@ from datetime import datetime, timedelta, timezone
 import threading 
 import time 
 import queue 
+import concurrent.futures
 
 import asyncio
 import websockets
 import pandas as pd
+import numpy as np
 import math
 
+from candle_engine import FootprintCandleEngine
+from trade_archive import TradeArchive, TRADE_ARCHIVE_DIR, LEGACY_TRADE_FILE, parquet_last_time, read_parquet_since
+from binary_frames import encode_message, decode_message, is_binary_frame, json_default
+from depth_sync import DepthBook
+from heatmap_storage import init_schema, load_rollups, build_heatmap_query, run_storage_maintenance, remove_unrecorded_archive_files, SIDE_CATEGORIES
+
 # <<<< MỚI: Import CSDL >>>>
 try:
     import duckdb
@@ -34,44 +42,140 @@ SERVER_PORT = 8766
 SYMBOL = 'BTCUSDT'
 CANDLE_DISPLAY_LIMIT = 200 
 TIMEFRAMES_PANDAS = { '1M': '1min', '5M': '5min', '15M': '15min', '1H': '1h', '4H': '4h', '1D': '1D' }
+TIMEFRAMES_MS = { '1M': 60 * 1000, '5M': 5 * 60 * 1000, '15M': 15 * 60 * 1000, '1H': 60 * 60 * 1000, '4H': 4 * 60 * 60 * 1000, '1D': 24 * 60 * 60 * 1000 }
 DEFAULT_PRICE_GROUPING = {'1M':5, '5M':15, '15M':25, '1H':35, '4H':100, '1D':250}
 
 # Cấu hình cho Heatmap Fading
 HEATMAP_FADE_DURATION_MS = 15 * 60 * 1000 # 15 phút
 HEATMAP_REFRESH_RATE_MS = 50 # 50ms (20 FPS)
 
+# Chu kỳ gộp message 'update' gửi cho frontend (thay vì 1 message mỗi trade)
+UPDATE_FLUSH_INTERVAL_MS = 100
+
+# Dựng sẵn nến từ kho aggTrades của data_collector khi khởi động (không đọc quá số ngày này)
+CANDLE_BOOTSTRAP_MAX_DAYS = 7
+
+# Xin data_collector gửi frame nhị phân (binary_frames.py) thay vì JSON
+USE_BINARY_FRAMES = True
+
 # ==============================================================================
 # CƠ SỞ DỮ LIỆU (DUCKDB)
 # ==============================================================================
 DB_FILE = 'heatmap_history.duckdb'
-DB_BATCH_SIZE = 2000 
-db_queue = queue.Queue() # Queue dùng để giao tiếp giữa Asyncio và Thread DuckDB
+# Độ phân giải thời gian của heatmap lịch sử theo timeframe (khớp với bảng rollup trong heatmap_storage)
+HEATMAP_TIME_BUCKET_MS = {'1M': 1000, '5M': 10000}
+DB_BATCH_SIZE = 50000 # Số dòng tối đa mỗi lần ghi (ghi theo cột, 1 lệnh append)
+DB_FLUSH_INTERVAL_S = 1.0 # Ghi buffer dù chưa đủ DB_BATCH_SIZE sau mỗi khoảng này
+DB_CHECKPOINT_INTERVAL_S = 300.0 # CHECKPOINT thưa hơn nhiều so với ghi (5 phút)
+# Chu kỳ lưu trữ phân vùng ngày cũ ra Parquet + xóa dữ liệu quá hạn (xem heatmap_storage)
+DB_MAINTENANCE_INTERVAL_S = 600.0
+db_queue = queue.Queue() # Queue dùng để giao tiếp giữa Asyncio và Thread DuckDB (mỗi phần tử = 1 depth event)
 db_thread = None 
+DB_QUEUE_HIGH_WATER = 300 # Số block tồn trong queue bị coi là nghẽn (~30 giây depth 100ms)
+# Số liệu backpressure của db_queue (đọc được từ bên ngoài, vd. để hiển thị / log)
+db_queue_stats = {
+    'blocks_enqueued': 0, 'rows_enqueued': 0, 'rows_written': 0,
+    'high_water_mark': 0, # qsize lớn nhất từng thấy
+    'over_high_water': 0, # Số lần enqueue khi queue đã vượt DB_QUEUE_HIGH_WATER
+}
 
 def print_log(message):
     """Ghi log với timestamp cho backend."""
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     print(f"[{timestamp}] [PROCESSOR-RT] {message}")
 
+SIDE_BID, SIDE_ASK = 0, 1
+
+def make_depth_block(event_time, bids, asks):
+    """1 depth event -> 1 block (timestamp, prices, quantities, sides) để đưa vào db_queue.
+    bids/asks: ndarray (n, 2) từ frame nhị phân hoặc list cặp chuỗi từ JSON."""
+    bids = np.asarray(bids, dtype=np.float64).reshape(-1, 2)
+    asks = np.asarray(asks, dtype=np.float64).reshape(-1, 2)
+    prices = np.concatenate((bids[:, 0], asks[:, 0]))
+    quantities = np.concatenate((bids[:, 1], asks[:, 1]))
+    sides = np.concatenate((np.full(len(bids), SIDE_BID, dtype=np.uint8), np.full(len(asks), SIDE_ASK, dtype=np.uint8)))
+    return (int(event_time), prices, quantities, sides)
+
+def enqueue_depth_block(block):
+    """Đưa 1 block vào db_queue (1 lần lấy khóa cho cả depth event) và cập nhật số liệu backpressure."""
+    db_queue.put(block)
+    stats = db_queue_stats
+    stats['blocks_enqueued'] += 1; stats['rows_enqueued'] += len(block[1])
+    qsize = db_queue.qsize()
+    if qsize > stats['high_water_mark']: stats['high_water_mark'] = qsize
+    if qsize > DB_QUEUE_HIGH_WATER:
+        stats['over_high_water'] += 1
+        if stats['over_high_water'] % 100 == 1:
+            print_log(f"CẢNH BÁO: Queue CSDL đang nghẽn ({qsize} block chờ ghi). Số liệu: {stats}")
+
+class LiquidityColumnBuffer:
+    """Buffer dạng cột cho luồng ghi CSDL: gom các block rồi ghi 1 lần bằng DuckDB append."""
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.blocks = []; self.n_rows = 0
+
+    def __len__(self):
+        return self.n_rows
+
+    def append_block(self, block):
+        if not len(block[1]): return
+        self.blocks.append(block); self.n_rows += len(block[1])
+
+    def to_frame(self):
+        blocks = self.blocks
+        return pd.DataFrame({
+            'timestamp_ms': np.repeat(np.array([b[0] for b in blocks], dtype=np.int64), [len(b[1]) for b in blocks]),
+            'price': np.concatenate([b[1] for b in blocks]).astype(np.float32),
+            'quantity': np.concatenate([b[2] for b in blocks]).astype(np.float32),
+            'side': pd.Categorical.from_codes(np.concatenate([b[3] for b in blocks]), SIDE_CATEGORIES),
+        })
+
+def write_liquidity_batch(db_conn, buffer, rollups=()):
+    """Ghi toàn bộ buffer vào liquidity_updates bằng 1 lệnh bulk (không executemany từng dòng),
+    sau đó cập nhật dần các bảng rollup heatmap từ chính lô vừa ghi."""
+    if not len(buffer): return 0
+    n_rows = len(buffer)
+    frame = buffer.to_frame()
+    db_conn.append('liquidity_updates', frame)
+    buffer.clear()
+    for rollup in rollups:
+        try: rollup.add(db_conn, frame)
+        except Exception as e: print_log(f"Lỗi cập nhật rollup {rollup.table}: {e}")
+    db_queue_stats['rows_written'] += n_rows
+    return n_rows
+
+def run_db_maintenance(db_conn, rollups):
+    """Lưu trữ/xóa dữ liệu cũ; lỗi chỉ ghi log để luồng ghi tiếp tục chạy."""
+    try:
+        result = run_storage_maintenance(db_conn, rollups)
+        if result['archived_files'] or result['removed_files'] or result['removed_rollup_rows']:
+            db_conn.execute("CHECKPOINT")
+            print_log(f"Bảo trì CSDL: lưu trữ {len(result['archived_files'])} phân vùng, xóa {result['removed_files']} file Parquet và {result['removed_rollup_rows']} dòng rollup quá hạn.")
+    except Exception as e:
+        print_log(f"Lỗi khi bảo trì CSDL (lưu trữ/xóa dữ liệu cũ): {e}")
+
 def db_writer_thread():
     """Hàm 'Nhân Viên Kho' (Chạy trên Thread riêng) - Ghi vào DuckDB"""
     print_log(f"Luồng Ghi CSDL (DuckDB) đã khởi động. Đang kết nối tới {DB_FILE}...")
     db_conn = None
+    rollups = []
+    local_buffer = LiquidityColumnBuffer()
     try:
         db_conn = duckdb.connect(DB_FILE)
-        db_conn.execute("""
-            CREATE TABLE IF NOT EXISTS liquidity_updates (
-                timestamp_ms BIGINT,
-                price REAL,
-                quantity REAL,
-                side VARCHAR
-            )
-        """)
-        db_conn.execute("CREATE INDEX IF NOT EXISTS idx_timestamp ON liquidity_updates (timestamp_ms)")
+        init_schema(db_conn)
+        # File Parquet sót lại của lần lưu trữ chết giữa chừng (chưa được ghi nhận) -> xóa, view chỉ đọc file đã ghi nhận
+        recovered = remove_unrecorded_archive_files(db_conn)
+        if recovered['removed_files'] or recovered['missing_files']:
+            print_log(f"Kho heatmap: xóa {recovered['removed_files']} file chưa ghi nhận, bỏ {recovered['missing_files']} file đã mất khỏi danh sách.")
+        rollups = load_rollups(db_conn)
+        run_db_maintenance(db_conn, rollups)
         print_log("Luồng CSDL kết nối thành công. Bắt đầu vòng lặp...")
         
-        local_buffer = []
-        last_commit_time = time.time()
+        last_flush_time = time.time()
+        last_checkpoint_time = last_flush_time
+        last_maintenance_time = last_flush_time
         
         while True:
             try:
@@ -81,36 +185,36 @@ def db_writer_thread():
                     print_log("Luồng CSDL nhận tín hiệu tắt máy...")
                     break 
                     
-                local_buffer.append(data)
+                local_buffer.append_block(data)
                 
                 if len(local_buffer) >= DB_BATCH_SIZE:
-                    db_conn.executemany("INSERT INTO liquidity_updates VALUES (?, ?, ?, ?)", local_buffer)
-                    db_conn.commit()
-                    db_conn.execute("CHECKPOINT")
-                    local_buffer.clear()
-                    last_commit_time = time.time()
+                    write_liquidity_batch(db_conn, local_buffer, rollups)
+                    last_flush_time = time.time()
                 
             except queue.Empty:
                 pass 
                 
             current_time = time.time()
-            if local_buffer and (current_time - last_commit_time > 5.0): # 5 giây
-                db_conn.executemany("INSERT INTO liquidity_updates VALUES (?, ?, ?, ?)", local_buffer)
-                db_conn.commit()
+            if len(local_buffer) and (current_time - last_flush_time > DB_FLUSH_INTERVAL_S):
+                write_liquidity_batch(db_conn, local_buffer, rollups)
+                last_flush_time = current_time
+            if current_time - last_checkpoint_time > DB_CHECKPOINT_INTERVAL_S:
                 db_conn.execute("CHECKPOINT")
-                local_buffer.clear()
-                last_commit_time = current_time
+                last_checkpoint_time = current_time
+                print_log(f"CSDL CHECKPOINT. Queue: {db_queue.qsize()} block chờ ghi, số liệu: {db_queue_stats}")
+            if current_time - last_maintenance_time > DB_MAINTENANCE_INTERVAL_S:
+                run_db_maintenance(db_conn, rollups)
+                last_maintenance_time = time.time()
 
     except Exception as e:
         print_log(f"!!! Lỗi nghiêm trọng trong Luồng CSDL: {e}")
     finally:
         if db_conn:
             try:
-                if local_buffer:
+                if len(local_buffer):
                     print_log(f"Ghi nốt {len(local_buffer)} dữ liệu cuối cùng...")
-                    db_conn.executemany("INSERT INTO liquidity_updates VALUES (?, ?, ?, ?)", local_buffer)
-                    db_conn.commit()
-                    db_conn.execute("CHECKPOINT")
+                    write_liquidity_batch(db_conn, local_buffer, rollups)
+                db_conn.execute("CHECKPOINT")
                 print_log("Luồng CSDL đang đóng kết nối...")
                 db_conn.close()
             except Exception as e:
@@ -123,79 +227,141 @@ def db_writer_thread():
 
 # --- Biến toàn cục cho backend ---
 connected_clients = set()
-recent_candles = {tf: deque(maxlen=CANDLE_DISPLAY_LIMIT) for tf in TIMEFRAMES_PANDAS.keys()}
-current_candles = {}
-last_candle_close_prices = {}
+# Chế độ nhận 'update' của từng client: 'full' (mặc định, gửi cả nến) hoặc 'delta' (chỉ level đổi)
+client_update_modes = {}
+update_seq = 0 # Số thứ tự của message update, tăng sau mỗi lần flush
+# Định dạng frame của từng client: 'json' (mặc định) hoặc 'binary'
+client_frame_modes = {}
+# Luồng gửi heatmap lịch sử đang chạy của từng client + số thứ tự luồng (để client bỏ chunk cũ)
+heatmap_stream_tasks = {}
+heatmap_stream_ids = {}
 current_price_grouping = DEFAULT_PRICE_GROUPING.copy()
+candle_engine = FootprintCandleEngine(TIMEFRAMES_MS, current_price_grouping, CANDLE_DISPLAY_LIMIT)
+recent_candles = candle_engine.recent_candles # Nến đã đóng theo từng timeframe (đã định dạng)
+# Trong lúc dựng nến từ lịch sử: trade live được giữ lại ở đây rồi phát lại sau (None = không dựng)
+bootstrap_pending_trades = None
+client_timeframes = {} # Timeframe client yêu cầu gần nhất (để gửi lại full_data sau khi dựng nến)
+book_mirror = DepthBook() # Bản sao sổ lệnh đầy đủ của collector (book_snapshot + delta có đánh số) cho client mới vào
 
-def group_price(price, timeframe):
-    global current_price_grouping 
-    group_val = current_price_grouping.get(timeframe, DEFAULT_PRICE_GROUPING.get(timeframe, 10))
-    if group_val <= 0: group_val = 1 
-    return int(price / group_val) * group_val
-
-def format_candle(candle):
-    if not candle: return None
-    levels_list = sorted([[p, round(vols['b'], 4), round(vols['a'], 4)] for p, vols in candle['levels'].items()], key=lambda x: x[0], reverse=True)
-    formatted = candle.copy()
-    formatted['timestamp'] = int(candle['timestamp'].timestamp() * 1000)
-    formatted['levels'] = levels_list
-    formatted['totalVolume'] = round(candle['totalVolume'], 4)
-    return formatted
-
-async def broadcast_to_frontend(message):
-    if connected_clients:
-        await asyncio.gather(*[client.send(message) for client in connected_clients], return_exceptions=True)
+def encode_for_client(websocket, message):
+    """Mã hóa message dict theo định dạng frame mà client đã chọn."""
+    if client_frame_modes.get(websocket) == 'binary': return encode_message(message)
+    return json.dumps(message, default=json_default)
+
+async def broadcast_to_frontend(message, clients=None, encoded=None):
+    """message: dict. Mỗi định dạng frame chỉ mã hóa 1 lần.
+    encoded: {'json': str, 'binary': bytes} đã có sẵn (vd. frame nhận từ collector) để khỏi mã hóa lại."""
+    clients = connected_clients if clients is None else clients
+    if not clients: return
+    encoded = dict(encoded or {})
+    sends = []
+    for client in clients:
+        mode = client_frame_modes.get(client, 'json')
+        if mode not in encoded: encoded[mode] = encode_for_client(client, message)
+        sends.append(client.send(encoded[mode]))
+    await asyncio.gather(*sends, return_exceptions=True)
 
 async def process_trade(trade):
-    """Xử lý trade mới và cập nhật nến footprint hiện tại."""
+    """Xử lý trade mới và cập nhật nến footprint hiện tại (mọi timeframe trong 1 lượt).
+    Không gửi gì ở đây: update_flusher sẽ gửi gộp theo chu kỳ UPDATE_FLUSH_INTERVAL_MS."""
+    if bootstrap_pending_trades is not None:
+        bootstrap_pending_trades.append(trade); return
     try:
-        trade_time = pd.to_datetime(trade['T'], unit='ms', utc=True)
-        trade_price = float(trade['p']); trade_qty = float(trade['q']); is_buyer_maker = trade['m']
-        
-        updated_tf = []
-        for tf_key, tf_pandas in TIMEFRAMES_PANDAS.items():
-            candle_timestamp = trade_time.floor(tf_pandas)
-            
-            if tf_key not in current_candles or current_candles[tf_key]['timestamp'] != candle_timestamp:
-                if tf_key in current_candles and current_candles[tf_key]:
-                    finished_candle = format_candle(current_candles[tf_key])
-                    recent_candles[tf_key].append(finished_candle)
-                
-                last_close = last_candle_close_prices.get(tf_key, trade_price)
-                current_candles[tf_key] = {
-                    "timestamp": candle_timestamp, 
-                    "time": candle_timestamp.strftime('%H:%M'), 
-                    "open": last_close, "high": trade_price, "low": trade_price, 
-                    "close": trade_price, "totalVolume": 0, "levels": {},
-                }
-            
-            candle = current_candles[tf_key]
-            candle.update(high=max(candle['high'], trade_price), low=min(candle['low'], trade_price), close=trade_price, totalVolume=candle['totalVolume'] + trade_qty)
-            last_candle_close_prices[tf_key] = trade_price
-            
-            grouped_p = group_price(trade_price, tf_key)
-            if grouped_p not in candle['levels']: candle['levels'][grouped_p] = {'b': 0, 'a': 0}
-            if is_buyer_maker: candle['levels'][grouped_p]['b'] += trade_qty 
-            else: candle['levels'][grouped_p]['a'] += trade_qty 
-            updated_tf.append(tf_key)
-            
-        if updated_tf:
-            message_to_send = {"type": "update", "data": {tf: format_candle(current_candles[tf]) for tf in updated_tf if tf in current_candles}}
-            await broadcast_to_frontend(json.dumps(message_to_send))
+        candle_engine.add_trade(int(trade['T']), float(trade['p']), float(trade['q']), trade['m'])
     except Exception as e:
         print_log(f"Lỗi khi xử lý trade: {e}")
 
+async def flush_updates():
+    """Gửi 1 message gộp cho các timeframe đã thay đổi từ lần flush trước.
+    Client 'full' nhận 'update' (cả nến), client 'delta' nhận 'update_delta' (chỉ level đổi + OHLC)."""
+    global update_seq
+    full_clients = [c for c in connected_clients if client_update_modes.get(c, 'full') == 'full']
+    delta_clients = [c for c in connected_clients if client_update_modes.get(c) == 'delta']
+    updates, deltas, closed = candle_engine.take_updates(with_full=bool(full_clients), with_delta=bool(delta_clients))
+    if not updates and not deltas and not closed: return
+    update_seq += 1
+    if full_clients:
+        message_to_send = {"type": "update", "seq": update_seq, "data": updates}
+        if closed: message_to_send["closed"] = closed # Trạng thái cuối của các nến vừa đóng
+        await broadcast_to_frontend(message_to_send, full_clients)
+    if delta_clients:
+        message_to_send = {"type": "update_delta", "seq": update_seq, "data": deltas}
+        if closed: message_to_send["closed"] = closed
+        await broadcast_to_frontend(message_to_send, delta_clients)
+
+async def update_flusher(interval_ms=UPDATE_FLUSH_INTERVAL_MS):
+    """Task nền: mỗi tick gom các nến 'dirty' thành 1 message 'update'."""
+    interval = max(interval_ms, 1) / 1000
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await flush_updates()
+        except Exception as e:
+            print_log(f"Lỗi khi gửi update gộp: {e}")
+
+def build_candles_from_archive(archive_dir=TRADE_ARCHIVE_DIR, legacy_file=LEGACY_TRADE_FILE):
+    """Hàm chặn (chạy trên executor): dựng engine nến mới từ phần đuôi kho aggTrades.
+    Chỉ mở các file / row group có thể chứa trade trong cửa sổ cần (history_limit nến của mọi timeframe).
+    Chưa có kho (collector chưa chuyển file cũ) thì đọc file Parquet cũ."""
+    engine = FootprintCandleEngine(TIMEFRAMES_MS, current_price_grouping, CANDLE_DISPLAY_LIMIT)
+    archive = TradeArchive(archive_dir)
+    if archive.exists(): last_ts, read_since = archive.last_time(), archive.read_since
+    else: last_ts, read_since = parquet_last_time(legacy_file), lambda since: read_parquet_since(legacy_file, since)
+    since_ms = None
+    if last_ts is not None:
+        since_ms = max(engine.history_start_ms(last_ts), last_ts - CANDLE_BOOTSTRAP_MAX_DAYS * TIMEFRAMES_MS['1D'])
+    trades, groups_read, groups_total = read_since(since_ms)
+    if since_ms is None and len(trades['T']): # File cũ không có thống kê: tự cắt cửa sổ sau khi đọc
+        last_ts = int(trades['T'][-1])
+        since_ms = max(engine.history_start_ms(last_ts), last_ts - CANDLE_BOOTSTRAP_MAX_DAYS * TIMEFRAMES_MS['1D'])
+        keep = trades['T'] >= since_ms
+        trades = {k: v[keep] for k, v in trades.items()}
+    n_candles = engine.load_history(trades['T'], trades['p'], trades['q'], trades['m'])
+    return engine, len(trades['T']), n_candles, groups_read, groups_total
+
+async def bootstrap_candles():
+    """Dựng nến từ kho lưu trữ trade rồi chuyển sang cập nhật live: engine mới thay engine rỗng,
+    các trade nhận được trong lúc dựng ('history' của collector + trade live) được phát lại
+    (engine tự bỏ phần đã có trong lịch sử)."""
+    global candle_engine, recent_candles, bootstrap_pending_trades
+    loop = asyncio.get_event_loop()
+    replaced = False
+    try:
+        engine, n_trades, n_candles, groups_read, groups_total = await loop.run_in_executor(None, build_candles_from_archive)
+        if n_trades:
+            engine.set_price_grouping(current_price_grouping) # Grouping có thể đã đổi trong lúc dựng
+            candle_engine = engine; recent_candles = engine.recent_candles; replaced = True
+            print_log(f"Đã dựng {n_candles} nến từ {n_trades} trade lịch sử (đọc {groups_read}/{groups_total} row group).")
+    except Exception as e:
+        print_log(f"Không dựng được nến từ kho lịch sử trade: {e}")
+    finally:
+        pending, bootstrap_pending_trades = bootstrap_pending_trades, None
+        for trade in pending or (): await process_trade(trade)
+    if not replaced: return
+    # Client đã kết nối trong lúc dựng đang giữ lịch sử rỗng -> gửi lại full_data
+    for websocket, tf in list(client_timeframes.items()):
+        try: await websocket.send(json.dumps({ "type": "full_data", "timeframe": tf, "seq": update_seq, "data": candle_engine.full_history(tf) }))
+        except Exception: pass
+
 async def collector_subscriber():
     """Chạy trên luồng Asyncio, nhận data từ data_collector và quẳng vào Queue CSDL."""
     global db_queue
+    # Trade collector chưa kịp ghi vào kho (ghi theo chu kỳ) chỉ có trong message 'history' đầu tiên:
+    # phát vào engine 1 lần để nối liền lịch sử với trade live. Kết nối lại sau đó thì bỏ
+    # (các trade đó đã được tính khi nhận live).
+    replay_history = True
     while True:
         try:
             async with websockets.connect(DATA_COLLECTOR_URI) as websocket:
                 print_log(f"Đã kết nối tới 'Tổng đài' {DATA_COLLECTOR_URI} để nhận dữ liệu trực tiếp.")
+                book_mirror.reset() # Collector gửi book_snapshot ngay khi kết nối
+                if USE_BINARY_FRAMES:
+                    await websocket.send(json.dumps({"type": "set_protocol", "frames": "binary"}))
                 async for message in websocket:
                     try:
-                        data = json.loads(message)
+                        # Frame nhị phân: bids/asks là ndarray float64 (view, không copy)
+                        is_binary = is_binary_frame(message)
+                        data = decode_message(message) if is_binary else json.loads(message)
                         if not isinstance(data, dict): continue
                         msg_type = data.get('type')
                         
@@ -203,18 +369,31 @@ async def collector_subscriber():
                             event_time = data.get('timestamp')
                             if not event_time: continue 
                             bids = data.get('bids', []); asks = data.get('asks', [])
-                            # Gửi data liquidity vào queue cho luồng DuckDB
-                            for p, q in bids: db_queue.put((event_time, float(p), float(q), 'bid'))
-                            for p, q in asks: db_queue.put((event_time, float(p), float(q), 'ask'))
-                            await broadcast_to_frontend(message) # Vẫn broadcast live
+                            # Gửi CẢ depth event vào queue cho luồng DuckDB (1 block, không put từng level)
+                            enqueue_depth_block(make_depth_block(event_time, bids, asks))
+                            # Hở thì bản sao bị xóa, chờ book_snapshot kế tiếp của collector
+                            if data.get('update_id') is not None: book_mirror.apply_delta_message(data)
+                            # Vẫn broadcast live; frame gốc được chuyển tiếp nguyên vẹn cho client cùng định dạng
+                            await broadcast_to_frontend(data, encoded={'binary' if is_binary else 'json': message})
+
+                        elif msg_type == 'book_snapshot':
+                            # Không ghi vào DuckDB (heatmap cộng dồn các depth event); chỉ cập nhật bản sao + chuyển tiếp
+                            book_mirror.load_snapshot(data['update_id'], data.get('bids', []), data.get('asks', []), data.get('timestamp'))
+                            await broadcast_to_frontend(data, encoded={'binary' if is_binary else 'json': message})
+
+                        elif msg_type == 'history':
+                            if replay_history:
+                                for trade_data in data.get('data') or (): await process_trade(trade_data)
+                            replay_history = False
 
                         elif msg_type == 'trade':
+                            replay_history = False
                             trade_data = data.get('data') 
                             if trade_data: await process_trade(trade_data) 
                              
                     except json.JSONDecodeError: pass 
                     except Exception as e:
-                        print_log(f"Lỗi khi xử lý tin nhắn từ collector: {e} - Tin nhắn (200 ký tự đầu): {message[:200]}...")
+                        print_log(f"Lỗi khi xử lý tin nhắn từ collector: {e} - Tin nhắn (200 ký tự đầu): {message[:200]!r}...")
         except Exception as e:
             print_log(f"Mất kết nối với 'Tổng đài' data_collector: {e}. Thử lại sau 5 giây...")
             await asyncio.sleep(5) 
@@ -222,44 +401,114 @@ async def collector_subscriber():
 # ==============================================================================
 # HÀM Truy vấn CSDL
 # ==============================================================================
-def _blocking_db_query(start_time_ms, price_grouping, min_liquidity):
-    """Hàm I/O Chặn, chạy trên thread pool của asyncio."""
-    
-    with duckdb.connect(DB_FILE) as conn:
-        query = f"""
-            SELECT 
-                (timestamp_ms / 1000) * 1000 AS time_bucket,
-                CAST(price / {price_grouping} AS INTEGER) * {price_grouping} AS price_bucket,
-                side,
-                SUM(quantity) AS total_quantity
-            FROM liquidity_updates
-            WHERE 
-                timestamp_ms >= {start_time_ms}
-                AND quantity >= {min_liquidity}
-            GROUP BY 
-                time_bucket, price_bucket, side
-            ORDER BY
-                time_bucket, price_bucket
-        """
-        return conn.execute(query).df()
-
-async def query_historical_heatmap(start_time_ms, price_grouping, min_liquidity):
-    """Hàm Async (không chặn) để gọi hàm I/O Chặn."""
+class HeatmapReaderPool:
+    """Pool cố định các cursor đọc DuckDB sống lâu, dùng chung cho mọi truy vấn heatmap.
+    Tất cả cursor được tạo từ 1 kết nối gốc nên dùng chung catalog và buffer cache
+    (cùng database instance với luồng ghi). Pool chỉ dùng để đọc."""
+    def __init__(self, db_file, size):
+        self.db_file = db_file; self.size = size
+        self._lock = threading.Lock()
+        self._base_conn = None
+        self._cursors = queue.Queue()
+
+    def _ensure_open(self):
+        with self._lock:
+            if self._base_conn is None:
+                self._base_conn = duckdb.connect(self.db_file)
+                for _ in range(self.size): self._cursors.put(self._base_conn.cursor())
+
+    def query_numpy(self, sql, params=None):
+        """Chạy 1 truy vấn (có tham số) trên 1 cursor rảnh của pool; chặn nếu pool đang bận hết.
+        Trả về dict cột NumPy (không dựng DataFrame)."""
+        self._ensure_open()
+        cursor = self._cursors.get()
+        try:
+            return cursor.execute(sql, params).fetchnumpy()
+        finally:
+            self._cursors.put(cursor)
+
+    def close(self):
+        with self._lock:
+            while not self._cursors.empty():
+                try: self._cursors.get_nowait().close()
+                except Exception: pass
+            if self._base_conn is not None:
+                self._base_conn.close(); self._base_conn = None
+
+DB_READER_POOL_SIZE = 2 # Số truy vấn heatmap chạy song song tối đa
+db_reader_pool = HeatmapReaderPool(DB_FILE, DB_READER_POOL_SIZE)
+# Executor riêng (giới hạn số luồng = số cursor) thay cho executor mặc định của event loop
+db_query_executor = concurrent.futures.ThreadPoolExecutor(max_workers=DB_READER_POOL_SIZE, thread_name_prefix='heatmap-reader')
+
+HEATMAP_CHUNK_CANDLES = 20 # Mỗi chunk heatmap gửi cho frontend bao phủ bấy nhiêu nến
+
+def heatmap_result_columns(result):
+    """Kết quả fetchnumpy() -> cột heatmap gửi đi (side: 0 = bid, 1 = ask)."""
+    return {
+        "time_bucket": np.asarray(result['time_bucket'], dtype=np.int64),
+        "price_bucket": np.asarray(result['price_bucket'], dtype=np.float64),
+        "side": (np.asarray(result['side'], dtype=object) == 'ask').astype(np.uint8),
+        "total_quantity": np.asarray(result['total_quantity'], dtype=np.float64),
+    }
+
+def empty_heatmap_columns():
+    return heatmap_result_columns({'time_bucket': [], 'price_bucket': [], 'side': [], 'total_quantity': []})
+
+def _blocking_db_query(start_time_ms, price_grouping, min_liquidity, time_bucket_ms=1000, end_time_ms=None):
+    """Hàm I/O Chặn, chạy trên db_query_executor.
+    Đọc từ bảng rollup phù hợp (xem heatmap_storage) thay vì quét toàn bộ bảng thô."""
+    query, params = build_heatmap_query(start_time_ms, price_grouping, min_liquidity, time_bucket_ms, end_time_ms=end_time_ms)
+    return heatmap_result_columns(db_reader_pool.query_numpy(query, params))
+
+async def query_historical_heatmap(start_time_ms, price_grouping, min_liquidity, time_bucket_ms=1000, end_time_ms=None):
+    """Hàm Async (không chặn) để gọi hàm I/O Chặn. Trả về dict cột NumPy (rỗng nếu lỗi)."""
     loop = asyncio.get_event_loop()
     try:
-        df = await loop.run_in_executor(None, _blocking_db_query, start_time_ms, price_grouping, min_liquidity)
-        return df.to_dict('records')
+        return await loop.run_in_executor(db_query_executor, _blocking_db_query, start_time_ms, price_grouping, min_liquidity, time_bucket_ms, end_time_ms)
     except Exception as e:
         print_log(f"Lỗi khi truy vấn CSDL heatmap: {e}")
-        return []
+        return empty_heatmap_columns()
+
+async def stream_historical_heatmap(websocket, stream_id, tf, start_time_ms, end_time_ms, price_grouping, min_liquidity):
+    """Gửi heatmap lịch sử thành từng chunk theo cửa sổ thời gian, MỚI NHẤT TRƯỚC.
+    Mỗi cửa sổ là 1 truy vấn nhỏ (HEATMAP_CHUNK_CANDLES nến) nên chunk đầu tiên đến ngay,
+    không phụ thuộc độ dài lịch sử. Message: {"type": "heatmap_chunk", "timeframe", "stream_id",
+    "chunk" (0 = chunk đầu, client xóa heatmap cũ), "final", "data": cột}."""
+    chunk_ms = HEATMAP_CHUNK_CANDLES * TIMEFRAMES_MS[tf]
+    time_bucket_ms = HEATMAP_TIME_BUCKET_MS[tf]
+    # Ranh giới cửa sổ là bội số của chunk_ms (cũng là bội số của ô thời gian) để không cắt đôi ô nào
+    window_end = (end_time_ms // chunk_ms + 1) * chunk_ms
+    chunk_index = 0; total_points = 0
+    try:
+        while True:
+            window_start = window_end - chunk_ms
+            final = window_start <= start_time_ms
+            columns = await query_historical_heatmap(window_start, price_grouping, min_liquidity, time_bucket_ms, window_end)
+            n_points = len(columns['time_bucket'])
+            if n_points or final or chunk_index == 0:
+                await websocket.send(encode_for_client(websocket, {
+                    "type": "heatmap_chunk", "timeframe": tf, "stream_id": stream_id,
+                    "chunk": chunk_index, "final": final, "data": columns,
+                }))
+                chunk_index += 1; total_points += n_points
+            if final: break
+            window_end = window_start
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print_log(f"Lỗi khi gửi heatmap {tf}: {e}"); return
+    print_log(f"Đã gửi {total_points} điểm heatmap {tf} trong {chunk_index} chunk.")
 
 async def serve_frontend_client(websocket, *args):
     """Xử lý kết nối từ Giao diện (PySide6 app)."""
     global current_price_grouping 
     
+    # Snapshot sổ lệnh được tạo và client được thêm vào cùng 1 bước (không await xen giữa) -> delta sau đó nối tiếp snapshot
+    book_snapshot = book_mirror.snapshot_message() if book_mirror.synced else None
     connected_clients.add(websocket)
     print_log(f"Giao diện của Đại ca đã kết nối. Tổng số: {len(connected_clients)}")
     try:
+        if book_snapshot is not None: await websocket.send(encode_for_client(websocket, book_snapshot))
         async for message in websocket:
             try:
                 data = json.loads(message)
@@ -268,11 +517,11 @@ async def serve_frontend_client(websocket, *args):
                 if msg_type == 'request_timeframe':
                     tf = data.get('timeframe')
                     if tf in TIMEFRAMES_PANDAS:
+                        client_timeframes[websocket] = tf
                         # 1. Gửi nến
-                        full_data_list = list(recent_candles[tf])
-                        if tf in current_candles and current_candles[tf]:
-                            full_data_list.append(format_candle(current_candles[tf]))
-                        await websocket.send(json.dumps({ "type": "full_data", "timeframe": tf, "data": full_data_list }))
+                        full_data_list = candle_engine.full_history(tf)
+                        # 'seq' = số thứ tự update cuối đã gửi; client delta nối tiếp từ seq + 1
+                        await websocket.send(json.dumps({ "type": "full_data", "timeframe": tf, "seq": update_seq, "data": full_data_list }))
                         
                         # 2. Gửi Heatmap Lịch Sử
                         if tf in ['1M', '5M']: 
@@ -281,26 +530,38 @@ async def serve_frontend_client(websocket, *args):
                             grouping_val = current_price_grouping.get(tf, 10)
                             if grouping_val <= 0: grouping_val = 1
                             
-                            tf_duration_ms = pd.to_timedelta(TIMEFRAMES_PANDAS[tf]).total_seconds() * 1000
+                            tf_duration_ms = TIMEFRAMES_MS[tf]
                             total_duration_ms = max_candles * tf_duration_ms
                             end_time_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
                             # Lùi lại 5 nến dự phòng
                             start_time_ms = end_time_ms - total_duration_ms - (tf_duration_ms * 5) 
                             
-                            print_log(f"Đang truy vấn CSDL heatmap cho {tf} từ {datetime.fromtimestamp(start_time_ms/1000)}...")
-                            heatmap_data = await query_historical_heatmap(start_time_ms, grouping_val, min_liq)
-                            print_log(f"Truy vấn xong, gửi {len(heatmap_data)} điểm dữ liệu heatmap.")
-                            
-                            await websocket.send(json.dumps({
-                                "type": "full_heatmap",
-                                "timeframe": tf,
-                                "data": heatmap_data
-                            }))
+                            # Hủy luồng gửi heatmap cũ của client này (đổi timeframe / grouping giữa chừng)
+                            old_task = heatmap_stream_tasks.pop(websocket, None)
+                            if old_task: old_task.cancel()
+                            heatmap_stream_ids[websocket] = heatmap_stream_ids.get(websocket, 0) + 1
+                            heatmap_stream_tasks[websocket] = asyncio.create_task(stream_historical_heatmap(
+                                websocket, heatmap_stream_ids[websocket], tf, start_time_ms, end_time_ms, grouping_val, min_liq))
                 
+                elif msg_type == 'request_book_snapshot':
+                    # Client thấy hở delta sổ lệnh: gửi lại cả sổ (chưa có bản sao thì client chờ snapshot định kỳ)
+                    if book_mirror.synced: await websocket.send(encode_for_client(websocket, book_mirror.snapshot_message()))
+
+                elif msg_type == 'set_protocol':
+                    mode = data.get('updates')
+                    if mode in ('full', 'delta'):
+                        client_update_modes[websocket] = mode
+                        print_log(f"Client chọn chế độ update: {mode}")
+                    frames = data.get('frames')
+                    if frames in ('json', 'binary'):
+                        client_frame_modes[websocket] = frames
+                        print_log(f"Client chọn định dạng frame: {frames}")
+
                 elif msg_type == 'update_settings': 
                     new_grouping = data.get('price_grouping')
                     if isinstance(new_grouping, dict):
                         current_price_grouping.update(new_grouping) # Chỉ update, không replace toàn bộ
+                        candle_engine.set_price_grouping(current_price_grouping)
                         print_log(f"Backend đã cập nhật PRICE_GROUPING: {current_price_grouping}")
                         
             except json.JSONDecodeError:
@@ -312,17 +573,27 @@ async def serve_frontend_client(websocket, *args):
         print_log(f"Lỗi giao tiếp với client: {e}")
     finally:
         connected_clients.remove(websocket)
+        client_update_modes.pop(websocket, None)
+        client_frame_modes.pop(websocket, None)
+        client_timeframes.pop(websocket, None)
+        heatmap_stream_ids.pop(websocket, None)
+        stream_task = heatmap_stream_tasks.pop(websocket, None)
+        if stream_task: stream_task.cancel()
         print_log(f"Giao diện đã ngắt kết nối. Còn lại: {len(connected_clients)}")
 
 
 async def start_backend_server(): 
     """Hàm main_async của backend, khởi động server cho frontend và subscriber."""
+    global bootstrap_pending_trades
     print_log("Cỗ máy CHẾ BIẾN đang khởi động...")
+    bootstrap_pending_trades = [] # Giữ trade live cho tới khi dựng xong nến từ lịch sử
+    bootstrap_task = asyncio.create_task(bootstrap_candles())
     server = await websockets.serve(serve_frontend_client, SERVER_HOST, SERVER_PORT)
     print_log(f"Server cho giao diện đã sẵn sàng tại ws://{SERVER_HOST}:{SERVER_PORT}")
     
     subscriber_task = asyncio.create_task(collector_subscriber())
-    await asyncio.gather(subscriber_task, server.wait_closed())
+    flusher_task = asyncio.create_task(update_flusher())
+    await asyncio.gather(bootstrap_task, subscriber_task, flusher_task, server.wait_closed())
 
 # ==============================================================================
 # HÀM KHỞI ĐỘNG BACKEND TRONG THREAD MỚI
@@ -347,10 +618,12 @@ def run_backend_in_thread():
     except asyncio.CancelledError:
         print_log("Luồng backend đã bị hủy.")
     finally:
+        db_query_executor.shutdown(wait=False)
+        db_reader_pool.close()
         loop.close()
         print_log("Đã đóng event loop của luồng backend.")
 
 # Exports cần thiết cho main_app.py:
-# run_backend_in_thread, db_queue, db_thread, SERVER_HOST, SERVER_PORT
+# run_backend_in_thread, db_queue, db_thread, db_queue_stats, SERVER_HOST, SERVER_PORT
 # Exports cần thiết cho frontend_ui.py:
 # HEATMAP_FADE_DURATION_MS, HEATMAP_REFRESH_RATE_MS, TIMEFRAMES_PANDAS, DEFAULT_PRICE_GROUPING
\ No newline at end of file
@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+# FILE: benchmarks.py
+# Các bài đo hiệu năng (chạy tay, không phải test).
+# Cách dùng:  python benchmarks.py candles [số_trade]
+#             python benchmarks.py frames [số_lần_lặp]
+#             python benchmarks.py db_writer [số_dòng]
+#             python benchmarks.py heatmap_query [số_giờ_dữ_liệu]
+#             python benchmarks.py regroup [số_level_mỗi_nến]
+#             python benchmarks.py bootstrap [số_trade]
+#             python benchmarks.py backfill [số_trade]
+#             python benchmarks.py depth_sync [số_event]
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import tempfile
+from collections import defaultdict, deque
+
+import numpy as np
+import pandas as pd
+
+from candle_engine import FootprintCandleEngine
+from binary_frames import encode_message, decode_message, json_default
+from heatmap_storage import init_schema, load_rollups, build_heatmap_query
+
+TIMEFRAMES_PANDAS = { '1M': '1min', '5M': '5min', '15M': '15min', '1H': '1h', '4H': '4h', '1D': '1D' }
+TIMEFRAMES_MS = { '1M': 60 * 1000, '5M': 5 * 60 * 1000, '15M': 15 * 60 * 1000, '1H': 60 * 60 * 1000, '4H': 4 * 60 * 60 * 1000, '1D': 24 * 60 * 60 * 1000 }
+DEFAULT_PRICE_GROUPING = {'1M':5, '5M':15, '15M':25, '1H':35, '4H':100, '1D':250}
+
+
+def make_trades(n, seed=42, start_ms=1_700_000_000_000, start_price=60000.0):
+    """Sinh n aggTrade giả lập (random walk) theo format của data_collector."""
+    rng = random.Random(seed)
+    trades = []; ts = start_ms; price = start_price
+    for _ in range(n):
+        ts += rng.randint(0, 40)
+        price = max(1.0, price + rng.gauss(0, 2.0))
+        trades.append({'T': ts, 'p': f"{price:.2f}", 'q': f"{rng.expovariate(20):.5f}", 'm': rng.random() < 0.5})
+    return trades
+
+
+def report(name, n, seconds):
+    rate = n / seconds if seconds > 0 else float('inf')
+    print(f"  {name:<34} {seconds * 1000:10.1f} ms   {rate:14,.0f} /s")
+    return rate
+
+# ==============================================================================
+# NẾN FOOTPRINT: process_trade cũ (pandas + dict) vs FootprintCandleEngine
+# ==============================================================================
+
+class LegacyCandleBuilder:
+    """Bản sao logic process_trade cũ (pd.to_datetime + floor + dict lồng nhau) để so sánh."""
+    def __init__(self, price_grouping):
+        self.price_grouping = price_grouping
+        self.recent_candles = {tf: [] for tf in TIMEFRAMES_PANDAS}
+        self.current_candles = {}; self.last_close = {}
+
+    def group_price(self, price, tf):
+        group_val = self.price_grouping.get(tf, 10)
+        if group_val <= 0: group_val = 1
+        return int(price / group_val) * group_val
+
+    @staticmethod
+    def format_candle(candle):
+        levels_list = sorted([[p, round(v['b'], 4), round(v['a'], 4)] for p, v in candle['levels'].items()], key=lambda x: x[0], reverse=True)
+        formatted = candle.copy()
+        formatted['timestamp'] = int(candle['timestamp'].timestamp() * 1000)
+        formatted['levels'] = levels_list
+        formatted['totalVolume'] = round(candle['totalVolume'], 4)
+        return formatted
+
+    def add_trade(self, trade):
+        trade_time = pd.to_datetime(trade['T'], unit='ms', utc=True)
+        price = float(trade['p']); qty = float(trade['q'])
+        for tf, tf_pandas in TIMEFRAMES_PANDAS.items():
+            ts = trade_time.floor(tf_pandas)
+            if tf not in self.current_candles or self.current_candles[tf]['timestamp'] != ts:
+                if tf in self.current_candles: self.recent_candles[tf].append(self.format_candle(self.current_candles[tf]))
+                last_close = self.last_close.get(tf, price)
+                self.current_candles[tf] = {"timestamp": ts, "time": ts.strftime('%H:%M'), "open": last_close, "high": price, "low": price, "close": price, "totalVolume": 0, "levels": {}}
+            c = self.current_candles[tf]
+            c.update(high=max(c['high'], price), low=min(c['low'], price), close=price, totalVolume=c['totalVolume'] + qty)
+            self.last_close[tf] = price
+            p = self.group_price(price, tf)
+            if p not in c['levels']: c['levels'][p] = {'b': 0, 'a': 0}
+            if trade['m']: c['levels'][p]['b'] += qty
+            else: c['levels'][p]['a'] += qty
+
+
+def bench_candles(n_trades=50_000):
+    print(f"[candles] {n_trades:,} trades, {len(TIMEFRAMES_MS)} timeframes")
+    trades = make_trades(n_trades)
+
+    legacy = LegacyCandleBuilder(DEFAULT_PRICE_GROUPING.copy())
+    t0 = time.perf_counter()
+    for tr in trades: legacy.add_trade(tr)
+    legacy_rate = report("legacy: cập nhật nến", n_trades, time.perf_counter() - t0)
+
+    engine = FootprintCandleEngine(TIMEFRAMES_MS, DEFAULT_PRICE_GROUPING.copy(), history_limit=None)
+    t0 = time.perf_counter()
+    for tr in trades: engine.add_trade(int(tr['T']), float(tr['p']), float(tr['q']), tr['m'])
+    engine_rate = report("engine: cập nhật nến", n_trades, time.perf_counter() - t0)
+    print(f"  => nhanh hơn x{engine_rate / legacy_rate:.1f}")
+
+    # Kiểm tra kết quả 2 bên giống nhau
+    for tf in TIMEFRAMES_MS:
+        expected = legacy.recent_candles[tf] + [legacy.format_candle(legacy.current_candles[tf])]
+        assert engine.full_history(tf) == expected, f"Kết quả khác nhau ở {tf}"
+
+    # Đường đi đầy đủ của process_trade cũ: cập nhật + format 6 nến + json.dumps mỗi trade
+    n_msg = min(n_trades, 5_000)
+    legacy = LegacyCandleBuilder(DEFAULT_PRICE_GROUPING.copy())
+    t0 = time.perf_counter()
+    for tr in trades[:n_msg]:
+        legacy.add_trade(tr)
+        json.dumps({"type": "update", "data": {tf: legacy.format_candle(c) for tf, c in legacy.current_candles.items()}})
+    legacy_rate = report("legacy: cập nhật + message", n_msg, time.perf_counter() - t0)
+
+    engine = FootprintCandleEngine(TIMEFRAMES_MS, DEFAULT_PRICE_GROUPING.copy())
+    t0 = time.perf_counter()
+    for tr in trades[:n_msg]:
+        engine.add_trade(int(tr['T']), float(tr['p']), float(tr['q']), tr['m'])
+        json.dumps({"type": "update", "data": {tf: engine.current_candle(tf) for tf in TIMEFRAMES_MS}})
+    engine_rate = report("engine: cập nhật + message", n_msg, time.perf_counter() - t0)
+    print(f"  => nhanh hơn x{engine_rate / legacy_rate:.1f}")
+
+
+# ==============================================================================
+# FRAME: JSON (chuỗi giá/khối lượng) vs frame nhị phân (binary_frames.py)
+# ==============================================================================
+
+def _sample_messages(rng):
+    """Các message điển hình trên 3 chặng collector -> backend -> frontend."""
+    trade = {"type": "trade", "data": {'T': 1_700_000_000_000, 'p': "60000.10", 'q': "0.01200", 'm': True}}
+    depth = {"type": "liquidity_raw", "timestamp": 1_700_000_000_000,
+             "bids": [[f"{60000 - i * 0.1:.2f}", f"{rng.random() * 5:.5f}"] for i in range(250)],
+             "asks": [[f"{60000 + i * 0.1:.2f}", f"{rng.random() * 5:.5f}"] for i in range(250)]}
+    engine = FootprintCandleEngine(TIMEFRAMES_MS, DEFAULT_PRICE_GROUPING.copy())
+    for tr in make_trades(20_000, seed=7):
+        engine.add_trade(int(tr['T']), float(tr['p']), float(tr['q']), tr['m'])
+    update = {"type": "update", "seq": 1, "data": {tf: engine.current_candle(tf) for tf in TIMEFRAMES_MS}}
+    n = 200_000
+    heatmap_cols = {'time_bucket': np.arange(n, dtype=np.int64) * 1000, 'price_bucket': np.full(n, 60000.0),
+                    'side': np.zeros(n, dtype=np.uint8), 'total_quantity': np.ones(n)}
+    heatmap_json = {"type": "full_heatmap", "timeframe": "5M",
+                    "data": [{'time_bucket': int(i) * 1000, 'price_bucket': 60000, 'side': 'bid', 'total_quantity': 1.0} for i in range(n)]}
+    heatmap_bin = {"type": "full_heatmap", "timeframe": "5M", "data": heatmap_cols}
+    return [("trade", trade, trade), ("liquidity_raw (500 level)", depth, depth),
+            ("update (6 nến)", update, update), (f"full_heatmap ({n:,} điểm)", heatmap_json, heatmap_bin)]
+
+
+def bench_frames(repeat=200):
+    print(f"[frames] encode + decode, {repeat} lần lặp (heatmap: 3 lần)")
+    rng = random.Random(1)
+    for name, msg_json, msg_bin in _sample_messages(rng):
+        n = 3 if name.startswith("full_heatmap") else repeat
+        text = json.dumps(msg_json); frame = encode_message(msg_bin)
+        t0 = time.perf_counter()
+        for _ in range(n):
+            decoded = json.loads(json.dumps(msg_json))
+            if name.startswith("liquidity"): [(float(p), float(q)) for p, q in decoded['bids']] # Bên nhận phải float() từng chuỗi
+        t_json = (time.perf_counter() - t0) / n
+        t0 = time.perf_counter()
+        for _ in range(n): decode_message(encode_message(msg_bin))
+        t_bin = (time.perf_counter() - t0) / n
+        print(f"  {name:<28} JSON {t_json * 1e6:10.1f} us {len(text):>10,} B | nhị phân {t_bin * 1e6:10.1f} us {len(frame):>10,} B | x{t_json / t_bin:.1f}")
+
+
+# ==============================================================================
+# GHI DUCKDB: put từng level + executemany theo lô 2000 + CHECKPOINT mỗi lô
+#            vs put cả depth event (block) + ghi theo cột
+# ==============================================================================
+
+def _make_depth_events(n_rows, levels_per_side=250, seed=3):
+    """Các depth event giả lập (~500 level mỗi event, cách nhau 100ms), giá/khối lượng dạng chuỗi như Binance."""
+    rng = random.Random(seed)
+    ts = 1_700_000_000_000
+    events = []
+    for _ in range(max(1, n_rows // (2 * levels_per_side))):
+        ts += 100
+        bids = [[f"{60000 - rng.randint(0, 5000) * 0.1:.2f}", f"{rng.random() * 5:.5f}"] for _ in range(levels_per_side)]
+        asks = [[f"{60000 + rng.randint(0, 5000) * 0.1:.2f}", f"{rng.random() * 5:.5f}"] for _ in range(levels_per_side)]
+        events.append((ts, bids, asks))
+    return events
+
+
+def bench_db_writer(n_rows=200_000):
+    import duckdb
+    import backend_processor as bp
+    print(f"[db_writer] ~{n_rows:,} dòng liquidity")
+    events = _make_depth_events(n_rows)
+    n_rows = sum(len(b) + len(a) for _, b, a in events)
+    with tempfile.TemporaryDirectory() as tmp:
+        # Đường cũ rất chậm, chỉ đo ~50k dòng đầu
+        legacy_events = events[:max(1, 50_000 // (len(events[0][1]) * 2))]
+        n_legacy = sum(len(b) + len(a) for _, b, a in legacy_events)
+        conn = duckdb.connect(os.path.join(tmp, 'legacy.duckdb')); init_schema(conn)
+        q = bp.queue.Queue(); rows = []
+        t0 = time.perf_counter()
+        for ts, bids, asks in legacy_events:
+            for p, qty in bids: q.put((ts, float(p), float(qty), 'bid'))
+            for p, qty in asks: q.put((ts, float(p), float(qty), 'ask'))
+        while not q.empty():
+            rows.append(q.get())
+            if len(rows) >= 2000:
+                conn.executemany("INSERT INTO liquidity_updates VALUES (?, ?, ?, ?)", rows); rows.clear()
+                conn.commit(); conn.execute("CHECKPOINT")
+        if rows: conn.executemany("INSERT INTO liquidity_updates VALUES (?, ?, ?, ?)", rows)
+        legacy_rate = report("legacy: put từng level + executemany", n_legacy, time.perf_counter() - t0)
+        conn.close()
+
+        conn = duckdb.connect(os.path.join(tmp, 'columnar.duckdb')); init_schema(conn)
+        buffer = bp.LiquidityColumnBuffer(); q = bp.queue.Queue()
+        t0 = time.perf_counter()
+        for ts, bids, asks in events: q.put(bp.make_depth_block(ts, bids, asks))
+        while not q.empty():
+            buffer.append_block(q.get())
+            if len(buffer) >= bp.DB_BATCH_SIZE: bp.write_liquidity_batch(conn, buffer)
+        bp.write_liquidity_batch(conn, buffer); conn.execute("CHECKPOINT")
+        columnar_rate = report("columnar: put block + append", n_rows, time.perf_counter() - t0)
+        assert conn.execute("SELECT COUNT(*) FROM liquidity_updates").fetchone()[0] == n_rows
+        conn.close()
+    print(f"  => nhanh hơn x{columnar_rate / legacy_rate:.1f}")
+
+
+def bench_heatmap_query(hours=8, window_candles=200):
+    """Truy vấn heatmap lịch sử với cửa sổ CỐ ĐỊNH (window_candles nến 1M) khi CSDL lớn dần:
+    bảng thô vs rollup, cho cả 2 rollup (1M grouping 5 / ô 1s -> rollup 1s; grouping 20 / ô 10s -> rollup 10s).
+    Khi dữ liệu đã dài hơn cửa sổ, thời gian rollup phải đứng yên còn bảng thô tăng theo kích thước CSDL."""
+    import duckdb
+    import backend_processor as bp
+    from heatmap_storage import choose_rollup
+    # Như stream @depth@100ms: 10 diff/giây, mỗi diff vài chục level quanh giá giữa (đi ngẫu nhiên)
+    events_per_second = 10; levels_per_side = 20; rows_per_hour = 3600 * events_per_second * 2 * levels_per_side
+    window_ms = window_candles * TIMEFRAMES_MS['1M']
+    # (nhãn, ô thời gian ms, price grouping, rollup phải được chọn)
+    cases = [('1s x 1', bp.HEATMAP_TIME_BUCKET_MS['1M'], DEFAULT_PRICE_GROUPING['1M'], 'liquidity_rollup_1s'),
+             ('10s x 10', 10000, 20, 'liquidity_rollup_10s')]
+    for _, time_bucket_ms, grouping, table in cases: assert choose_rollup(time_bucket_ms, grouping)[0] == table
+    print(f"[heatmap_query] depth {events_per_second} event/giây x {2 * levels_per_side} level, tới {hours} giờ dữ liệu, cửa sổ cố định {window_candles} nến 1M")
+    print(f"  {'':>26}" + "".join(f"{'raw ' + label:>16}{'rollup ' + label:>18}" for label, _, _, _ in cases))
+    rng = np.random.default_rng(7)
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = duckdb.connect(os.path.join(tmp, 'heatmap.duckdb')); init_schema(conn)
+        rollups = load_rollups(conn)
+        buffer = bp.LiquidityColumnBuffer()
+        ts = 1_700_000_000_000; mid = 60000.0
+        for hour in range(1, hours + 1):
+            for _ in range(3600 * events_per_second):
+                ts += 1000 // events_per_second; mid += rng.normal(0, 0.5)
+                prices = np.round(np.concatenate((mid - rng.integers(1, 500, levels_per_side) * 0.1, mid + rng.integers(1, 500, levels_per_side) * 0.1)), 1)
+                sides = np.repeat(np.array([bp.SIDE_BID, bp.SIDE_ASK], dtype=np.uint8), levels_per_side)
+                buffer.append_block((ts, prices, rng.random(2 * levels_per_side) * 5, sides))
+                if len(buffer) >= bp.DB_BATCH_SIZE: bp.write_liquidity_batch(conn, buffer, rollups)
+            bp.write_liquidity_batch(conn, buffer, rollups)
+            start_ms = ts - window_ms
+            line = f"  {hour:>2} giờ ({hour * rows_per_hour:>11,} dòng):"
+            for _, time_bucket_ms, grouping, _ in cases:
+                results = {}
+                for label, use_rollups in (('raw', False), ('rollup', True)):
+                    query, params = build_heatmap_query(start_ms, grouping, 0, time_bucket_ms, use_rollups=use_rollups)
+                    results[label] = _best_of(lambda: conn.execute(query, params).df())
+                (raw_s, raw_df), (rollup_s, rollup_df) = results['raw'], results['rollup']
+                assert len(raw_df) == len(rollup_df) and np.allclose(raw_df['total_quantity'].sum(), rollup_df['total_quantity'].sum())
+                line += f"{raw_s * 1000:13.1f} ms{rollup_s * 1000:15.1f} ms"
+            print(line)
+        conn.close()
+
+
+# ==============================================================================
+# GỘP NẾN Ở FRONTEND: vòng lặp Python cũ vs aggregate_candle_levels (NumPy)
+# ==============================================================================
+
+def legacy_regroup(chart_data_list, group_by):
+    """Bản sao phần gộp level + 2 profile của DataProcessor.process_data cũ."""
+    aggregated = []
+    for candle in chart_data_list:
+        new_levels = defaultdict(lambda: {'b': 0, 'a': 0})
+        for p, b, a in candle.get('levels', []):
+            new_levels[int(p / group_by) * group_by]['b'] += b; new_levels[int(p / group_by) * group_by]['a'] += a
+        agg_candle = candle.copy(); agg_candle['levels'] = [[p, v['b'], v['a']] for p, v in new_levels.items()]
+        aggregated.append(agg_candle)
+    total = defaultdict(float)
+    for candle in aggregated:
+        for p, b, a in candle['levels']: total[p] += b + a
+    detailed = defaultdict(float)
+    for candle in chart_data_list:
+        for p, b, a in candle.get('levels', []): detailed[p] += b + a
+    return aggregated, dict(total), dict(detailed)
+
+
+def _make_candles(n, levels_per_candle, seed=11):
+    rng = np.random.default_rng(seed)
+    candles, price = [], 60000.0
+    for i in range(n):
+        low = round(price + rng.normal(0, 30)); price = low + levels_per_candle / 2
+        levels = [[float(low + j), float(rng.random() * 3), float(rng.random() * 3)] for j in range(levels_per_candle - 1, -1, -1)]
+        candles.append({'timestamp': 1_700_000_000_000 + i * 60_000, 'open': low + 5, 'high': low + levels_per_candle - 1,
+                        'low': float(low), 'close': low + 10, 'totalVolume': 1.0, 'levels': levels})
+    return candles
+
+
+def _best_of(fn, *args, repeat=3):
+    """Thời gian nhỏ nhất sau repeat lần chạy (bỏ nhiễu lần chạy đầu) + kết quả lần cuối."""
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter(); result = fn(*args); best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def bench_regroup(levels_per_candle=60):
+    from frontend_ui import aggregate_candle_levels
+    group_by = 5
+    print(f"[regroup] {levels_per_candle} level/nến, grouping {group_by}")
+    for n in (200, 1_000, 10_000):
+        candles = _make_candles(n, levels_per_candle)
+        t_legacy, legacy = _best_of(legacy_regroup, candles, group_by)
+        t_fast, fast = _best_of(aggregate_candle_levels, candles, group_by)
+        for old_candle, new_candle in zip(legacy[0], fast[0]):
+            assert sorted(old_candle['levels']) == sorted(new_candle['levels']) or np.allclose(sorted(old_candle['levels']), sorted(new_candle['levels']))
+        for old_profile, new_profile in zip(legacy[1:], fast[1:3]):
+            assert old_profile.keys() == new_profile.keys() and np.allclose([old_profile[k] for k in old_profile], [new_profile[k] for k in old_profile])
+        print(f"  {n:>6,} nến:  legacy {t_legacy * 1000:8.1f} ms   numpy {t_fast * 1000:8.1f} ms   => x{t_legacy / t_fast:.1f}")
+
+
+def bench_bootstrap(n_trades=500_000):
+    """Dựng nến từ trade lịch sử: add_trade từng trade vs load_history (NumPy), kiểm tra kết quả giống nhau."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from trade_archive import read_parquet_since
+    trades = make_trades(n_trades)
+    ts = np.array([t['T'] for t in trades], dtype=np.int64); prices = np.array([float(t['p']) for t in trades])
+    qtys = np.array([float(t['q']) for t in trades]); makers = np.array([t['m'] for t in trades])
+    print(f"[bootstrap] {n_trades:,} trade")
+    loop_engine = FootprintCandleEngine(TIMEFRAMES_MS, DEFAULT_PRICE_GROUPING, 200)
+    t0 = time.perf_counter()
+    for T, p, q, m in zip(ts.tolist(), prices.tolist(), qtys.tolist(), makers.tolist()): loop_engine.add_trade(T, p, q, m)
+    report("add_trade từng trade", n_trades, time.perf_counter() - t0)
+    engine = FootprintCandleEngine(TIMEFRAMES_MS, DEFAULT_PRICE_GROUPING, 200)
+    t0 = time.perf_counter(); engine.load_history(ts, prices, qtys, makers)
+    report("load_history (NumPy)", n_trades, time.perf_counter() - t0)
+    for tf in TIMEFRAMES_MS: assert engine.full_history(tf) == loop_engine.full_history(tf), tf
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'aggtrades.parquet')
+        pq.write_table(pa.table({'T': ts, 'p': prices, 'q': qtys, 'm': makers}), path, row_group_size=max(1, n_trades // 50))
+        since_ms = int(ts[-1]) - int(ts[-1] - ts[0]) // 10
+        t0 = time.perf_counter(); tail, groups_read, groups_total = read_parquet_since(path, since_ms)
+        print(f"  đọc đuôi (10% thời gian cuối): {len(tail['T']):,} trade, {groups_read}/{groups_total} row group, {(time.perf_counter() - t0) * 1000:.1f} ms")
+
+
+# ==============================================================================
+# TẢI LỊCH SỬ aggTrades: server HTTP giả lập /api/v3/aggTrades ở máy (có độ trễ + giới hạn weight)
+# ==============================================================================
+
+def bench_backfill(n_trades=200_000):
+    """Tải n_trade từ server giả lập (test_aggtrades_backfill.FakeAggTradesServer): 1 luồng vs nhiều shard song song.
+    Đúng / sai (429, tải tiếp từ backfill_state.json, điểm bắt đầu) nằm ở test_aggtrades_backfill.py."""
+    from trade_archive import TradeArchive
+    from aggtrades_backfill import AggTradesBackfill, WeightBudget
+    from test_aggtrades_backfill import FakeAggTradesServer
+
+    async def run():
+        server = FakeAggTradesServer(n_trades); await server.start()
+        print(f"[backfill] {n_trades:,} trade, server giả lập {server.url}: trễ {server.latency_s * 1000:.0f} ms/request, {server.weight_limit} weight/{server.window_s:.0f}s")
+        start_ms = int(server.times[0])
+        try:
+            for concurrency in (1, 8):
+                with tempfile.TemporaryDirectory() as tmp:
+                    archive = TradeArchive(tmp)
+                    backfill = AggTradesBackfill('BTCUSDT', archive, base_url=server.url, concurrency=concurrency,
+                                                 budget=WeightBudget(server.weight_limit, window_s=server.window_s), shard_pages=20, log=lambda m: None)
+                    t0 = time.perf_counter(); await backfill.run(start_ms); seconds = time.perf_counter() - t0
+                    report(f"{concurrency} luồng ({backfill.stats['requests']} request, {backfill.stats['rate_limited']} lần 429)", n_trades, seconds)
+        finally:
+            await server.stop()
+
+    asyncio.run(run())
+
+
+# ==============================================================================
+# SỔ LỆNH ĐẦY ĐỦ: sàn giả lập (sổ thật + depthUpdate có đánh số + snapshot REST trễ) -> OrderBookSync
+# ==============================================================================
+
+def bench_depth_sync(n_events=50_000, drop_rate=0.002, wire_lag=3):
+    """Tốc độ OrderBookSync trên sàn giả lập (test_depth_sync.FakeDepthExchange): stream có mất event (drop_rate,
+    trễ wire_lag event, mỗi message đóng frame nhị phân như collector) và stream liền mạch; cỡ / thời gian đóng book_snapshot.
+    Đúng / sai (hở -> đồng bộ lại, bên nhận, vào giữa luồng) nằm ở test_depth_sync.py."""
+    from depth_sync import OrderBookSync
+    from test_depth_sync import FakeDepthExchange
+
+    async def run():
+        exchange = FakeDepthExchange(); rng = random.Random(1)
+        print(f"[depth_sync] {n_events:,} event, sổ {len(exchange.bids) + len(exchange.asks):,} mức, mất {drop_rate:.1%} event, trễ {wire_lag} event")
+        counts = {'deltas': 0, 'snapshots': 0}
+
+        async def publish(message):
+            counts['snapshots' if message['type'] == 'book_snapshot' else 'deltas'] += 1
+            encode_message(message)
+
+        sync = OrderBookSync(exchange.snapshot, publish, log=lambda m: None)
+        wire = deque(); dropped = 0
+        t0 = time.perf_counter()
+        for i in range(n_events):
+            event = exchange.step()
+            if rng.random() < drop_rate: dropped += 1
+            else: wire.append(event)
+            while len(wire) > wire_lag: await sync.on_event(wire.popleft())
+            await asyncio.sleep(0) # Cho task lấy snapshot chạy
+        while wire: await sync.on_event(wire.popleft())
+        while sync._resync_task is not None and not sync._resync_task.done(): await asyncio.sleep(0.001)
+        seconds = time.perf_counter() - t0
+        stats = sync.stats
+        report(f"sync + frame nhị phân ({stats['gaps']} hở, {exchange.snapshots} snapshot REST)", n_events, seconds)
+        print(f"  mất {dropped} event -> tự đồng bộ lại {stats['snapshots']} lần; gửi {counts['deltas']:,} delta + {counts['snapshots']} book_snapshot")
+
+        # Chỉ chi phí của OrderBookSync trên stream liền mạch (event sinh trước, publish rỗng)
+        events = [exchange.step() for _ in range(n_events)]
+        async def publish_nothing(message): pass
+        clean = OrderBookSync(exchange.snapshot, publish_nothing, log=lambda m: None)
+        clean.book.load_snapshot(events[0]['U'] - 1, [], [])
+        t0 = time.perf_counter()
+        for event in events: await clean.on_event(event)
+        report("OrderBookSync.on_event (liền mạch)", n_events, time.perf_counter() - t0)
+
+        message = sync.book.snapshot_message()
+        t0 = time.perf_counter(); frame = encode_message(message); encode_s = time.perf_counter() - t0
+        t0 = time.perf_counter(); text = json.dumps(message, default=json_default); json_s = time.perf_counter() - t0
+        print(f"  book_snapshot {len(message['bids']) + len(message['asks']):,} mức: nhị phân {len(frame) / 1024:.0f} KB ({encode_s * 1000:.2f} ms), JSON {len(text) / 1024:.0f} KB ({json_s * 1000:.2f} ms)")
+
+    asyncio.run(run())
+
+
+BENCHMARKS = {
+    'candles': bench_candles,
+    'frames': bench_frames,
+    'db_writer': bench_db_writer,
+    'heatmap_query': bench_heatmap_query,
+    'regroup': bench_regroup,
+    'bootstrap': bench_bootstrap,
+    'backfill': bench_backfill,
+    'depth_sync': bench_depth_sync,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:2] or list(BENCHMARKS)
+    args = [int(a) for a in sys.argv[2:]]
+    for name in names:
+        BENCHMARKS[name](*args)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# FILE: binary_frames.py
+# Định dạng frame NHỊ PHÂN (tùy chọn) cho các luồng collector -> backend -> frontend.
+# Thay cho json.dumps / json.loads trên giá & khối lượng dạng chuỗi: số được đóng gói
+# 1 lần thành cột float64/int64, bên nhận đọc thẳng bằng np.frombuffer (không copy).
+#
+# Bố cục 1 frame:
+#   MAGIC (4 byte) | u32 độ dài header | header JSON (đệm tới bội số 8) | các cột (mỗi cột đệm tới bội số 8)
+# Header JSON chứa metadata của message + danh sách cột [tên, dtype, shape].
+# Riêng 'trade' dùng struct cố định 29 byte (MAGIC_TRADE) cho nhẹ.
+#
+# Đàm phán: client gửi {"type": "set_protocol", "frames": "binary"} (dạng text).
+# Bên nhận phân biệt frame text (JSON) và frame bytes (nhị phân) nên 2 loại dùng chung 1 kết nối.
+
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b'FPB1'
+_HEADER_LEN = struct.Struct('<I')
+# Trade đi rất dày nên dùng bố cục cố định riêng: MAGIC_TRADE | T int64 | p float64 | q float64 | m uint8
+MAGIC_TRADE = b'FPT1'
+_TRADE = struct.Struct('<qddB')
+_ALIGN = 8
+
+# Các message có định dạng nhị phân
+BINARY_MESSAGE_TYPES = ('trade', 'liquidity_raw', 'book_snapshot', 'update', 'update_delta', 'full_heatmap', 'heatmap_chunk')
+
+SIDE_CODES = {'bid': 0, 'ask': 1}
+SIDE_NAMES = ('bid', 'ask')
+
+
+def _pad(n):
+    return (-n) % _ALIGN
+
+
+def encode_frame(header, columns):
+    """Đóng gói header (dict) + các cột NumPy thành 1 frame bytes."""
+    arrays = []
+    col_meta = []
+    for name, arr in columns.items():
+        arr = np.ascontiguousarray(arr)
+        if arr.dtype.byteorder == '>': arr = arr.astype(arr.dtype.newbyteorder('<'))
+        col_meta.append([name, arr.dtype.str, list(arr.shape)])
+        arrays.append(arr)
+    header = dict(header); header['columns'] = col_meta
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    header_bytes += b' ' * _pad(len(MAGIC) + _HEADER_LEN.size + len(header_bytes))
+    parts = [MAGIC, _HEADER_LEN.pack(len(header_bytes)), header_bytes]
+    for arr in arrays:
+        raw = arr.tobytes()
+        parts.append(raw)
+        if _pad(len(raw)): parts.append(b'\0' * _pad(len(raw)))
+    return b''.join(parts)
+
+
+def decode_frame(buf):
+    """Giải mã frame -> (header, {tên cột: ndarray}). Các cột là view (chỉ đọc) trên buf, không copy."""
+    buf = memoryview(buf)
+    if bytes(buf[:len(MAGIC)]) != MAGIC:
+        raise ValueError("Frame nhị phân không hợp lệ (sai MAGIC)")
+    offset = len(MAGIC)
+    (header_len,) = _HEADER_LEN.unpack_from(buf, offset)
+    offset += _HEADER_LEN.size
+    header = json.loads(bytes(buf[offset:offset + header_len]))
+    offset += header_len
+    columns = {}
+    for name, dtype_str, shape in header.pop('columns', []):
+        dtype = np.dtype(dtype_str)
+        count = int(np.prod(shape)) if shape else 1
+        arr = np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+        columns[name] = arr.reshape(shape)
+        nbytes = count * dtype.itemsize
+        offset += nbytes + _pad(nbytes)
+    return header, columns
+
+
+def is_binary_frame(message):
+    return isinstance(message, (bytes, bytearray, memoryview)) and bytes(message[:len(MAGIC)]) in (MAGIC, MAGIC_TRADE)
+
+
+def _levels_array(pairs, width):
+    """List cặp [giá, khối lượng] (chuỗi hoặc số) -> ndarray float64 (n, width)."""
+    if isinstance(pairs, np.ndarray):
+        return pairs.astype(np.float64, copy=False).reshape(-1, width)
+    if not len(pairs):
+        return np.empty((0, width), dtype=np.float64)
+    return np.array(pairs, dtype=np.float64).reshape(-1, width)
+
+# ==============================================================================
+# ENCODE / DECODE THEO TỪNG LOẠI MESSAGE
+# ==============================================================================
+
+def encode_message(message):
+    """Message dict (cùng cấu trúc với bản JSON) -> frame nhị phân."""
+    msg_type = message.get('type')
+    if msg_type == 'trade':
+        t = message['data']
+        return MAGIC_TRADE + _TRADE.pack(int(t['T']), float(t['p']), float(t['q']), bool(t['m']))
+    if msg_type in ('liquidity_raw', 'book_snapshot'):
+        # Header giữ timestamp + số thứ tự sổ (prev_update_id / update_id) nếu có
+        return encode_frame({k: v for k, v in message.items() if k not in ('bids', 'asks')}, {
+            'bids': _levels_array(message.get('bids', []), 2),
+            'asks': _levels_array(message.get('asks', []), 2),
+        })
+    if msg_type in ('update', 'update_delta'):
+        header = {k: v for k, v in message.items() if k not in ('data', 'closed')}
+        columns = {}
+        header['data'] = {}
+        for tf, candle in message.get('data', {}).items():
+            header['data'][tf] = {k: v for k, v in candle.items() if k != 'levels'}
+            columns[f"data/{tf}"] = _levels_array(candle.get('levels', []), 3)
+        if 'closed' in message:
+            header['closed'] = {}
+            for tf, candles in message['closed'].items():
+                header['closed'][tf] = []
+                for i, candle in enumerate(candles):
+                    header['closed'][tf].append({k: v for k, v in candle.items() if k != 'levels'})
+                    columns[f"closed/{tf}/{i}"] = _levels_array(candle.get('levels', []), 3)
+        return encode_frame(header, columns)
+    if msg_type in ('full_heatmap', 'heatmap_chunk'):
+        data = message.get('data', {})
+        side = data.get('side', [])
+        if len(side) and not isinstance(side[0], (int, np.integer)):
+            side = [SIDE_CODES.get(s, 0) for s in side]
+        return encode_frame({k: v for k, v in message.items() if k != 'data'}, {
+            'time_bucket': np.asarray(data.get('time_bucket', []), dtype=np.int64),
+            'price_bucket': np.asarray(data.get('price_bucket', []), dtype=np.float64),
+            'side': np.asarray(side, dtype=np.uint8),
+            'total_quantity': np.asarray(data.get('total_quantity', []), dtype=np.float64),
+        })
+    raise ValueError(f"Không có định dạng nhị phân cho message '{msg_type}'")
+
+
+def decode_message(buf):
+    """Frame nhị phân -> message dict. Các mảng số là ndarray view trên buf (không copy)."""
+    if bytes(buf[:len(MAGIC_TRADE)]) == MAGIC_TRADE:
+        T, p, q, m = _TRADE.unpack_from(buf, len(MAGIC_TRADE))
+        return {'type': 'trade', 'data': {'T': T, 'p': p, 'q': q, 'm': bool(m)}}
+    header, columns = decode_frame(buf)
+    msg_type = header.get('type')
+    if msg_type in ('liquidity_raw', 'book_snapshot'):
+        header['bids'] = columns['bids']; header['asks'] = columns['asks']
+    elif msg_type in ('update', 'update_delta'):
+        for tf, candle in header.get('data', {}).items():
+            candle['levels'] = columns[f"data/{tf}"]
+        for tf, candles in header.get('closed', {}).items():
+            for i, candle in enumerate(candles):
+                candle['levels'] = columns[f"closed/{tf}/{i}"]
+    elif msg_type in ('full_heatmap', 'heatmap_chunk'):
+        header['data'] = columns
+    return header
+
+
+def json_default(obj):
+    """Dùng cho json.dumps(..., default=json_default): đổi ndarray / số NumPy về kiểu Python."""
+    if isinstance(obj, np.ndarray): return obj.tolist()
+    if isinstance(obj, np.generic): return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+# FILE: candle_engine.py
+# Bộ máy gộp nến Footprint dùng mảng kiểu cố định (array) thay cho dict lồng nhau.
+# Mốc thời gian của nến tính bằng số học mili-giây nguyên (không dùng pandas),
+# mọi khung thời gian được cập nhật trong MỘT vòng lặp cho mỗi trade.
+
+from array import array
+from collections import deque
+from datetime import datetime, timezone
+
+import numpy as np
+
+# Số ô giá dự phòng mỗi phía khi cấp phát / mở rộng mảng level
+LEVEL_PADDING = 64
+
+
+def bucket_index(price, group_val):
+    """Chỉ số ô giá (giống hệt int(price / group) trong code cũ)."""
+    return int(price / group_val)
+
+
+def candle_time_label(start_ms):
+    return datetime.fromtimestamp(start_ms / 1000, tz=timezone.utc).strftime('%H:%M')
+
+
+class _OpenCandle:
+    """Nến đang mở: OHLC + khối lượng Bid/Ask theo ô giá, lưu trong array('d')."""
+    __slots__ = ('start_ms', 'end_ms', 'time', 'open', 'high', 'low', 'close',
+                 'total_volume', 'group', 'base', 'bid', 'ask', 'hit',
+                 'changed', 'full_dirty')
+
+    def __init__(self, start_ms, tf_ms, open_price, first_price, group_val):
+        self.start_ms = start_ms
+        self.end_ms = start_ms + tf_ms
+        self.time = candle_time_label(start_ms)
+        # Giống code cũ: open = close nến trước, high/low bắt đầu từ giá trade đầu tiên
+        self.open = open_price; self.high = first_price; self.low = first_price; self.close = first_price
+        self.total_volume = 0.0
+        self.group = group_val
+        self.base = 0 # Chỉ số ô giá tương ứng với phần tử [0] của mảng
+        self.bid = array('d'); self.ask = array('d')
+        self.hit = bytearray() # 1 = ô giá đã có giao dịch
+        # Cho chế độ delta: chỉ số ô giá (tuyệt đối) đã đổi từ lần lấy delta trước
+        self.changed = set()
+        self.full_dirty = True # Nến mới / vừa regroup -> lần sau phải gửi toàn bộ levels
+
+    def _grow(self, idx):
+        """Mở rộng mảng để chứa được ô giá idx (hiếm khi xảy ra)."""
+        size = len(self.hit)
+        if size == 0:
+            self.base = idx - LEVEL_PADDING
+            size = 2 * LEVEL_PADDING + 1
+            self.bid = array('d', bytes(8 * size)); self.ask = array('d', bytes(8 * size))
+            self.hit = bytearray(size)
+            return
+        rel = idx - self.base
+        if rel < 0:
+            extra = -rel + LEVEL_PADDING
+            self.bid = array('d', bytes(8 * extra)) + self.bid
+            self.ask = array('d', bytes(8 * extra)) + self.ask
+            self.hit = bytearray(extra) + self.hit
+            self.base -= extra
+        elif rel >= size:
+            extra = rel - size + 1 + LEVEL_PADDING
+            self.bid.extend(array('d', bytes(8 * extra)))
+            self.ask.extend(array('d', bytes(8 * extra)))
+            self.hit.extend(bytearray(extra))
+
+    def add(self, price, qty, is_buyer_maker):
+        if price > self.high: self.high = price
+        if price < self.low: self.low = price
+        self.close = price
+        self.total_volume += qty
+        rel = bucket_index(price, self.group) - self.base
+        if rel < 0 or rel >= len(self.hit):
+            self._grow(rel + self.base)
+            rel = bucket_index(price, self.group) - self.base
+        if is_buyer_maker: self.bid[rel] += qty
+        else: self.ask[rel] += qty
+        self.hit[rel] = 1
+        self.changed.add(rel + self.base)
+
+    def load_levels(self, indices, bids, asks):
+        """Nạp các level đã gộp sẵn (chỉ số ô giá TĂNG dần) khi dựng nến từ lịch sử."""
+        if not indices: return
+        self._grow(indices[0]); self._grow(indices[-1])
+        bid, ask, hit, base = self.bid, self.ask, self.hit, self.base
+        for idx, b, a in zip(indices, bids, asks):
+            rel = idx - base
+            bid[rel] = b; ask[rel] = a; hit[rel] = 1
+        self.changed = set(); self.full_dirty = True
+
+    def iter_levels(self):
+        """Duyệt các level đã có giao dịch theo giá GIẢM dần: (price, bid, ask)."""
+        bid, ask, hit, base, group = self.bid, self.ask, self.hit, self.base, self.group
+        for i in range(len(hit) - 1, -1, -1):
+            if hit[i]:
+                yield (base + i) * group, bid[i], ask[i]
+
+    def regroup(self, group_val):
+        """Gộp lại các level đã có theo price grouping mới."""
+        levels = list(self.iter_levels())
+        self.group = group_val
+        self.bid = array('d'); self.ask = array('d'); self.hit = bytearray(); self.base = 0
+        for p, b, a in levels:
+            idx = bucket_index(p, group_val)
+            if not self.hit or not (0 <= idx - self.base < len(self.hit)):
+                self._grow(idx)
+            rel = idx - self.base
+            self.bid[rel] += b; self.ask[rel] += a; self.hit[rel] = 1
+        self.changed = set(); self.full_dirty = True
+
+    def to_dict(self):
+        """Định dạng giống format_candle cũ (gửi cho frontend)."""
+        return {
+            "timestamp": self.start_ms,
+            "time": self.time,
+            "open": self.open, "high": self.high, "low": self.low, "close": self.close,
+            "totalVolume": round(self.total_volume, 4),
+            "levels": [[p, round(b, 4), round(a, 4)] for p, b, a in self.iter_levels()],
+        }
+
+    def take_delta(self):
+        """Như to_dict nhưng 'levels' chỉ gồm các ô giá đã đổi (giá trị tuyệt đối).
+        'full' = True nghĩa là 'levels' là danh sách đầy đủ (nến mới / đã regroup)."""
+        if self.full_dirty:
+            delta = self.to_dict(); delta['full'] = True
+        else:
+            bid, ask, base, group = self.bid, self.ask, self.base, self.group
+            delta = {
+                "timestamp": self.start_ms,
+                "time": self.time,
+                "open": self.open, "high": self.high, "low": self.low, "close": self.close,
+                "totalVolume": round(self.total_volume, 4),
+                "levels": [[idx * group, round(bid[idx - base], 4), round(ask[idx - base], 4)] for idx in sorted(self.changed, reverse=True)],
+                "full": False,
+            }
+        self.changed = set(); self.full_dirty = False
+        return delta
+
+
+class FootprintCandleEngine:
+    """Quản lý nến đang mở + lịch sử nến đã đóng cho nhiều khung thời gian."""
+
+    def __init__(self, timeframes_ms, price_grouping, history_limit=200):
+        self.timeframes_ms = dict(timeframes_ms)
+        self.price_grouping = {}
+        self.history_limit = history_limit
+        self.recent_candles = {tf: deque(maxlen=history_limit) for tf in self.timeframes_ms}
+        self.current = {} # tf -> _OpenCandle
+        self.last_close = {}
+        # Theo dõi thay đổi giữa 2 lần flush (để gộp message 'update')
+        self.dirty = set()
+        self.closed_since_flush = {} # tf -> [nến vừa đóng (đã định dạng)]
+        # Danh sách phẳng để vòng lặp nóng không phải tra dict nhiều lần
+        self._tf_items = list(self.timeframes_ms.items())
+        # Sau load_history: bỏ qua trade live đã có trong lịch sử (T < mốc, và skip_at_cutoff trade đầu tiên có T = mốc)
+        self.skip_until_ms = -1; self.skip_at_cutoff = 0
+        self.set_price_grouping(price_grouping)
+
+    def set_price_grouping(self, price_grouping):
+        """Cập nhật price grouping; nến đang mở được gộp lại theo giá trị mới."""
+        for tf in self.timeframes_ms:
+            group_val = price_grouping.get(tf, self.price_grouping.get(tf, 10))
+            if group_val <= 0: group_val = 1
+            if self.price_grouping.get(tf) != group_val:
+                self.price_grouping[tf] = group_val
+                candle = self.current.get(tf)
+                if candle is not None:
+                    candle.regroup(group_val)
+                    self.dirty.add(tf)
+
+    def add_trade(self, ts_ms, price, qty, is_buyer_maker):
+        """Cập nhật TẤT CẢ khung thời gian bằng 1 trade. Trả về list tf vừa đóng nến."""
+        if ts_ms <= self.skip_until_ms:
+            if ts_ms < self.skip_until_ms: return []
+            if self.skip_at_cutoff > 0: self.skip_at_cutoff -= 1; return []
+        closed = []
+        current = self.current
+        for tf, tf_ms in self._tf_items:
+            candle = current.get(tf)
+            if candle is None or ts_ms >= candle.end_ms:
+                if candle is not None:
+                    finished = candle.to_dict()
+                    self.recent_candles[tf].append(finished)
+                    self.closed_since_flush.setdefault(tf, []).append(finished)
+                    closed.append(tf)
+                candle = _OpenCandle(ts_ms - ts_ms % tf_ms, tf_ms, self.last_close.get(tf, price), price, self.price_grouping[tf])
+                current[tf] = candle
+            candle.add(price, qty, is_buyer_maker)
+            self.last_close[tf] = price
+        self.dirty.update(self.timeframes_ms)
+        return closed
+
+    def history_start_ms(self, last_ts_ms):
+        """Mốc thời gian sớm nhất cần đọc để dựng history_limit nến (+ nến đang mở) cho mọi khung thời gian."""
+        return min(last_ts_ms - last_ts_ms % tf_ms - self.history_limit * tf_ms for tf_ms in self.timeframes_ms.values())
+
+    def load_history(self, ts, prices, qtys, is_buyer_maker):
+        """Dựng lại nến của mọi khung thời gian từ trade lịch sử (mảng NumPy đã sắp theo thời gian) bằng NumPy:
+        gộp theo (mốc nến, ô giá) thay vì gọi add_trade cho từng trade. Kết quả giống hệt khi chạy add_trade lần lượt.
+        Nến cuối cùng thành nến đang mở; trade live sau đó có T <= trade cuối của lịch sử sẽ bị bỏ qua (không đếm 2 lần).
+        Gọi khi engine chưa nhận trade live nào. Trả về số nến đã dựng."""
+        ts = np.asarray(ts, dtype=np.int64)
+        if not len(ts): return 0
+        prices = np.asarray(prices, dtype=np.float64); qtys = np.asarray(qtys, dtype=np.float64)
+        is_buyer_maker = np.asarray(is_buyer_maker, dtype=bool)
+        n_candles = 0
+        for tf, tf_ms in self._tf_items:
+            starts = ts - ts % tf_ms
+            i0 = int(np.searchsorted(starts, int(starts[-1]) - self.history_limit * tf_ms))
+            open_before = float(prices[i0 - 1]) if i0 > 0 else None # Open = close nến trước (như add_trade)
+            n_candles += self._load_tf_history(tf, tf_ms, starts[i0:], prices[i0:], qtys[i0:], is_buyer_maker[i0:], open_before)
+            self.dirty.add(tf)
+        self.skip_until_ms = int(ts[-1]); self.skip_at_cutoff = int(len(ts) - np.searchsorted(ts, ts[-1]))
+        return n_candles
+
+    def _load_tf_history(self, tf, tf_ms, starts, prices, qtys, is_buyer_maker, open_before):
+        group = self.price_grouping[tf]
+        n = len(starts)
+        first = np.flatnonzero(np.r_[True, starts[1:] != starts[:-1]]) # Trade đầu tiên của từng nến
+        last = np.r_[first[1:], n] - 1
+        candle_id = np.repeat(np.arange(len(first)), last - first + 1)
+        high = np.maximum.reduceat(prices, first); low = np.minimum.reduceat(prices, first)
+        close = prices[last]
+        opens = np.r_[prices[0] if open_before is None else open_before, close[:-1]]
+        volume = np.bincount(candle_id, weights=qtys) # bincount cộng tuần tự -> khớp từng bit với add_trade
+        # Level: gộp theo (nến, ô giá); khóa tăng dần = nến tăng dần rồi ô giá tăng dần
+        buckets = np.trunc(prices / group).astype(np.int64)
+        low_bucket = int(buckets.min()); span = int(buckets.max()) - low_bucket + 1
+        keys, inverse = np.unique(candle_id * span + (buckets - low_bucket), return_inverse=True)
+        bid = np.bincount(inverse, weights=np.where(is_buyer_maker, qtys, 0.0), minlength=len(keys))
+        ask = np.bincount(inverse, weights=np.where(is_buyer_maker, 0.0, qtys), minlength=len(keys))
+        level_bounds = np.searchsorted(keys // span, np.arange(len(first) + 1)).tolist()
+        level_index = (keys % span + low_bucket).tolist(); bid = bid.tolist(); ask = ask.tolist()
+        start_list = starts[first].tolist(); open_list = opens.tolist(); high_list = high.tolist(); low_list = low.tolist()
+        close_list = close.tolist(); volume_list = volume.tolist()
+        history = self.recent_candles[tf]; history.clear()
+        for c in range(len(first) - 1):
+            lo, hi = level_bounds[c], level_bounds[c + 1]
+            history.append({
+                "timestamp": start_list[c],
+                "time": candle_time_label(start_list[c]),
+                "open": open_list[c], "high": high_list[c], "low": low_list[c], "close": close_list[c],
+                "totalVolume": round(volume_list[c], 4),
+                "levels": [[level_index[i] * group, round(bid[i], 4), round(ask[i], 4)] for i in range(hi - 1, lo - 1, -1)],
+            })
+        c = len(first) - 1; lo, hi = level_bounds[c], level_bounds[c + 1]
+        candle = _OpenCandle(start_list[c], tf_ms, open_list[c], float(prices[first[c]]), group)
+        candle.high = high_list[c]; candle.low = low_list[c]; candle.close = close_list[c]; candle.total_volume = volume_list[c]
+        candle.load_levels(level_index[lo:hi], bid[lo:hi], ask[lo:hi])
+        self.current[tf] = candle; self.last_close[tf] = close_list[c]
+        return len(first)
+
+    def take_updates(self, with_full=True, with_delta=False):
+        """Lấy (và xóa) các thay đổi từ lần flush trước.
+        Trả về (nến đầy đủ của các tf bị thay đổi, delta của các tf đó, các nến đã đóng trong khoảng đó).
+        Chỉ dựng phần được yêu cầu (with_full / with_delta)."""
+        if not self.dirty and not self.closed_since_flush:
+            return {}, {}, {}
+        dirty_tfs = [tf for tf in self.timeframes_ms if tf in self.dirty and tf in self.current]
+        updates = {tf: self.current[tf].to_dict() for tf in dirty_tfs} if with_full else {}
+        deltas = {}
+        for tf in dirty_tfs:
+            candle = self.current[tf]
+            if with_delta: deltas[tf] = candle.take_delta()
+            else: candle.changed = set(); candle.full_dirty = False # Không ai cần delta: chỉ reset
+        closed = self.closed_since_flush
+        self.dirty = set(); self.closed_since_flush = {}
+        return updates, deltas, closed
+
+    def current_candle(self, tf):
+        """Nến đang mở của tf (đã định dạng) hoặc None."""
+        candle = self.current.get(tf)
+        return candle.to_dict() if candle is not None else None
+
+    def full_history(self, tf):
+        """Lịch sử nến đã đóng + nến đang mở (dùng cho 'full_data')."""
+        data = list(self.recent_candles.get(tf, ()))
+        candle = self.current.get(tf)
+        if candle is not None: data.append(candle.to_dict())
+        return data
@@ -4,14 +4,17 @@ import asyncio
 import websockets
 import json
 from binance import AsyncClient, BinanceSocketManager
-import pandas as pd
 from datetime import datetime, timedelta, timezone
 import os
-import aiohttp
 import signal
 import requests  
 import numpy as np 
 
+from binary_frames import encode_message, json_default
+from trade_archive import TradeArchive, LEGACY_TRADE_FILE, trades_to_records
+from aggtrades_backfill import AggTradesBackfill
+from depth_sync import OrderBookSync, DEPTH_SNAPSHOT_LIMIT, BOOK_SNAPSHOT_INTERVAL_S
+
 # ==============================================================================
 # ================== CONFIG GỘP CHUNG (ĐẠI CA CHỈNH Ở ĐÂY) =====================
 # ==============================================================================
@@ -19,10 +22,13 @@ CONFIG = {
     # --- Cài đặt chung ---
     'symbol': 'BTCUSDT',
     'days_of_history': 1,  # Số ngày lịch sử trade để tải về
+    'backfill_concurrency': 8, # Số shard (khoảng id) tải lịch sử song song, chung 1 ngân sách weight
     
     # --- Cài đặt lưu file (chỉ áp dụng cho trades) ---
-    'parquet_file': 'btcusdt_aggtrades.parquet',
+    'archive_dir': 'aggtrades_archive', # Kho Parquet phân vùng theo giờ/ngày + manifest (xem trade_archive.py)
+    'parquet_file': LEGACY_TRADE_FILE, # File cũ (1 file append); nếu còn sẽ được chuyển vào kho 1 lần
     'save_interval_seconds': 10, # Cứ 10 giây lưu buffer trade xuống file
+    'compact_interval_seconds': 600, # Gộp các giờ/ngày đã đóng thành file lớn
     
     # --- Cài đặt máy chủ Websocket (để bắn data ra) ---
     'server_host': 'localhost',
@@ -31,6 +37,8 @@ CONFIG = {
     # --- Cài đặt tính toán thanh khoản (LIQUIDITY) ---
     'liquidity_settings': {
         'enabled': True,
+        'depth_snapshot_limit': DEPTH_SNAPSHOT_LIMIT, # Số mức mỗi bên khi lấy snapshot REST để dựng sổ đầy đủ
+        'book_snapshot_interval_seconds': BOOK_SNAPSHOT_INTERVAL_S, # Chu kỳ gửi snapshot cả sổ cho backend
         # <<< GHI CHÚ: TÍNH NĂNG GỘP (zone_width_ticks) ĐÃ BỊ TẮT Ở FILE NÀY >>>
         # Việc gộp sẽ do app.py (giao diện) tự xử lý
     },
@@ -45,8 +53,11 @@ CONFIG = {
 
 # --- Các biến toàn cục ---
 connected_clients = set()
+binary_clients = set() # Client đã chọn frame nhị phân (set_protocol: frames=binary)
 last_100_trades = []
 trade_buffer = []
+trade_archive = TradeArchive(CONFIG['archive_dir'])
+depth_sync = None # OrderBookSync: sổ lệnh đầy đủ (snapshot + diff), tạo trong main khi đã có AsyncClient
 # <<<< GHI CHÚ: Không cần 'symbol_info' nữa vì không gộp ở đây >>>>
 
 # --- Hàm ghi log ---
@@ -68,12 +79,7 @@ def save_buffer_on_exit():
     
     print_log(f"Đang ghi nốt {len(trade_buffer)} giao dịch cuối cùng... (Vui lòng không tắt ngang)")
     try:
-        df_to_save = pd.DataFrame(trade_buffer)
-        df_to_save['p'] = pd.to_numeric(df_to_save['p'])
-        df_to_save['q'] = pd.to_numeric(df_to_save['q'])
-        
-        file_exists_and_has_data = os.path.exists(CONFIG['parquet_file']) and os.path.getsize(CONFIG['parquet_file']) > 0
-        df_to_save.to_parquet(CONFIG['parquet_file'], engine='fastparquet', append=file_exists_and_has_data)
+        trade_archive.append(trade_buffer)
         print_log("Ghi nốt thành công. Tạm biệt Đại ca!")
         trade_buffer.clear()
     except Exception as e:
@@ -81,106 +87,97 @@ def save_buffer_on_exit():
     finally:
         signal.signal(signal.SIGINT, original_sigint_handler)
 
-# --- Hàm lấy lịch sử trades (Không đổi) ---
-async def get_historical_trades(symbol, start_time_ms, end_time_ms):
-    all_trades = []
-    from_id = -1
-    url = "https://api.binance.com/api/v3/aggTrades"
-    print_log(f"Bắt đầu hút lịch sử từ {datetime.fromtimestamp(start_time_ms/1000)} đến {datetime.fromtimestamp(end_time_ms/1000)}")
-    async with aiohttp.ClientSession() as session:
-        while True:
-            params = {'symbol': symbol, 'limit': 1000}
-            if from_id == -1: params['startTime'] = int(start_time_ms); params['endTime'] = int(end_time_ms)
-            else: params['fromId'] = from_id
-            try:
-                async with session.get(url, params=params) as response:
-                    if response.status == 200:
-                        trades = await response.json()
-                        if not trades or (from_id != -1 and trades[-1]['T'] > end_time_ms):
-                            if trades: valid_trades = [t for t in trades if t['T'] <= end_time_ms]; all_trades.extend(valid_trades)
-                            break
-                        all_trades.extend(trades); from_id = trades[-1]['a'] + 1
-                        if not CONFIG['silent_mode']: print(f"\rĐang hút dữ liệu... Đã lấy được {len(all_trades)} giao dịch.", end="")
-                        await asyncio.sleep(0.1)
-                    elif response.status == 429: print("\nBị giới hạn tốc độ. Chờ 1 phút..."); await asyncio.sleep(60)
-                    else: print(f"\nLỗi khi lấy dữ liệu: {response.status} - {await response.text()}"); break
-            except Exception as e: print(f"\nLỗi kết nối: {e}. Thử lại sau 10 giây..."); await asyncio.sleep(10)
-    if not CONFIG['silent_mode']: print()
-    print_log(f"Hút xong. Tổng cộng {len(all_trades)} giao dịch.")
-    return all_trades
-
-# --- Quản lý file lịch sử (Không đổi) ---
+# --- Quản lý kho lịch sử: chỉ đọc manifest (không đọc dữ liệu) để biết đã có tới đâu ---
 async def manage_history():
     print_log("Kiểm tra dữ liệu lịch sử...")
+    try:
+        if os.path.exists(CONFIG['parquet_file']) and not trade_archive.exists():
+            print_log(f"Chuyển file cũ {CONFIG['parquet_file']} vào kho {CONFIG['archive_dir']} (chỉ 1 lần)...")
+            print_log(f"Đã chuyển {trade_archive.import_legacy_file(CONFIG['parquet_file'])} giao dịch.")
+        removed = trade_archive.remove_orphans()
+        if removed: print_log(f"Đã xóa {removed} file dở dang không có trong manifest.")
+    except Exception as e: print_log(f"Lỗi khi chuẩn bị kho lịch sử: {e}")
     end_date = datetime.now(timezone.utc)
     start_date = end_date - timedelta(days=CONFIG['days_of_history'])
-    df = None
-    if os.path.exists(CONFIG['parquet_file']):
-        try:
-            df = pd.read_parquet(CONFIG['parquet_file'])
-            if not df.empty:
-                last_timestamp_ms = df['T'].max()
-                start_date = datetime.fromtimestamp(last_timestamp_ms / 1000, tz=timezone.utc)
-                print_log(f"Đã có file. Lấy dữ liệu mới từ: {start_date}.")
-        except Exception as e: print_log(f"Lỗi đọc file parquet: {e}. Sẽ tải lại toàn bộ."); df = None
-    if df is None or df.empty: print_log(f"Chưa có dữ liệu. Bắt đầu tải lịch sử {CONFIG['days_of_history']} ngày.")
-    start_ms = int(start_date.timestamp() * 1000); end_ms = int(end_date.timestamp() * 1000)
-    if end_ms > start_ms + 60000:
-        trades = await get_historical_trades(CONFIG['symbol'], start_ms, end_ms)
-        if trades:
-            new_df = pd.DataFrame(trades); new_df = new_df[['T', 'p', 'q', 'm']]
-            new_df['p'] = pd.to_numeric(new_df['p']); new_df['q'] = pd.to_numeric(new_df['q'])
-            print_log(f"Ghi {len(new_df)} giao dịch mới vào file {CONFIG['parquet_file']}...")
-            new_df.to_parquet(CONFIG['parquet_file'], engine='fastparquet', append=(df is not None and not df.empty))
+    last_timestamp_ms = trade_archive.last_time()
+    if last_timestamp_ms is not None:
+        print_log(f"Đã có kho ({trade_archive.manifest['rows']} giao dịch). Lấy dữ liệu mới từ: {datetime.fromtimestamp(last_timestamp_ms / 1000, tz=timezone.utc)}.")
+    else: print_log(f"Chưa có dữ liệu. Bắt đầu tải lịch sử {CONFIG['days_of_history']} ngày.")
+    # Tải theo khoảng aggTrade id (nối tiếp id cuối trong manifest / làm nốt lần tải dở), ghi thẳng vào kho
+    backfill = AggTradesBackfill(CONFIG['symbol'], trade_archive, concurrency=CONFIG['backfill_concurrency'], log=print_log)
+    try: await backfill.run(int(start_date.timestamp() * 1000), int(end_date.timestamp() * 1000))
+    except Exception as e: print_log(f"Lỗi khi tải lịch sử trade: {e}. Phần đã tải được giữ lại, lần sau sẽ tải tiếp.")
     print_log("Kiểm tra lịch sử hoàn tất.")
 
 # --- Hàm broadcast (chung cho cả trades và liquidity) ---
 async def broadcast(message):
+    """message: dict. Mã hóa 1 lần cho mỗi định dạng (JSON / nhị phân) đang có client dùng."""
     if connected_clients:
-        tasks = [client.send(message) for client in connected_clients]
+        tasks = []
+        json_clients = [c for c in connected_clients if c not in binary_clients]
+        if json_clients:
+            text = json.dumps(message, default=json_default) # book_snapshot chứa ndarray
+            tasks += [client.send(text) for client in json_clients]
+        if binary_clients:
+            frame = encode_message(message) # Giá/khối lượng đóng gói thành float64 ngay tại đây
+            tasks += [client.send(frame) for client in binary_clients]
         await asyncio.gather(*tasks)
 
 # --- Xử lý 1 trade MỚI (Không đổi) ---
 async def handle_new_trade(msg):
     if msg and msg.get('e') == 'aggTrade':
         trade_data = {'T': msg['T'], 'p': msg['p'], 'q': msg['q'], 'm': msg['m']}
-        await broadcast(json.dumps({"type": "trade", "data": trade_data}))
-        trade_buffer.append(trade_data)
+        # Ghi nhận TRƯỚC khi broadcast: client đăng ký giữa chừng nhận trade này đúng 1 lần (trong 'history' hoặc live)
+        trade_buffer.append({'a': msg['a'], **trade_data}) # Kho lưu cả aggTrade id (để bỏ trùng / nối tiếp)
         last_100_trades.append(trade_data)
         if len(last_100_trades) > 100: last_100_trades.pop(0)
+        await broadcast({"type": "trade", "data": trade_data})
 
-# --- Xử lý sổ lệnh (depth) MỚI (ĐÃ SỬA) ---
+def history_trades():
+    """Trade gửi kèm khi client kết nối: 100 trade cuối, hoặc mọi trade chưa ghi vào kho nếu nhiều hơn
+    (backend dùng để nối nến dựng từ kho với trade live)."""
+    if len(trade_buffer) > len(last_100_trades):
+        return [{'T': t['T'], 'p': t['p'], 'q': t['q'], 'm': t['m']} for t in trade_buffer]
+    return list(last_100_trades)
+
+# --- Xử lý sổ lệnh (depth): đưa vào sổ đầy đủ (depth_sync.py) ---
 async def handle_new_depth(msg):
     config = CONFIG.get('liquidity_settings', {})
     if not config.get('enabled', True):
         return
         
     if msg and msg.get('e') == 'depthUpdate':
-        # <<<< THAY ĐỔI: Không gộp, không tính toán gì cả >>>>
-        # Chỉ lấy sổ lệnh thô (bids/asks) và gửi thẳng
-        bids = msg.get('b', [])
-        asks = msg.get('a', [])
-        
-        # Gửi dữ liệu thô
-        liquidity_data = {
-            "type": "liquidity_raw", # <<<< Đổi tên type
-            "timestamp": msg.get('E'), # Event time
-            "bids": bids, # Gửi thô
-            "asks": asks  # Gửi thô
-        }
-        await broadcast(json.dumps(liquidity_data))
+        # Không gộp, không tính toán: diff thô (bids/asks) chỉ được gửi đi ('liquidity_raw' + prev_update_id / update_id)
+        # khi nối tiếp đúng sổ; hở thì depth_sync tự lấy snapshot REST và gửi 'book_snapshot'
+        await depth_sync.on_event(msg)
+
+async def fetch_depth_snapshot(client: AsyncClient):
+    return await client.get_order_book(symbol=CONFIG['symbol'], limit=CONFIG['liquidity_settings']['depth_snapshot_limit'])
 
 # --- Đăng ký client (giao diện) (Không đổi) ---
 async def register_client(websocket):
     if not CONFIG['silent_mode']: print_log(f"Giao diện đã kết nối. Tổng số: {len(connected_clients)+1}")
-    connected_clients.add(websocket)
     try:
-        if last_100_trades:
-            initial_data = {"type": "history", "data": last_100_trades}
+        # Snapshot sổ lệnh gửi trước mọi delta cho client này (giữ lock để không xen delta vào giữa).
+        # Lấy 'history' và đăng ký nhận broadcast liền nhau (không await xen giữa): không thiếu, không trùng trade
+        if depth_sync is not None:
+            async with depth_sync.lock:
+                if depth_sync.book.synced: await websocket.send(json.dumps(depth_sync.book.snapshot_message(), default=json_default))
+                history = history_trades(); connected_clients.add(websocket)
+        else: history = history_trades(); connected_clients.add(websocket)
+        if history:
+            initial_data = {"type": "history", "data": history}
             await websocket.send(json.dumps(initial_data))
-        await websocket.wait_closed()
+        async for message in websocket:
+            try:
+                data = json.loads(message)
+                if isinstance(data, dict) and data.get('type') == 'set_protocol':
+                    if data.get('frames') == 'binary': binary_clients.add(websocket)
+                    elif data.get('frames') == 'json': binary_clients.discard(websocket)
+            except (json.JSONDecodeError, TypeError): pass
     finally:
-        connected_clients.remove(websocket)
+        connected_clients.discard(websocket)
+        binary_clients.discard(websocket)
         if not CONFIG['silent_mode']: print_log(f"Giao diện đã ngắt kết nối. Còn lại: {len(connected_clients)}")
 
 # --- Task: Khởi động stream AGGTRADES (Không đổi) ---
@@ -206,47 +203,61 @@ async def start_depth_stream(client: AsyncClient):
                 await handle_new_depth(res.get('data', {}))
             except Exception as e: print_log(f"Lỗi từ stream SỔ LỆNH: {e}. Đang cố gắng kết nối lại..."); await asyncio.sleep(5)
 
-# --- Task: Lưu buffer định kỳ (cho trades) (Không đổi) ---
+# --- Task: Lưu buffer định kỳ (cho trades) + gộp định kỳ các giờ/ngày đã đóng ---
 async def save_buffer_periodically():
+    loop = asyncio.get_running_loop()
+    compact_task = None; last_compact = 0.0
     while True:
         await asyncio.sleep(CONFIG['save_interval_seconds'])
         if trade_buffer:
             trades_to_save = trade_buffer.copy(); trade_buffer.clear()
             try:
-                if not CONFIG['silent_mode']: print_log(f"Chuẩn bị ghi {len(trades_to_save)} giao dịch từ buffer vào file...")
-                df_to_save = pd.DataFrame(trades_to_save)
-                df_to_save['p'] = pd.to_numeric(df_to_save['p']); df_to_save['q'] = pd.to_numeric(df_to_save['q'])
-                df_to_save.to_parquet(CONFIG['parquet_file'], engine='fastparquet', append=True)
+                if not CONFIG['silent_mode']: print_log(f"Chuẩn bị ghi {len(trades_to_save)} giao dịch từ buffer vào kho...")
+                trade_archive.append(trades_to_save)
                 if not CONFIG['silent_mode']: print_log(f"Ghi thành công!")
-            except Exception as e: print_log(f"!!! Lỗi nghiêm trọng khi ghi buffer vào file: {e}")
+            except Exception as e: print_log(f"!!! Lỗi nghiêm trọng khi ghi buffer vào kho: {e}")
+        # Gộp chạy trên executor (đọc/ghi file lớn) để không chặn stream; append vẫn chạy song song được
+        if (compact_task is None or compact_task.done()) and loop.time() - last_compact >= CONFIG['compact_interval_seconds']:
+            last_compact = loop.time()
+            compact_task = loop.run_in_executor(None, compact_archive)
+
+def compact_archive():
+    try:
+        result = trade_archive.compact()
+        if result['written_files'] and not CONFIG['silent_mode']:
+            print_log(f"Gộp kho: {len(result['written_files'])} file mới, xóa {result['removed_files']} file nhỏ.")
+    except Exception as e: print_log(f"Lỗi khi gộp kho lịch sử trade: {e}")
 
 # --- Hàm MAIN (Tổng hành dinh) (Đã sửa) ---
 async def main():
     # <<<< BƯỚC 1: Tải lịch sử trades (Không cần lấy tick_size nữa) >>>>
     await manage_history()
     try:
-        df = pd.read_parquet(CONFIG['parquet_file'])
-        if not df.empty:
-            df = df.sort_values(by='T', ascending=False).head(100)
+        # Chỉ đọc row group cuối của file mới nhất trong manifest (thời gian không đổi dù kho lớn cỡ nào)
+        if trade_archive.last_time() is not None:
+            recent, _ = trade_archive.read_last(100)
             global last_100_trades
-            last_100_trades = df.to_dict('records'); last_100_trades.reverse()
+            last_100_trades = trades_to_records(recent)
             print_log(f"Đã tải {len(last_100_trades)} giao dịch cuối cùng để khởi tạo.")
     except Exception as e: print_log(f"Không tải được dữ liệu khởi tạo từ file: {e}")
 
     # BƯỚC 2: Khởi động các dịch vụ
     binance_client = await AsyncClient.create()
+    global depth_sync
+    depth_sync = OrderBookSync(lambda: fetch_depth_snapshot(binance_client), broadcast, log=print_log)
     try:
         server_task = websockets.serve(register_client, CONFIG['server_host'], CONFIG['server_port'])
         trade_stream_task = start_trade_stream(binance_client)
         depth_stream_task = start_depth_stream(binance_client)
         saver_task = save_buffer_periodically()
+        book_snapshot_task = depth_sync.publish_snapshots(CONFIG['liquidity_settings']['book_snapshot_interval_seconds'])
         
         print_log("="*50)
-        print_log("HỆ THỐNG ĐÃ ONLINE (Gửi Trades + Raw Liquidity)")
+        print_log("HỆ THỐNG ĐÃ ONLINE (Gửi Trades + Sổ lệnh: snapshot + delta)")
         print_log(f"Đang bắn data tới: ws://{CONFIG['server_host']}:{CONFIG['server_port']}")
         print_log("="*50)
 
-        await asyncio.gather(server_task, trade_stream_task, depth_stream_task, saver_task)
+        await asyncio.gather(server_task, trade_stream_task, depth_stream_task, saver_task, book_snapshot_task)
     finally:
         print_log("Đang đóng kết nối tới Binance..."); await binance_client.close_connection(); save_buffer_on_exit()
 
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# FILE: depth_sync.py
+# Sổ lệnh ĐẦY ĐỦ phía collector theo quy trình của Binance: snapshot REST + diff depth có đánh số.
+# - Chưa đồng bộ: giữ các event depthUpdate trong buffer, lấy snapshot (lastUpdateId), bỏ event có
+#   u <= lastUpdateId; event đầu tiên còn lại phải thỏa U <= lastUpdateId + 1 <= u.
+# - Đã đồng bộ: mỗi event phải nối tiếp sổ (U <= update_id + 1 <= u). Hở (mất event, stream kết nối lại)
+#   -> tự đồng bộ lại bằng snapshot mới.
+# - Gửi đi: 'book_snapshot' (cả sổ; ngay sau khi đồng bộ + định kỳ) và 'liquidity_raw' kèm
+#   prev_update_id / update_id để bên nhận kiểm tra tính liên tục và vào giữa luồng chỉ bằng 1 snapshot.
+#   Các event đã buffer trong lúc đồng bộ lại được gửi (không đánh số) ngay trước snapshot, để heatmap
+#   không bị trống khoảng đó; bên nhận không áp dụng chúng vào sổ (snapshot theo sau đã chứa).
+# DepthBook không làm I/O nên dùng chung cho collector (sổ gốc) và backend (bản sao dựng từ message).
+
+import time
+import asyncio
+from collections import deque
+
+import numpy as np
+
+DEPTH_SNAPSHOT_LIMIT = 5000 # Số mức mỗi bên của snapshot REST /api/v3/depth (tối đa của sàn)
+BOOK_SNAPSHOT_INTERVAL_S = 10.0 # Chu kỳ gửi snapshot cả sổ cho bên nhận
+MAX_BUFFERED_EVENTS = 10_000 # Số event giữ tối đa trong lúc chờ snapshot (event cũ nhất bị bỏ)
+RESYNC_DELAY_S = 1.0 # Chờ trước khi lấy lại snapshot khi lỗi REST / snapshot cũ hơn buffer (buffer hở thì lấy lại ngay)
+
+
+def _apply_levels(book, levels):
+    """levels: cặp [giá, khối lượng] (chuỗi của sàn hoặc ndarray (n, 2)). Khối lượng 0 = xóa mức."""
+    if isinstance(levels, np.ndarray): levels = levels.tolist()
+    for p, q in levels:
+        price = float(p); qty = float(q)
+        if qty == 0: book.pop(price, None)
+        else: book[price] = qty
+
+
+def _levels_dict(levels):
+    """Cả 1 bên của snapshot -> {giá: khối lượng}; ndarray (frame nhị phân) dựng thẳng, không lặp từng mức."""
+    if isinstance(levels, np.ndarray):
+        levels = levels.reshape(-1, 2); levels = levels[levels[:, 1] > 0]
+        return dict(zip(levels[:, 0].tolist(), levels[:, 1].tolist()))
+    book = {}; _apply_levels(book, levels)
+    return book
+
+
+def _side_array(book, descending):
+    """{giá: khối lượng} -> ndarray float64 (n, 2) sắp theo giá."""
+    n = len(book)
+    levels = np.empty((n, 2), dtype=np.float64)
+    if n:
+        levels[:, 0] = np.fromiter(book.keys(), dtype=np.float64, count=n)
+        levels[:, 1] = np.fromiter(book.values(), dtype=np.float64, count=n)
+        order = np.argsort(levels[:, 0])
+        levels = levels[order[::-1] if descending else order]
+    return levels
+
+
+class DepthBook:
+    """Sổ lệnh 2 bên (giá -> khối lượng) + update_id của diff cuối đã áp dụng (None = chưa đồng bộ)."""
+
+    def __init__(self):
+        self.bids = {}; self.asks = {}
+        self.update_id = None
+        self.event_time = None # Thời điểm (ms) của event / snapshot cuối
+
+    @property
+    def synced(self): return self.update_id is not None
+
+    def reset(self):
+        self.bids = {}; self.asks = {}; self.update_id = None
+
+    def load_snapshot(self, update_id, bids, asks, event_time=None):
+        """Thay cả sổ bằng snapshot (REST depth hoặc message 'book_snapshot')."""
+        self.bids = _levels_dict(bids); self.asks = _levels_dict(asks)
+        self.update_id = int(update_id)
+        self.event_time = event_time if event_time is not None else int(time.time() * 1000)
+
+    def apply_diff(self, first_id, last_id, bids, asks, event_time=None):
+        """Áp dụng 1 diff gồm các update [first_id, last_id]. Trả về 'applied', 'stale' (đã có trong sổ)
+        hoặc 'gap' (thiếu update ở giữa, sổ không đổi -> phải đồng bộ lại)."""
+        if self.update_id is None: return 'gap'
+        if last_id <= self.update_id: return 'stale'
+        if first_id > self.update_id + 1: return 'gap'
+        _apply_levels(self.bids, bids); _apply_levels(self.asks, asks)
+        self.update_id = int(last_id)
+        if event_time is not None: self.event_time = event_time
+        return 'applied'
+
+    def apply_event(self, event):
+        """1 event depthUpdate của sàn (U, u, b, a, E)."""
+        return self.apply_diff(int(event['U']), int(event['u']), event.get('b', ()), event.get('a', ()), event.get('E'))
+
+    def apply_delta_message(self, message):
+        """1 message 'liquidity_raw' có đánh số: chỉ nhận nếu prev_update_id khớp sổ hiện tại.
+        'gap' thì sổ được xóa, chờ 'book_snapshot' kế tiếp. Message không đánh số (event phát lại khi
+        collector đồng bộ lại) bị bỏ qua như 'stale'."""
+        update_id = message.get('update_id')
+        if update_id is None: return 'stale'
+        if self.update_id is not None and update_id <= self.update_id: return 'stale'
+        if self.update_id is None or message.get('prev_update_id') != self.update_id:
+            self.reset(); return 'gap'
+        return self.apply_diff(self.update_id + 1, int(update_id), message.get('bids', ()), message.get('asks', ()), message.get('timestamp'))
+
+    def snapshot_message(self):
+        """Message 'book_snapshot': bids giá giảm dần, asks giá tăng dần (ndarray (n, 2), frame nhị phân gửi thẳng)."""
+        return {"type": "book_snapshot", "timestamp": self.event_time, "update_id": self.update_id,
+                "bids": _side_array(self.bids, True), "asks": _side_array(self.asks, False)}
+
+
+class OrderBookSync:
+    """Giữ DepthBook của collector khớp với sàn.
+    fetch_snapshot: coroutine function -> dict REST depth {'lastUpdateId', 'bids', 'asks'};
+    publish: coroutine function nhận 1 message để gửi cho bên nhận.
+    lock giữ thứ tự: snapshot và các delta sau nó được gửi đúng thứ tự sổ đã áp dụng."""
+
+    def __init__(self, fetch_snapshot, publish, log=print, max_buffered=MAX_BUFFERED_EVENTS):
+        self.book = DepthBook()
+        self.fetch_snapshot = fetch_snapshot; self.publish = publish; self.log = log
+        self.buffer = deque(maxlen=max_buffered)
+        self.lock = asyncio.Lock()
+        self._resync_task = None
+        self.stats = {'events': 0, 'applied': 0, 'stale': 0, 'gaps': 0, 'snapshots': 0}
+
+    async def on_event(self, event):
+        """1 event depthUpdate từ websocket của sàn."""
+        self.stats['events'] += 1
+        async with self.lock:
+            if not self.book.synced:
+                self.buffer.append(event); self._start_resync(); return
+            prev_id = self.book.update_id
+            status = self.book.apply_event(event)
+            if status == 'applied':
+                self.stats['applied'] += 1
+                await self.publish({"type": "liquidity_raw", "timestamp": event.get('E'), "prev_update_id": prev_id,
+                                    "update_id": self.book.update_id, "bids": event.get('b', []), "asks": event.get('a', [])})
+            elif status == 'stale': self.stats['stale'] += 1
+            else:
+                self.stats['gaps'] += 1
+                self.log(f"Sổ lệnh bị hở (update_id {prev_id} -> U={event['U']}). Đang đồng bộ lại bằng snapshot...")
+                self.book.reset(); self.buffer.clear(); self.buffer.append(event)
+                self._start_resync()
+
+    def _start_resync(self):
+        if self._resync_task is None or self._resync_task.done():
+            self._resync_task = asyncio.create_task(self._resync())
+
+    async def _resync(self):
+        while True:
+            try:
+                snapshot = await self.fetch_snapshot()
+            except Exception as e:
+                self.log(f"Lỗi khi lấy snapshot sổ lệnh: {e}. Thử lại sau {RESYNC_DELAY_S:.0f} giây...")
+                await asyncio.sleep(RESYNC_DELAY_S); continue
+            async with self.lock:
+                buffered = list(self.buffer)
+                status = self._replay(snapshot)
+                if status == 'synced':
+                    self.stats['snapshots'] += 1
+                    # Event buffer chưa từng được gửi: gửi không đánh số (cho heatmap), rồi snapshot (cho sổ)
+                    for event in buffered:
+                        await self.publish({"type": "liquidity_raw", "timestamp": event.get('E'),
+                                            "bids": event.get('b', []), "asks": event.get('a', [])})
+                    await self.publish(self.book.snapshot_message())
+                    return
+            if status == 'old': await asyncio.sleep(RESYNC_DELAY_S)
+
+    def _replay(self, snapshot):
+        """Nạp snapshot + áp dụng các event đã buffer sau nó. Trả về 'synced', 'old' (snapshot cũ hơn
+        event đầu trong buffer) hoặc 'gap' (buffer cũng bị hở) -> phải lấy snapshot khác."""
+        last_id = int(snapshot['lastUpdateId'])
+        events = [e for e in self.buffer if int(e['u']) > last_id]
+        if events and int(events[0]['U']) > last_id + 1:
+            self.log(f"Snapshot sổ lệnh (lastUpdateId {last_id}) cũ hơn event đầu trong buffer (U={events[0]['U']}). Lấy lại...")
+            return 'old'
+        self.book.load_snapshot(last_id, snapshot['bids'], snapshot['asks'])
+        for i, event in enumerate(events):
+            if self.book.apply_event(event) == 'gap': # Chỉ giữ phần buffer sau chỗ hở
+                self.book.reset(); self.buffer = deque(events[i:], maxlen=self.buffer.maxlen)
+                return 'gap'
+        self.buffer.clear()
+        return 'synced'
+
+    async def publish_snapshots(self, interval_s=BOOK_SNAPSHOT_INTERVAL_S):
+        """Task nền: gửi snapshot cả sổ định kỳ để bên nhận vào giữa luồng / tự sửa sai lệch."""
+        while True:
+            await asyncio.sleep(interval_s)
+            async with self.lock:
+                if self.book.synced: await self.publish(self.book.snapshot_message())
@@ -7,10 +7,15 @@ import sys
 import json
 import os
 import importlib.util
-from collections import deque, defaultdict
+from collections import deque, defaultdict, OrderedDict
+from itertools import chain
 from datetime import datetime, timezone 
 import inspect
 import math
+import threading
+import time
+
+import numpy as np
 
 # --- Imports từ PySide6 (app.py) ---
 from PySide6.QtWidgets import (
@@ -20,13 +25,16 @@ from PySide6.QtWidgets import (
     QMenuBar, QFileDialog, QSizePolicy, QDoubleSpinBox
 )
 from PySide6.QtCore import (
-    Qt, QUrl, QTimer, Slot, QRectF, QSize, Signal, QPoint, QObject, QThread, QPointF
+    Qt, QUrl, QTimer, Slot, QRectF, QRect, QSize, Signal, QPoint, QObject, QThread, QPointF, QByteArray
 )
 from PySide6.QtGui import (
-    QPainter, QColor, QFont, QPen, QBrush, QFontMetrics, QAction
+    QPainter, QColor, QFont, QPen, QBrush, QFontMetrics, QAction, QImage, QPixmap, QRegion, QStaticText, QTransform
 )
 from PySide6.QtWebSockets import QWebSocket
 
+from binary_frames import decode_message, SIDE_CODES
+from order_book import new_live_book, ScaleBuckets
+
 # --- Imports Constants từ backend_processor (Định nghĩa lại các hằng số cần thiết) ---
 SERVER_HOST = "localhost"
 SERVER_PORT = 8766
@@ -46,6 +54,145 @@ HEATMAP_FADE_DURATION_MS = 15 * 60 * 1000 # 15 phút
 HEATMAP_REFRESH_RATE_MS = 50 # 50ms (20 FPS)
 # ---------------------------------------------------------------------------------
 
+HEATMAP_COLUMNS = ('time_bucket', 'price_bucket', 'side', 'total_quantity')
+
+def heatmap_to_columns(data):
+    """Chuẩn hóa dữ liệu heatmap lịch sử về dạng cột NumPy (side: 0 = bid, 1 = ask).
+    data: list điểm dict (JSON) hoặc dict cột (frame nhị phân, giữ nguyên không copy)."""
+    if isinstance(data, dict):
+        return {k: np.asarray(data.get(k, [])) for k in HEATMAP_COLUMNS}
+    return {
+        'time_bucket': np.array([p.get('time_bucket', 0) for p in data], dtype=np.int64),
+        'price_bucket': np.array([p.get('price_bucket', 0) for p in data], dtype=np.float64),
+        'side': np.array([SIDE_CODES.get(p.get('side'), 0) for p in data], dtype=np.uint8),
+        'total_quantity': np.array([p.get('total_quantity', 0) for p in data], dtype=np.float64),
+    }
+
+STATIC_TILE_SIZE = 512 # Cạnh (pixel logic) của 1 ô cache lớp tĩnh của chart
+HEATMAP_RASTER_MAX_COLUMNS = 2048 # Số cột thời gian tối đa của ảnh heatmap lịch sử (ảnh được co giãn khi vẽ)
+
+def rasterize_heatmap(columns, min_ts, col_ms, n_cols, top_price, group_by, n_rows, low_color, high_color, alpha_min, alpha_max):
+    """Gộp heatmap lịch sử (dạng cột) vào lưới thời gian x giá bằng NumPy rồi tô màu.
+    Hàng 0 = top_price (giá giảm dần theo hàng, bước group_by), cột c = [min_ts + c*col_ms, ...).
+    Trả về mảng uint32 (n_rows, n_cols) dạng 0xAARRGGBB (QImage.Format_ARGB32); ô trống trong suốt."""
+    pixels = np.zeros((n_rows, n_cols), dtype=np.uint32)
+    times = np.asarray(columns['time_bucket'], dtype=np.int64)
+    if not len(times) or n_rows <= 0 or n_cols <= 0: return pixels
+    cols = (times - min_ts) // col_ms
+    rows = ((top_price - (np.asarray(columns['price_bucket'], dtype=np.float64) // group_by) * group_by) / group_by).round().astype(np.int64)
+    inside = (cols >= 0) & (cols < n_cols) & (rows >= 0) & (rows < n_rows)
+    if not inside.any(): return pixels
+    grid = np.bincount(rows[inside] * n_cols + cols[inside], weights=np.asarray(columns['total_quantity'], dtype=np.float64)[inside], minlength=n_rows * n_cols)
+    filled = grid > 0
+    # Chuẩn hóa theo phân vị 99 để vài bức tường cực lớn không làm nhạt toàn bộ ảnh
+    cap = float(np.percentile(grid[filled], 99)) if filled.any() else 1.0
+    level = np.minimum(grid / (cap if cap > 0 else 1.0), 1.0)
+    lo = np.array([low_color.red(), low_color.green(), low_color.blue()], dtype=np.float64)
+    hi = np.array([high_color.red(), high_color.green(), high_color.blue()], dtype=np.float64)
+    rgb = (lo + (hi - lo) * level[:, None]).astype(np.uint32)
+    alpha = ((alpha_min + level * (alpha_max - alpha_min)) * 255).astype(np.uint32) * filled
+    flat = (alpha << 24) | (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+    return flat.reshape(n_rows, n_cols)
+
+# ==============================================================================
+# CACHE CHỮ ĐÃ LAYOUT SẴN (DÙNG CHUNG CHO CÁC WIDGET)
+# ==============================================================================
+TEXT_CACHE_MAX_ENTRIES = 8192 # Số chuỗi (theo font) giữ lại tối đa, vượt thì bỏ chuỗi dùng lâu nhất
+
+class TextCache:
+    """Cache QStaticText theo (chuỗi, font) với LRU: chữ chỉ shape / layout glyph 1 lần,
+    các frame sau vẽ lại bằng drawStaticText. Màu chữ lấy từ pen lúc vẽ nên không cần nằm trong key."""
+    def __init__(self, max_entries=TEXT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # (chuỗi, QFont) -> (QStaticText, rộng, cao)
+
+    def _get(self, text, font):
+        key = (text, font)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key); return entry
+        static = QStaticText(text); static.setTextFormat(Qt.PlainText); static.prepare(QTransform(), font)
+        size = static.size()
+        entry = (static, size.width(), size.height())
+        self._entries[(text, QFont(font))] = entry # Copy font để key không đổi nếu font gốc bị sửa
+        if len(self._entries) > self.max_entries: self._entries.popitem(last=False)
+        return entry
+
+    def draw(self, painter, rect, align, text, font, color):
+        """Giống painter.drawText(rect, align, text) với font / màu cho trước (chỉ 1 dòng, không cắt chữ)."""
+        static, w, h = self._get(text, font)
+        if align & Qt.AlignRight: x = rect.right() - w
+        elif align & Qt.AlignHCenter: x = rect.left() + (rect.width() - w) / 2
+        else: x = rect.left()
+        if align & Qt.AlignVCenter: y = rect.top() + (rect.height() - h) / 2
+        elif align & Qt.AlignBottom: y = rect.bottom() - h
+        else: y = rect.top()
+        painter.setFont(font); painter.setPen(color)
+        painter.drawStaticText(QPointF(x, y), static)
+
+    def clear(self): self._entries.clear()
+
+TEXT_CACHE = TextCache()
+
+def bold_font(font):
+    """Bản in đậm của font (tạo 1 lần mỗi khi đổi cài đặt font, không tạo lại cho từng ô)."""
+    bold = QFont(font); bold.setBold(True); return bold
+
+# ==============================================================================
+# BỘ ĐIỀU PHỐI KHUNG HÌNH (GOM CÁC LẦN VẼ LẠI)
+# ==============================================================================
+DEFAULT_MAX_FPS = 60
+
+class FrameScheduler(QObject):
+    """Gom mọi yêu cầu vẽ lại / đồng bộ pane thành tối đa 1 lượt mỗi khung hình.
+    Nhịp khung hình = min(tần số quét màn hình, max_fps). Các widget đánh dấu bẩn (cả widget hoặc 1 vùng),
+    các tác vụ có tên (vd: đồng bộ trục giá) chỉ giữ lần gọi cuối; tới khung hình thì chạy tác vụ trước
+    rồi update() mỗi widget bẩn đúng 1 lần với vùng gộp."""
+    def __init__(self, max_fps=DEFAULT_MAX_FPS, parent=None):
+        super().__init__(parent)
+        self._timer = QTimer(self); self._timer.setSingleShot(True); self._timer.setTimerType(Qt.PreciseTimer)
+        self._timer.timeout.connect(self._flush)
+        self._tasks = {}; self._dirty = {} # tên -> hàm; widget -> QRegion (None = cả widget)
+        self._last_frame = 0.0; self.frame_interval_ms = 1000.0 / DEFAULT_MAX_FPS
+        self.set_max_fps(max_fps)
+
+    def set_max_fps(self, max_fps):
+        screen = QApplication.primaryScreen()
+        refresh = screen.refreshRate() if screen is not None and screen.refreshRate() > 0 else DEFAULT_MAX_FPS
+        self.frame_interval_ms = 1000.0 / max(1, min(max_fps, refresh))
+
+    def schedule(self, name, callback):
+        self._tasks[name] = callback; self._arm()
+
+    def update(self, widget, rect=None):
+        """Thay widget.update(rect): vùng của nhiều lần gọi trong cùng khung hình được gộp lại."""
+        if widget in self._dirty:
+            region = self._dirty[widget]
+            if region is not None: self._dirty[widget] = None if rect is None else region.united(rect)
+        else: self._dirty[widget] = None if rect is None else QRegion(rect)
+        self._arm()
+
+    def _arm(self):
+        if self._timer.isActive(): return
+        wait = self._last_frame + self.frame_interval_ms - time.perf_counter() * 1000
+        self._timer.start(max(0, int(wait)))
+
+    def _flush(self):
+        self._last_frame = time.perf_counter() * 1000
+        tasks, self._tasks = self._tasks, {}
+        for callback in tasks.values(): callback()
+        dirty, self._dirty = self._dirty, {}
+        for widget, region in dirty.items():
+            if region is None: widget.update()
+            elif not region.isEmpty(): widget.update(region)
+
+def request_repaint(widget, rect=None):
+    """widget.update() qua FrameScheduler của cửa sổ (widget.frame_scheduler); chưa gắn thì vẽ lại ngay như cũ."""
+    scheduler = getattr(widget, 'frame_scheduler', None)
+    if scheduler is not None: scheduler.update(widget, rect)
+    elif rect is None: widget.update()
+    else: widget.update(rect)
+
 # ==============================================================================
 # Lớp CÀI ĐẶT GIAO DIỆN (SETTINGS)
 # ==============================================================================
@@ -92,6 +239,7 @@ class AppSettings:
         self.SHOW_PANE_3 = True 
         
         self.MIN_LIQUIDITY_TO_SHOW = 0.1 
+        self.MAX_FPS = DEFAULT_MAX_FPS # Giới hạn số lần vẽ lại / giây (máy yếu có thể hạ xuống)
         
         self.MAX_CANDLES_TO_LOAD_1M = 60
         self.MAX_CANDLES_TO_LOAD_5M = 200
@@ -150,6 +298,8 @@ class SettingsDialog(QDialog):
         self.generic_spinboxes = {} 
         self.add_generic_spinbox_setting(left_layout, "Số nến (1 Phút):", "MAX_CANDLES_TO_LOAD_1M", self.settings.MAX_CANDLES_TO_LOAD_1M)
         self.add_generic_spinbox_setting(left_layout, "Số nến (5 Phút):", "MAX_CANDLES_TO_LOAD_5M", self.settings.MAX_CANDLES_TO_LOAD_5M)
+        self.add_generic_spinbox_setting(left_layout, "Giới hạn FPS:", "MAX_FPS", self.settings.MAX_FPS)
+        self.generic_spinboxes["MAX_FPS"].setRange(5, 240); self.generic_spinboxes["MAX_FPS"].setSingleStep(5)
 
         self.add_checkbox_setting(left_layout, "Hiển thị Info Pane (Dưới đáy)", "SHOW_INFO_PANE")
         self.add_checkbox_setting(left_layout, "Hiển thị Nhãn Info (Bên phải)", "SHOW_PANE_3") 
@@ -365,8 +515,8 @@ class PriceAxisWidget(QWidget):
         self.y_zoom=params["y_zoom"]; self.last_price=params.get("last_price",0); self.timeframe=params.get("timeframe","5M")
         self.settings.timeframe = self.timeframe
         chart_height = len(self.price_scale) * (self.effective_price_level_height() + 2)
-        self.setFixedHeight(chart_height if chart_height > 0 else 300); self.update()
-    def set_crosshair_y(self, y): self.crosshair_y = y; self.update()
+        self.setFixedHeight(chart_height if chart_height > 0 else 300); request_repaint(self)
+    def set_crosshair_y(self, y): self.crosshair_y = y; request_repaint(self)
     def paintEvent(self, event):
         painter=QPainter(self); painter.fillRect(self.rect(), self.settings.BG_COLOR); painter.setFont(self.settings.MAIN_FONT)
         if not self.price_scale: painter.end(); return
@@ -399,7 +549,7 @@ class VolumeProfileAxisWidget(QWidget):
     def update_data(self, params):
         self.price_scale=params.get("price_scale",[]); self.volume_profile=params.get("total_volume_profile",{})
         self.price_level_height=params.get("price_level_height",14); self.y_zoom=params.get("y_zoom",1.0); self.timeframe=params.get("timeframe","5M")
-        chart_height = len(self.price_scale) * (self.effective_price_level_height()+2); self.setFixedHeight(chart_height if chart_height>0 else 300); self.update()
+        chart_height = len(self.price_scale) * (self.effective_price_level_height()+2); self.setFixedHeight(chart_height if chart_height>0 else 300); request_repaint(self)
     def paintEvent(self, event):
         painter=QPainter(self); painter.fillRect(self.rect(),self.settings.BG_COLOR); painter.setFont(self.settings.MAIN_FONT)
         if not self.price_scale or not self.volume_profile: painter.end(); return
@@ -416,12 +566,14 @@ class VolumeProfileAxisWidget(QWidget):
 
 # <<<< SỬA: Logic co giãn COB (Yêu cầu mới) >>>>
 class CurrentOrderBlockWidget(QWidget):
+    """Pane COB: tổng thanh khoản (sổ UNFILTERED) theo từng hàng giá của chart, co giãn theo max của các hàng đang thấy.
+    Tổng theo hàng giữ trong ScaleBuckets: dựng lại khi thang giá đổi, còn lại chỉ cộng delta của từng message depth."""
     def __init__(self, settings, parent=None):
         super().__init__(parent)
         self.settings = settings
         self.setMinimumWidth(80)
-        self.unfiltered_live_order_book = {'bid': {}, 'ask': {}}
-        # Xóa max_live_bid và max_live_ask (sẽ tính động)
+        self.unfiltered_live_order_book = {}
+        self.buckets = ScaleBuckets(); self._buckets_key = None
         self.price_scale = []
         self.price_level_height = 14
         self.y_zoom = 1.0
@@ -430,12 +582,25 @@ class CurrentOrderBlockWidget(QWidget):
     def effective_price_level_height(self): 
         return self.price_level_height * self.y_zoom
 
-    @Slot(dict, float)
-    def on_live_liquidity_updated(self, unfiltered_live_data, max_liq_ignored):
-        """Nhận dữ liệu live book UNFILTERED từ chart chính."""
-        self.unfiltered_live_order_book = unfiltered_live_data
-        # Không cần tính max_live_bid/ask ở đây nữa
-        self.update() # Chỉ cần yêu cầu vẽ lại
+    def _price_group_by(self):
+        price_group_by = self.settings.PRICE_GROUPING.get(self.timeframe, 1)
+        return price_group_by if price_group_by > 0 else 1
+
+    def _rebuild_buckets(self):
+        key = (id(self.unfiltered_live_order_book), len(self.price_scale), self.price_scale[0] if self.price_scale else None, self._price_group_by())
+        if key == self._buckets_key: return
+        self._buckets_key = key
+        if self.price_scale: self.buckets.rebuild(self.unfiltered_live_order_book, self.price_scale[0], self._price_group_by(), len(self.price_scale))
+
+    @Slot(object, object)
+    def on_live_liquidity_updated(self, unfiltered_live_data, changes):
+        """Nhận live book UNFILTERED từ chart chính + list thay đổi (bên, giá, delta khối lượng); changes = None: dựng lại."""
+        if unfiltered_live_data is not self.unfiltered_live_order_book or changes is None:
+            self.unfiltered_live_order_book = unfiltered_live_data; self._buckets_key = None
+            self._rebuild_buckets()
+        elif self.price_scale:
+            for side, price, delta in changes: self.buckets.apply(side, price, delta)
+        request_repaint(self) # Chỉ cần yêu cầu vẽ lại
 
     def update_data(self, params):
         """Đồng bộ trục Y với chart chính."""
@@ -443,9 +608,10 @@ class CurrentOrderBlockWidget(QWidget):
         self.price_level_height = params.get("price_level_height", 14)
         self.y_zoom = params.get("y_zoom", 1.0)
         self.timeframe = params.get("timeframe", "5M")
+        self._rebuild_buckets()
         chart_height = len(self.price_scale) * (self.effective_price_level_height() + 2)
         self.setFixedHeight(chart_height if chart_height > 0 else 300)
-        self.update()
+        request_repaint(self)
 
     def paintEvent(self, event):
         painter = QPainter(self)
@@ -457,73 +623,42 @@ class CurrentOrderBlockWidget(QWidget):
             return
 
         eff_height = self.effective_price_level_height()
+        row_height = eff_height + 2
         half_width = self.width() / 2.0
         
         bid_color = self.settings.COB_BID_COLOR # -> Đỏ
         ask_color = self.settings.COB_ASK_COLOR # -> Xanh
         text_color = self.settings.COB_TEXT_COLOR
-        
-        price_group_by = self.settings.PRICE_GROUPING.get(self.timeframe, 1)
-        if price_group_by <= 0: price_group_by = 1
-        
-        # --- BẮT ĐẦU LOGIC SỬA ---
-        
-        # 1. Gộp toàn bộ thanh khoản (như cũ)
-        agg_bids = defaultdict(float)
-        agg_asks = defaultdict(float)
-
-        for p_live, (qty, ts) in self.unfiltered_live_order_book['bid'].items():
-            p_bucket = int(p_live / price_group_by) * price_group_by
-            agg_bids[p_bucket] += qty
-            
-        for p_live, (qty, ts) in self.unfiltered_live_order_book['ask'].items():
-            p_bucket = int(p_live / price_group_by) * price_group_by
-            agg_asks[p_bucket] += qty
-
-        # 2. Tìm max CHỈ TRONG PHẠM VI HIỂN THỊ (Yêu cầu mới)
-        visible_bids_qty = []
-        visible_asks_qty = []
-        visible_price_set = set(self.price_scale)
-
-        for price, qty in agg_bids.items():
-            if price in visible_price_set:
-                visible_bids_qty.append(qty)
-        
-        for price, qty in agg_asks.items():
-            if price in visible_price_set:
-                visible_asks_qty.append(qty)
-
-        max_bid_visible = max(visible_bids_qty) if visible_bids_qty else 1.0
-        max_ask_visible = max(visible_asks_qty) if visible_asks_qty else 1.0
-        
-        if max_bid_visible == 0: max_bid_visible = 1.0
-        if max_ask_visible == 0: max_ask_visible = 1.0
-
-        # --- KẾT THÚC LOGIC SỬA ---
-
-        # 3. Vẽ, sử dụng max_visible (Yêu cầu mới)
-        for i, price in enumerate(self.price_scale):
-            y_pos = i * (eff_height + 2)
+        font = self.settings.MAIN_FONT
+        
+        # Max CHỈ TRONG CÁC HÀNG ĐANG THẤY (cây max theo đoạn, không quét cả thang giá)
+        visible = self.visibleRegion().boundingRect()
+        if visible.isEmpty(): visible = event.rect()
+        first_row = max(0, int(visible.top() // row_height))
+        last_row = min(len(self.price_scale) - 1, int(visible.bottom() // row_height))
+        max_bid_visible = self.buckets.max_in_rows('bid', first_row, last_row) or 1.0
+        max_ask_visible = self.buckets.max_in_rows('ask', first_row, last_row) or 1.0
+        bid_qty = self.buckets.qty['bid'][first_row:last_row + 1].tolist()
+        ask_qty = self.buckets.qty['ask'][first_row:last_row + 1].tolist()
+
+        for i, qty_bid, qty_ask in zip(range(first_row, last_row + 1), bid_qty, ask_qty):
+            y_pos = i * row_height
             
             # Vẽ Asks (Xanh) bên TRÁI
-            qty_ask = agg_asks.get(price, 0)
             if qty_ask > 0:
-                bar_width = (qty_ask / max_ask_visible) * half_width # Sửa: dùng max_ask_visible
+                bar_width = (qty_ask / max_ask_visible) * half_width
                 bar_rect = QRectF(0, y_pos, bar_width, eff_height) 
                 painter.fillRect(bar_rect, ask_color) 
-                painter.setPen(text_color)
                 text_rect = QRectF(0 + 2, y_pos, half_width - 2, eff_height) 
-                painter.drawText(text_rect, Qt.AlignVCenter | Qt.AlignLeft, f" {qty_ask:.1f}")
+                TEXT_CACHE.draw(painter, text_rect, Qt.AlignVCenter | Qt.AlignLeft, f" {qty_ask:.1f}", font, text_color)
 
             # Vẽ Bids (Đỏ) bên PHẢI
-            qty_bid = agg_bids.get(price, 0)
             if qty_bid > 0:
-                bar_width = (qty_bid / max_bid_visible) * half_width # Sửa: dùng max_bid_visible
+                bar_width = (qty_bid / max_bid_visible) * half_width
                 bar_rect = QRectF(self.width() - bar_width, y_pos, bar_width, eff_height) 
                 painter.fillRect(bar_rect, bid_color)
-                painter.setPen(text_color)
                 text_rect = QRectF(half_width, y_pos, half_width - 2, eff_height) 
-                painter.drawText(text_rect, Qt.AlignVCenter | Qt.AlignRight, f"{qty_bid:.1f} ")
+                TEXT_CACHE.draw(painter, text_rect, Qt.AlignVCenter | Qt.AlignRight, f"{qty_bid:.1f} ", font, text_color)
                 
         painter.end()
 # <<<< KẾT THÚC SỬA COB >>>>
@@ -560,8 +695,8 @@ class DetailedInfoDataWidget(QWidget):
         eff_total_width, eff_gap=self.effective_candle_total_width(),self.effective_candle_gap()
         extra_space = self.parent().width()*0.2 if self.parent() else 200
         total_width=len(self.chart_data)*eff_total_width+(len(self.chart_data)-1)*eff_gap if self.chart_data else 0
-        self.setFixedWidth(total_width+extra_space if total_width>0 else 0); self.update()
-    def set_crosshair_x(self, x): self.crosshair_x=x; self.update()
+        self.setFixedWidth(total_width+extra_space if total_width>0 else 0); request_repaint(self)
+    def set_crosshair_x(self, x): self.crosshair_x=x; request_repaint(self)
     def paintEvent(self, event):
         painter=QPainter(self); painter.fillRect(self.rect(), self.settings.BG_COLOR); painter.setFont(self.settings.MAIN_FONT)
         if not self.chart_data: painter.end(); return
@@ -594,78 +729,192 @@ class DetailedInfoDataWidget(QWidget):
 # ==============================================================================
 # BỘ XỬ LÝ DỮ LIỆU (Worker) (Giữ nguyên)
 # ==============================================================================
+DATA_PROCESSOR_PRICE_PAD = 3000 # Thang giá luôn phủ last_price +/- giá trị này
+
+def aggregate_candle_levels(chart_data_list, group_by):
+    """Gộp level của toàn bộ nến theo bước group_by bằng NumPy: level của mọi nến được trải thành mảng phẳng
+    (giá, bid, ask, chỉ số nến), gom nhóm bằng np.floor_divide + np.bincount; 2 volume profile tính cùng lượt.
+    Trả về (nến đã gộp - level xếp giá giảm dần, total_volume_profile, detailed_volume_profile, giá min, giá max)."""
+    n = len(chart_data_list)
+    level_lists = [c.get('levels', []) for c in chart_data_list]
+    counts = np.fromiter(map(len, level_lists), dtype=np.int64, count=n)
+    m = int(counts.sum())
+    ohlc = np.array([(c.get('open',0), c.get('high',0), c.get('low',0), c.get('close',0)) for c in chart_data_list], dtype=np.float64)
+    min_p, max_p = float(ohlc.min()), float(ohlc.max())
+    if m == 0:
+        return [dict(c, levels=[]) for c in chart_data_list], {}, {}, min_p, max_p
+    flat = np.fromiter(chain.from_iterable(chain.from_iterable(level_lists)), dtype=np.float64, count=3 * m).reshape(m, 3)
+    prices, volumes = flat[:, 0], flat[:, 1] + flat[:, 2]
+    min_p, max_p = min(min_p, float(prices.min())), max(max_p, float(prices.max()))
+
+    # Hàng của bucket tính từ bucket cao nhất (0 = giá cao nhất) để level trong mỗi nến ra theo giá giảm dần
+    buckets = np.floor_divide(prices, group_by).astype(np.int64)
+    top = int(buckets.max()); rows = top - buckets; n_rows = int(rows.max()) + 1
+    keys = np.repeat(np.arange(n, dtype=np.int64), counts) * n_rows + rows
+    cells, cell_of = np.unique(keys, return_inverse=True)
+    cell_bid = np.bincount(cell_of, weights=flat[:, 1], minlength=len(cells))
+    cell_ask = np.bincount(cell_of, weights=flat[:, 2], minlength=len(cells))
+    cell_price = (top - cells % n_rows) * group_by
+    level_rows = list(map(list, zip(cell_price.tolist(), cell_bid.tolist(), cell_ask.tolist())))
+    bounds = np.searchsorted(cells // n_rows, np.arange(n + 1)).tolist()
+    aggregated = []
+    for i, candle in enumerate(chart_data_list):
+        agg_candle = candle.copy(); agg_candle['levels'] = level_rows[bounds[i]:bounds[i + 1]]
+        aggregated.append(agg_candle)
+
+    row_volume = np.bincount(rows, weights=volumes, minlength=n_rows)
+    used_rows = np.flatnonzero(np.bincount(rows, minlength=n_rows))
+    total_profile = dict(zip(((top - used_rows) * group_by).tolist(), row_volume[used_rows].tolist()))
+    unique_prices, price_of = np.unique(prices, return_inverse=True)
+    detailed_profile = dict(zip(unique_prices.tolist(), np.bincount(price_of, weights=volumes, minlength=len(unique_prices)).tolist()))
+    return aggregated, total_profile, detailed_profile, min_p, max_p
+
 class DataProcessor(QObject):
-    dataReady = Signal(dict)
-    
-    @Slot(list, str, dict, float)
-    def process_data(self, chart_data_list, timeframe, price_grouping, last_price):
+    """Gộp nến theo PRICE_GROUPING + tính thang giá và 2 volume profile (chạy ở luồng riêng).
+    Giữ trạng thái giữa các lần gọi: nến là dict không bị sửa tại chỗ (nến đổi = dict mới), nên khi chỉ vài nến
+    (thường là nến cuối) đổi thì chỉ gộp lại các nến đó và cộng / trừ phần chênh vào profile.
+    Thang giá chỉ mở rộng khi vùng giá tăng; đổi timeframe / grouping hoặc full_data thì dựng lại toàn bộ."""
+    dataReady = Signal(object) # object: truyền thẳng tham chiếu, Signal(dict) đổi cả payload sang QVariantMap mỗi lần emit
+
+    _wake = Signal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._reset()
+        self._mailbox_lock = threading.Lock(); self._pending_job = None; self._wake_posted = False; self._generation = 0
+        self._wake.connect(self._drain, Qt.QueuedConnection) # Chạy _drain trên luồng của DataProcessor
+
+    def _reset(self):
+        self._timeframe = None; self._group_by = None
+        self._raw_candles = []; self._agg_candles = [] # Nến gốc (để so danh tính) và nến đã gộp, cùng thứ tự
+        self._total_profile = defaultdict(float); self._detailed_profile = defaultdict(float)
+        self._min_p = self._max_p = None; self._price_scale = []
+
+    @staticmethod
+    def _regroup_candle(candle, group_by):
+        """Gộp 1 nến (đường cập nhật nhanh); cùng cách chia bucket (floor) với aggregate_candle_levels."""
+        new_levels = defaultdict(lambda: {'b': 0, 'a': 0})
+        for p, b, a in candle.get('levels', []):
+            bucket = int(p // group_by) * group_by; new_levels[bucket]['b'] += b; new_levels[bucket]['a'] += a
+        agg_candle = candle.copy(); agg_candle['levels'] = [[p, v['b'], v['a']] for p, v in sorted(new_levels.items(), reverse=True)]
+        return agg_candle
+
+    @staticmethod
+    def _candle_price_range(candle):
+        prices = [candle.get('open',0), candle.get('high',0), candle.get('low',0), candle.get('close',0)]
+        prices.extend(p for p, _, _ in candle.get('levels', []))
+        return min(prices), max(prices)
+
+    def _add_to_profiles(self, raw_candle, agg_candle, sign):
+        """Cộng (sign = 1) hoặc trừ (sign = -1) 1 nến vào 2 profile; mức giá về 0 thì xóa khỏi profile."""
+        for profile, candle in ((self._total_profile, agg_candle), (self._detailed_profile, raw_candle)):
+            for p, b, a in candle.get('levels', []):
+                value = profile[p] + sign * (b + a)
+                if sign < 0 and abs(value) < 1e-9: del profile[p]
+                else: profile[p] = value
+
+    def _extend_price_range(self, min_p, max_p, last_price):
+        """Nới vùng giá (không bao giờ thu hẹp). Trả về True nếu thang giá phải dựng lại."""
+        if last_price > 0:
+            min_p = min(min_p, last_price - DATA_PROCESSOR_PRICE_PAD); max_p = max(max_p, last_price + DATA_PROCESSOR_PRICE_PAD)
+        if self._min_p is not None and min_p >= self._min_p and max_p <= self._max_p: return False
+        self._min_p = min_p if self._min_p is None else min(self._min_p, min_p)
+        self._max_p = max_p if self._max_p is None else max(self._max_p, max_p)
+        group_by = self._group_by
+        min_bucket, max_bucket = int((self._min_p - group_by) / group_by) * group_by, int((self._max_p + group_by) / group_by) * group_by
+        self._price_scale = [p for p in range(max_bucket, min_bucket - 1, -group_by)]
+        return True
+
+    def _rebuild(self, chart_data_list, timeframe, group_by, last_price):
+        self._reset(); self._timeframe, self._group_by = timeframe, group_by
+        self._raw_candles = list(chart_data_list)
+        self._agg_candles, total_profile, detailed_profile, min_p, max_p = aggregate_candle_levels(chart_data_list, group_by)
+        self._total_profile = defaultdict(float, total_profile); self._detailed_profile = defaultdict(float, detailed_profile)
+        self._extend_price_range(min_p, max_p, last_price)
+
+    def _apply_incremental(self, chart_data_list, last_price):
+        """Áp dụng phần thay đổi so với lần trước. Trả về False nếu cần dựng lại toàn bộ."""
+        old = self._raw_candles
+        if not old or not chart_data_list: return False
+        # Deque có maxlen nên nến cũ bị đẩy ra ở đầu: tìm số nến đã rơi ra
+        first_ts = chart_data_list[0].get('timestamp')
+        dropped = 0
+        while dropped < len(old) and old[dropped].get('timestamp') != first_ts: dropped += 1
+        if dropped == len(old): return False
+        changed = [j for j, c in enumerate(chart_data_list) if j + dropped >= len(old) or old[j + dropped] is not c]
+        if len(changed) > max(1, len(chart_data_list) // 2): return False
+        for j in changed:
+            i = j + dropped
+            if i < len(old) and old[i].get('timestamp') != chart_data_list[j].get('timestamp'): return False
+
+        for i in range(dropped): self._add_to_profiles(old[i], self._agg_candles[i], -1)
+        agg_candles = self._agg_candles[dropped:]
+        range_min = range_max = None
+        for j in changed:
+            raw = chart_data_list[j]; agg = self._regroup_candle(raw, self._group_by)
+            if j + dropped < len(old):
+                self._add_to_profiles(old[j + dropped], agg_candles[j], -1); agg_candles[j] = agg
+            else: agg_candles.append(agg)
+            self._add_to_profiles(raw, agg, 1)
+            lo, hi = self._candle_price_range(raw)
+            range_min = lo if range_min is None else min(range_min, lo); range_max = hi if range_max is None else max(range_max, hi)
+        self._raw_candles = list(chart_data_list); self._agg_candles = agg_candles
+        if range_min is None: range_min, range_max = self._min_p, self._max_p
+        self._extend_price_range(range_min, range_max, last_price)
+        return True
+
+    # --- Hộp thư "mới nhất thắng" giữa luồng GUI và luồng xử lý ---
+    # Luồng GUI gọi submit(): job mới thay job đang chờ (tối đa 1 job chờ + 1 job đang chạy),
+    # nên dù trade tới nhanh đến đâu, luồng xử lý không bao giờ phải chạy lần lượt các snapshot đã cũ.
+    # Mỗi job mang 1 generation (tăng dần) và kết quả dataReady mang lại số đó để bên nhận bỏ kết quả lỗi thời.
+
+    def submit(self, chart_data_list, timeframe, price_grouping, last_price):
+        """Gửi job mới (gọi từ luồng GUI). Trả về generation của job."""
+        with self._mailbox_lock:
+            self._generation += 1
+            self._pending_job = (self._generation, list(chart_data_list), timeframe, dict(price_grouping), last_price)
+            wake = not self._wake_posted; self._wake_posted = True
+        if wake: self._wake.emit()
+        return self._generation
+
+    def invalidate(self):
+        """Bỏ job đang chờ và mọi kết quả chưa tới (vd: đổi timeframe). Trả về generation mà kết quả phải vượt qua."""
+        with self._mailbox_lock:
+            self._generation += 1; self._pending_job = None
+            return self._generation
+
+    @Slot()
+    def _drain(self):
+        with self._mailbox_lock:
+            job, self._pending_job, self._wake_posted = self._pending_job, None, False
+        if job is not None: self.process_data(*job[1:], generation=job[0])
+
+    def process_data(self, chart_data_list, timeframe, price_grouping, last_price, generation=0):
         group_by = price_grouping.get(timeframe, 1)
         if group_by <= 0: group_by = 1 
         
         if not chart_data_list: 
+            self._reset()
             if last_price > 0:
-                expanded_min_p = last_price - 3000
-                expanded_max_p = last_price + 3000
+                expanded_min_p = last_price - DATA_PROCESSOR_PRICE_PAD
+                expanded_max_p = last_price + DATA_PROCESSOR_PRICE_PAD
                 min_bucket, max_bucket = int(expanded_min_p / group_by) * group_by, int(expanded_max_p / group_by) * group_by
                 aggregated_price_scale = [p for p in range(max_bucket, min_bucket - 1, -group_by)]
-                self.dataReady.emit({"aggregated_price_scale": aggregated_price_scale, "aggregated_chart_data": [], "total_volume_profile": {}, "detailed_volume_profile": {}})
+                self.dataReady.emit({"aggregated_price_scale": aggregated_price_scale, "aggregated_chart_data": [], "total_volume_profile": {}, "detailed_volume_profile": {}, "generation": generation})
                 return
             else:
-                self.dataReady.emit({}); return
-
-        all_prices = set()
-        for c in chart_data_list:
-            all_prices.update([c.get('open',0), c.get('high',0), c.get('low',0), c.get('close',0)])
-            for p, _, _ in c.get('levels', []): all_prices.add(p)
-                
-        if not all_prices: 
-             if last_price > 0:
-                expanded_min_p = last_price - 3000
-                expanded_max_p = last_price + 3000
-                min_bucket, max_bucket = int(expanded_min_p / group_by) * group_by, int(expanded_max_p / group_by) * group_by
-                aggregated_price_scale = [p for p in range(max_bucket, min_bucket - 1, -group_by)]
-                self.dataReady.emit({"aggregated_price_scale": aggregated_price_scale, "aggregated_chart_data": [], "total_volume_profile": {}, "detailed_volume_profile": {}})
-                return
-             else:
-                self.dataReady.emit({}); return
+                self.dataReady.emit({"generation": generation}); return
 
-        min_p, max_p = min(all_prices), max(all_prices)
-        
-        if last_price > 0:
-            expanded_min_p = last_price - 3000
-            expanded_max_p = last_price + 3000
-            min_p = min(min_p, expanded_min_p)
-            max_p = max(max_p, expanded_max_p)
-            
-        min_p -= group_by
-        max_p += group_by
+        if timeframe != self._timeframe or group_by != self._group_by or not self._apply_incremental(chart_data_list, last_price):
+            self._rebuild(chart_data_list, timeframe, group_by, last_price)
 
-        min_bucket, max_bucket = int(min_p / group_by) * group_by, int(max_p / group_by) * group_by
-        aggregated_price_scale = [p for p in range(max_bucket, min_bucket - 1, -group_by)]
-        
-        aggregated_chart_data = []
-        for candle in chart_data_list:
-            new_levels = defaultdict(lambda: {'b': 0, 'a': 0})
-            for p, b, a in candle.get('levels', []):
-                new_levels[int(p / group_by) * group_by]['b'] += b; new_levels[int(p / group_by) * group_by]['a'] += a
-            agg_candle = candle.copy(); agg_candle['levels'] = [[p, v['b'], v['a']] for p, v in new_levels.items()]
-            
-            aggregated_chart_data.append(agg_candle)
-            
-        new_profile = defaultdict(float)
-        for candle in aggregated_chart_data:
-            for p, b, a in candle.get('levels', []): new_profile[p] += (b + a)
-        total_volume_profile = dict(new_profile); detailed_prof = defaultdict(float)
-
-        for candle in chart_data_list:
-            for p, b, a in candle.get('levels', []): detailed_prof[p] += (b+a)
-        detailed_volume_profile = dict(detailed_prof)
-        
+        # Gửi bản copy nông: luồng GUI giữ list / dict này trong khi luồng này tiếp tục cập nhật trạng thái
         self.dataReady.emit({ 
-            "aggregated_price_scale": aggregated_price_scale, 
-            "aggregated_chart_data": aggregated_chart_data, 
-            "total_volume_profile": total_volume_profile, 
-            "detailed_volume_profile": detailed_volume_profile 
+            "aggregated_price_scale": self._price_scale, 
+            "aggregated_chart_data": list(self._agg_candles), 
+            "total_volume_profile": dict(self._total_profile), 
+            "detailed_volume_profile": dict(self._detailed_profile),
+            "generation": generation
         })
 
 # ==============================================================================
@@ -674,7 +923,7 @@ class DataProcessor(QObject):
 class FootprintChartWidget(QWidget):
     crosshairMoved = Signal(QPoint)
     dataChanged = Signal()
-    liveLiquidityChanged = Signal(dict, float) 
+    liveLiquidityChanged = Signal(object, object) # (sổ lệnh UNFILTERED, list (bên, giá, delta khối lượng) hoặc None = dựng lại); không đổi sang QVariantMap
     
     def __init__(self, settings, parent_window=None, parent=None): 
         super().__init__(parent); self.settings=settings; self.setMouseTracking(True)
@@ -686,79 +935,83 @@ class FootprintChartWidget(QWidget):
         self.x_zoom,self.y_zoom=1.0,1.0; self.last_price=0
         self.last_price_highlight_color = QColor(self.settings.GRID_COLOR.name()); self.last_price_highlight_color.setAlpha(80) 
         self.setMinimumSize(400,300); self.indicators = []; self._setup_indicator_panel()
-        self.historical_heatmap_data = []; self.max_historical_liq = 1.0     
-        self.live_order_book = { 'bid': {}, 'ask': {} } 
-        self.unfiltered_live_order_book = { 'bid': {}, 'ask': {} }
+        self.historical_heatmap_data = heatmap_to_columns([]); self.max_historical_liq = 1.0     
+        # Ảnh raster heatmap lịch sử (cache) + khóa để biết khi nào phải dựng lại
+        self._historical_heatmap_version = 0; self._heatmap_raster = None; self._heatmap_raster_key = None
+        self.live_order_book = new_live_book() # Đã lọc MIN_LIQUIDITY_TO_SHOW (dải heatmap live)
+        self.unfiltered_live_order_book = new_live_book() # Đầy đủ (COB)
         self.max_live_liq = 1.0 
-        self.fade_timer = QTimer(self); self.fade_timer.timeout.connect(self.update); self.fade_timer.start(HEATMAP_REFRESH_RATE_MS) 
+        # Các ô cache lớp tĩnh của paintEvent (xem _static_layer_tiles)
+        self._static_tiles = OrderedDict(); self._static_layer_key = None; self._layer_version = 0; self._closed_candles_signature = None
+        self._bold_font = bold_font(self.settings.MAIN_FONT) # Font đậm cho chữ profile / heatmap live, tạo lại ở invalidate_layers
+        self._price_y_map_cache = {}; self._price_y_map_key = None
+        self.fade_timer = QTimer(self); self.fade_timer.timeout.connect(self._on_fade_tick); self.fade_timer.start(HEATMAP_REFRESH_RATE_MS) 
 
     def set_historical_heatmap(self, data):
-        self.historical_heatmap_data = data
-        max_liq = 0
-        if data:
-            try: max_liq = max(point.get('total_quantity', 0) for point in data)
-            except ValueError: max_liq = 0 
-        self.max_historical_liq = max_liq if max_liq > 0 else 1.0; self.update() 
+        self.historical_heatmap_data = heatmap_to_columns(data)
+        quantities = self.historical_heatmap_data['total_quantity']
+        max_liq = float(quantities.max()) if len(quantities) else 0
+        self.max_historical_liq = max_liq if max_liq > 0 else 1.0
+        self._historical_heatmap_version += 1; request_repaint(self) 
+
+    def append_historical_heatmap(self, data):
+        """Nối thêm 1 chunk heatmap lịch sử (dạng cột) vào dữ liệu hiện có."""
+        chunk = heatmap_to_columns(data)
+        if not len(chunk['time_bucket']): return
+        current = self.historical_heatmap_data
+        self.historical_heatmap_data = {k: np.concatenate((current[k], chunk[k])) for k in HEATMAP_COLUMNS}
+        max_liq = max(float(chunk['total_quantity'].max()), self.max_historical_liq if len(current['time_bucket']) else 0)
+        self.max_historical_liq = max_liq if max_liq > 0 else 1.0
+        self._historical_heatmap_version += 1; request_repaint(self)
 
     @Slot(dict)
     def add_live_liquidity(self, data):
         event_time = data.get('timestamp')
         if not event_time: 
             return
+        changes = self._apply_live_levels(data, event_time)
+        self._update_max_live_liq()
+        self.liveLiquidityChanged.emit(self.unfiltered_live_order_book, changes) 
+
+    @Slot(dict)
+    def set_live_book(self, data):
+        """Thay sổ lệnh live bằng snapshot cả sổ ('book_snapshot'); pane COB dựng lại bucket từ đầu."""
+        event_time = data.get('timestamp')
+        if not event_time: 
+            return
+        for side in ('bid', 'ask'): self.unfiltered_live_order_book[side].clear(); self.live_order_book[side].clear()
+        self._apply_live_levels(data, event_time)
+        self._update_max_live_liq()
+        self.liveLiquidityChanged.emit(self.unfiltered_live_order_book, None)
 
+    def _apply_live_levels(self, data, event_time):
+        """Ghi các mức bids/asks vào 2 sổ live. Trả về list (bên, giá, delta khối lượng) của sổ UNFILTERED."""
         min_liq_filter = self.settings.MIN_LIQUIDITY_TO_SHOW
         
         group_by = self.settings.LIQ_PRICE_GROUPING
         if group_by <= 0: 
             group_by = 1
         
-        for p_str, q_str in data.get('bids', []):
-            price = float(p_str); qty = float(q_str)
-            price_bucket = int(price / group_by) * group_by
-            
-            if qty == 0: 
-                if price_bucket in self.unfiltered_live_order_book['bid']:
-                    del self.unfiltered_live_order_book['bid'][price_bucket]
-            else:
-                self.unfiltered_live_order_book['bid'][price_bucket] = (qty, event_time)
-
-            if qty < min_liq_filter: 
-                if price_bucket in self.live_order_book['bid']: 
-                    del self.live_order_book['bid'][price_bucket]
-            else: 
-                self.live_order_book['bid'][price_bucket] = (qty, event_time)
+        changes = [] # (bên, giá, delta khối lượng) của sổ UNFILTERED cho pane COB
+        for side, levels in (('bid', data.get('bids', [])), ('ask', data.get('asks', []))):
+            book, filtered = self.unfiltered_live_order_book[side], self.live_order_book[side]
+            for p_str, q_str in levels:
+                price = float(p_str); qty = float(q_str)
+                price_bucket = int(price / group_by) * group_by
+                old = book.get(price_bucket); old_qty = old[0] if old is not None else 0.0
                 
-        for p_str, q_str in data.get('asks', []):
-            price = float(p_str); qty = float(q_str)
-            price_bucket = int(price / group_by) * group_by
-            
-            if qty == 0:
-                if price_bucket in self.unfiltered_live_order_book['ask']:
-                    del self.unfiltered_live_order_book['ask'][price_bucket]
-            else:
-                self.unfiltered_live_order_book['ask'][price_bucket] = (qty, event_time)
+                if qty == 0: book.discard(price_bucket)
+                else: book.set(price_bucket, qty, event_time)
+                if qty != old_qty: changes.append((side, price_bucket, qty - old_qty))
                 
-            if qty < min_liq_filter:
-                if price_bucket in self.live_order_book['ask']: 
-                    del self.live_order_book['ask'][price_bucket]
-            else: 
-                self.live_order_book['ask'][price_bucket] = (qty, event_time)
-        
-        max_liq = 0
-        try: 
-            max_bids = max(item[0] for item in self.live_order_book['bid'].values())
-        except ValueError: 
-            max_bids = 0
-        try: 
-            max_asks = max(item[0] for item in self.live_order_book['ask'].values())
-        except ValueError: 
-            max_asks = 0
-        
-        self.max_live_liq = max(max_bids, max_asks)
+                if qty < min_liq_filter: filtered.discard(price_bucket)
+                else: filtered.set(price_bucket, qty, event_time)
+        return changes
+
+    def _update_max_live_liq(self):
+        self.max_live_liq = max(self.live_order_book['bid'].max_qty(), self.live_order_book['ask'].max_qty())
         if self.max_live_liq == 0: 
             self.max_live_liq = 1.0
-        
-        self.liveLiquidityChanged.emit(self.unfiltered_live_order_book, 0) 
     
     def _setup_indicator_panel(self):
         self.indicator_panel = IndicatorPanel(self)
@@ -777,7 +1030,7 @@ class FootprintChartWidget(QWidget):
     def remove_indicator(self, index):
         if 0 <= index < len(self.indicators): del self.indicators[index]; self._recalculate_and_redraw()
     def set_indicator_visibility(self, index, visible):
-        if 0 <= index < len(self.indicators): self.indicators[index]['visible'] = visible; self.update()
+        if 0 <= index < len(self.indicators): self.indicators[index]['visible'] = visible; request_repaint(self)
     def open_indicator_settings(self, index):
         if 0 <= index < len(self.indicators): print(f"Yêu cầu cài đặt cho: {self.indicators[index]['instance'].name}")
     def clear_indicators(self): self.indicators.clear(); self._recalculate_and_redraw()
@@ -798,38 +1051,24 @@ class FootprintChartWidget(QWidget):
         if candle_low == 0 or candle_high == 0:
             return 
             
-        bids_to_remove = [p for p in self.unfiltered_live_order_book['bid'] if candle_low <= p <= candle_high]
-        asks_to_remove = [p for p in self.unfiltered_live_order_book['ask'] if candle_low <= p <= candle_high]
-        
-        did_remove = False
-        for p in bids_to_remove:
-            if p in self.live_order_book['bid']:
-                del self.live_order_book['bid'][p] 
-            if p in self.unfiltered_live_order_book['bid']:
-                del self.unfiltered_live_order_book['bid'][p]; did_remove = True
-                
-        for p in asks_to_remove:
-            if p in self.live_order_book['ask']:
-                del self.live_order_book['ask'][p] 
-            if p in self.unfiltered_live_order_book['ask']:
-                del self.unfiltered_live_order_book['ask'][p]; did_remove = True
-        
-        if did_remove:
-            try: max_bids = max(item[0] for item in self.live_order_book['bid'].values())
-            except ValueError: max_bids = 0
-            try: max_asks = max(item[0] for item in self.live_order_book['ask'].values())
-            except ValueError: max_asks = 0
-            self.max_live_liq = max(max_bids, max_asks)
-            if self.max_live_liq == 0: self.max_live_liq = 1.0
-            
-            self.liveLiquidityChanged.emit(self.unfiltered_live_order_book, 0)
+        changes = []
+        for side in ('bid', 'ask'):
+            self.live_order_book[side].remove_range(candle_low, candle_high)
+            changes.extend((side, p, -qty) for p, qty, _ in self.unfiltered_live_order_book[side].remove_range(candle_low, candle_high))
+        
+        if changes:
+            self._update_max_live_liq()
+            self.liveLiquidityChanged.emit(self.unfiltered_live_order_book, changes)
     
-    @Slot(dict)
+    @Slot(object)
     def on_data_processed(self, processed_data):
         self._aggregated_price_scale=processed_data.get("aggregated_price_scale",[]); 
         self._aggregated_chart_data=processed_data.get("aggregated_chart_data",[])
         self.total_volume_profile=processed_data.get("total_volume_profile",{}); 
         self.detailed_volume_profile=processed_data.get("detailed_volume_profile",{})
+        closed = self._aggregated_chart_data[:-1]
+        self._closed_candles_signature = (len(closed), closed[0].get('timestamp') if closed else None, closed[-1].get('timestamp') if closed else None,
+                                          sum(c.get('totalVolume', 0) for c in closed))
         
         if self._aggregated_chart_data:
             last_candle = self._aggregated_chart_data[-1]
@@ -845,49 +1084,143 @@ class FootprintChartWidget(QWidget):
 
         self.indicator_panel.update_indicators(self.indicators)
         if not self._aggregated_chart_data and not self._aggregated_price_scale: 
-            self.setFixedSize(400,300); self.update(); self.dataChanged.emit(); return
+            self.setFixedSize(400,300); request_repaint(self); self.dataChanged.emit(); return
         chart_height=len(self._aggregated_price_scale)*(self.effective_price_level_height()+2)
         extra_space=self.parent().width()*0.2 if self.parent() else 200
         total_width=len(self._aggregated_chart_data)*self.effective_candle_total_width()+(len(self._aggregated_chart_data)-1)*self.effective_candle_gap()
         self.setFixedSize(max(400,total_width+extra_space),max(300,chart_height))
-        self.update(); self.dataChanged.emit()
+        request_repaint(self); self.dataChanged.emit()
         
     def mouseMoveEvent(self, event): 
         if event.buttons() != Qt.NoButton: event.ignore() 
-        else: self.crosshair_pos=event.position().toPoint(); self.crosshairMoved.emit(self.crosshair_pos); self.update(); event.accept() 
+        else: self._move_crosshair(event.position().toPoint()); event.accept() 
     def leaveEvent(self, event): 
-        self.crosshair_pos=QPoint(-1,-1); self.crosshairMoved.emit(self.crosshair_pos); self.update(); event.accept() 
+        self._move_crosshair(QPoint(-1,-1)); event.accept() 
+    def _move_crosshair(self, pos):
+        """Chỉ vẽ lại 2 đường của crosshair cũ và mới thay vì toàn bộ widget."""
+        dirty = QRegion()
+        for p in (self.crosshair_pos, pos):
+            if p.x() > 0:
+                snapped_y, snapped_x = self._crosshair_lines(p)
+                dirty = dirty.united(QRect(0, int(snapped_y) - 2, self.width(), 5)).united(QRect(int(snapped_x) - 2, 0, 5, self.height()))
+        self.crosshair_pos=pos; self.crosshairMoved.emit(self.crosshair_pos)
+        if not dirty.isEmpty(): request_repaint(self, dirty)
     def resizeEvent(self, event):
         super().resizeEvent(event); self.indicator_panel.move(10, 10)
 
     def paintEvent(self, event):
-        painter=QPainter(self); painter.setRenderHint(QPainter.Antialiasing); painter.fillRect(self.rect(), self.settings.BG_COLOR)
+        painter=QPainter(self); painter.setRenderHint(QPainter.Antialiasing)
         if not self._aggregated_chart_data and not self._aggregated_price_scale:
+            painter.fillRect(self.rect(), self.settings.BG_COLOR)
             painter.setPen(self.settings.TEXT_COLOR); painter.drawText(self.rect(),Qt.AlignCenter,"Đang chờ dữ liệu..."); painter.end(); return
         
         painter.setFont(self.settings.MAIN_FONT)
         eff_pl_height, eff_total_width, eff_gap = self.effective_price_level_height(), self.effective_candle_total_width(), self.effective_candle_gap()
-        price_y_map={p:i*(eff_pl_height+2) for i,p in enumerate(self._aggregated_price_scale)}
+        price_y_map=self._price_y_map()
         
+        # Lớp 0 (vẽ mỗi frame): nền + vùng giá cuối (đổi ô giá liên tục khi thị trường chạy), nằm dưới các nến
+        visible = self.visibleRegion().boundingRect()
+        if visible.isEmpty(): visible = event.rect()
+        area = event.rect().intersected(visible)
+        painter.fillRect(area, self.settings.BG_COLOR)
+        if price_y_map: self._draw_last_price_highlight(painter, price_y_map, area)
+
+        # Lớp 1 (cache theo ô cố định, nền trong suốt): heatmap lịch sử + các nến đã đóng, chỉ các ô phủ vùng cần vẽ
+        for x, y, tile in self._static_layer_tiles(area, visible, price_y_map):
+            painter.drawPixmap(x, y, tile)
+        
+        # Lớp 2 (vẽ mỗi frame): dải heatmap live + nến đang chạy + indicator
         if price_y_map:
-            self._draw_liquidity_heatmap(painter, price_y_map)
-            self._draw_last_price_highlight(painter, price_y_map)
+            self._draw_liquidity_heatmap(painter, price_y_map, visible)
             
-        start_x_map={}
-        
-        for i, candle in enumerate(self._aggregated_chart_data):
-            start_x=i*(eff_total_width+eff_gap)
-            start_x_map[i]=start_x
-            self._draw_candle(painter, candle, start_x, price_y_map)
+        start_x_map={i: i*(eff_total_width+eff_gap) for i in range(len(self._aggregated_chart_data))}
+        if self._aggregated_chart_data:
+            last_index = len(self._aggregated_chart_data) - 1
+            if start_x_map[last_index] <= visible.right() and start_x_map[last_index] + eff_total_width >= visible.left():
+                self._draw_candle(painter, self._aggregated_chart_data[last_index], start_x_map[last_index], price_y_map, visible)
         
         for indicator_info in self.indicators: 
             if indicator_info['visible']:
                 indicator_info['instance'].paint(painter, price_y_map, start_x_map, eff_total_width, eff_pl_height)
 
+        # Lớp 3: crosshair
         if self.crosshair_pos.x() > 0: self._draw_crosshair(painter)
             
         painter.end()
 
+    def _price_y_map(self):
+        """{giá: y} cho thang giá hiện tại, chỉ dựng lại khi thang giá hoặc zoom dọc đổi."""
+        scale = self._aggregated_price_scale; row_height = self.effective_price_level_height() + 2
+        key = (len(scale), scale[0] if scale else None, scale[-1] if scale else None, row_height)
+        if key != self._price_y_map_key:
+            self._price_y_map_cache = {p: i * row_height for i, p in enumerate(scale)}; self._price_y_map_key = key
+        return self._price_y_map_cache
+
+    def invalidate_layers(self):
+        """Buộc dựng lại lớp cache (đổi cài đặt màu/font/hiển thị...)."""
+        self._bold_font = bold_font(self.settings.MAIN_FONT)
+        self._layer_version += 1; request_repaint(self)
+
+    def _static_layer_tiles(self, area, visible, price_y_map):
+        """Các ô (x, y, QPixmap) cạnh STATIC_TILE_SIZE phủ area, chứa phần ít thay đổi của biểu đồ.
+        Ô được cache theo chỉ số ô (không theo vị trí cuộn) nên khi cuộn chỉ vẽ các ô mới lộ ra, phần còn lại chỉ blit.
+        Cả cache bị bỏ khi zoom, thang giá, nến đã đóng, heatmap lịch sử hoặc cài đặt thay đổi;
+        mép phải heatmap lịch sử (chạy theo đồng hồ) chỉ làm vẽ lại cột ô chứa nó."""
+        group_by = self.settings.PRICE_GROUPING.get(self.current_tf, 1)
+        if group_by <= 0: group_by = 1
+        geometry = self._heatmap_geometry() if len(self.historical_heatmap_data['time_bucket']) else None
+        scale = self._aggregated_price_scale
+        dpr = self.devicePixelRatioF()
+        key = (self.width(), self.height(), dpr, self.x_zoom, self.y_zoom, self.current_tf, group_by,
+               scale[0] if scale else None, len(scale), self._closed_candles_signature, self._layer_version,
+               self._historical_heatmap_version, geometry is not None)
+        if key != self._static_layer_key: self._static_tiles.clear(); self._static_layer_key = key
+        size = STATIC_TILE_SIZE; tiles = []
+        if area.isEmpty(): return tiles
+        for ty in range(area.top() // size, area.bottom() // size + 1):
+            for tx in range(area.left() // size, area.right() // size + 1):
+                # Mép phải heatmap lịch sử kẹp vào ô: ô nằm hẳn 1 bên mép giữ nguyên khi mép dịch
+                edge = min(max(int(geometry[3]), tx * size), (tx + 1) * size) if geometry else None
+                entry = self._static_tiles.get((tx, ty))
+                if entry is None or entry[1] != edge:
+                    entry = (self._render_static_tile(QRect(tx * size, ty * size, size, size).intersected(self.rect()), price_y_map, geometry, dpr), edge)
+                self._static_tiles[(tx, ty)] = entry; self._static_tiles.move_to_end((tx, ty))
+                tiles.append((tx * size, ty * size, entry[0]))
+        # Giữ khoảng 2 màn hình ô; bỏ ô dùng lâu nhất
+        max_tiles = 2 * (visible.width() // size + 2) * (visible.height() // size + 2)
+        while len(self._static_tiles) > max_tiles: self._static_tiles.popitem(last=False)
+        return tiles
+
+    def _render_static_tile(self, rect, price_y_map, geometry, dpr):
+        """Vẽ lớp tĩnh của 1 ô (rect theo toạ độ widget) vào QPixmap nền trong suốt (nền + vùng giá cuối vẽ bên dưới mỗi frame)."""
+        pixmap = QPixmap(max(1, int(rect.width() * dpr)), max(1, int(rect.height() * dpr))); pixmap.setDevicePixelRatio(dpr)
+        pixmap.fill(Qt.transparent)
+        painter = QPainter(pixmap); painter.setRenderHint(QPainter.Antialiasing); painter.setFont(self.settings.MAIN_FONT)
+        painter.translate(-rect.x(), -rect.y())
+        if price_y_map and geometry: self._draw_historical_heatmap(painter, geometry[0], geometry[1], geometry[2], geometry[3], rect)
+        # Chỉ các nến đã đóng có phần nằm trong ô
+        eff_total_width, eff_gap = self.effective_candle_total_width(), self.effective_candle_gap(); candle_plus_gap = eff_total_width + eff_gap
+        first = max(0, int((rect.left() - eff_total_width) // candle_plus_gap))
+        last = min(len(self._aggregated_chart_data) - 1, int(rect.right() // candle_plus_gap) + 1)
+        for i in range(first, last):
+            self._draw_candle(painter, self._aggregated_chart_data[i], i*candle_plus_gap, price_y_map, rect)
+        painter.end()
+        return pixmap
+
+    def _live_dirty_rect(self):
+        """Vùng thay đổi theo thời gian (nến đang chạy + dải heatmap live) để update() riêng."""
+        n = len(self._aggregated_chart_data)
+        x0 = max(0, n - 1) * (self.effective_candle_total_width() + self.effective_candle_gap())
+        geometry = self._heatmap_geometry()
+        if geometry: x0 = min(x0, geometry[3])
+        x0 = max(0, int(x0) - 1)
+        return QRect(x0, 0, self.width() - x0, self.height())
+
+    def _on_fade_tick(self):
+        """Timer 20 FPS: chỉ có dải heatmap live mờ dần theo thời gian -> chỉ vẽ lại vùng đó."""
+        if self.current_tf not in ['1M', '5M']: return
+        if not self.live_order_book['bid'] and not self.live_order_book['ask']: return
+        request_repaint(self, self._live_dirty_rect())
 
     def _draw_merged_block_helper(self, painter, block_data, price_y_map, base_color_ignored, current_time_ms, rect_x, rect_width, eff_pl_height):
         if not block_data:
@@ -937,17 +1270,53 @@ class FootprintChartWidget(QWidget):
             text_rect = QRectF(rect_x, y_start, rect_width - 5, height) 
             text_color = QColor(self.settings.LIQ_TEXT_COLOR)
             text_color.setAlpha(255) 
-            painter.setPen(text_color)
-            original_font = painter.font()
-            bold_font = QFont(original_font)
-            bold_font.setBold(True)
-            painter.setFont(bold_font)
-            painter.drawText(text_rect, Qt.AlignVCenter | Qt.AlignRight, text)
-            painter.setFont(original_font)
+            TEXT_CACHE.draw(painter, text_rect, Qt.AlignVCenter | Qt.AlignRight, text, self._bold_font, text_color)
             
-    def _draw_liquidity_heatmap(self, painter, price_y_map):
+    def _historical_heatmap_pixels(self, min_ts, total_duration_ms):
+        """Mảng pixel của heatmap lịch sử (1 pixel = 1 ô thời gian x 1 mức giá).
+        Chỉ dựng lại khi dữ liệu, thang giá (grouping / vùng giá), khoảng thời gian hoặc màu thay đổi;
+        zoom chỉ đổi kích thước khi vẽ nên không cần dựng lại. Trả về (uint32 (n_rows, n_cols), số ms mà ảnh bao phủ) hoặc None."""
+        scale = self._aggregated_price_scale
+        if not scale or not len(self.historical_heatmap_data['time_bucket']): return None
+        group_by = scale[0] - scale[1] if len(scale) > 1 else max(self.settings.PRICE_GROUPING.get(self.current_tf, 1), 1)
+        st = self.settings
+        key = (self._historical_heatmap_version, scale[0], group_by, len(scale), min_ts, total_duration_ms,
+               st.LIQ_COLOR_LOW.rgba(), st.LIQ_COLOR_HIGH.rgba(), st.LIQ_ALPHA_MIN, st.LIQ_ALPHA_MAX)
+        if key != self._heatmap_raster_key:
+            col_ms = max(1000, -(-total_duration_ms // HEATMAP_RASTER_MAX_COLUMNS))
+            n_cols = -(-total_duration_ms // col_ms)
+            pixels = rasterize_heatmap(self.historical_heatmap_data, min_ts, col_ms, n_cols, scale[0], group_by, len(scale),
+                                       st.LIQ_COLOR_LOW, st.LIQ_COLOR_HIGH, st.LIQ_ALPHA_MIN, st.LIQ_ALPHA_MAX)
+            self._heatmap_raster = (pixels, n_cols * col_ms); self._heatmap_raster_key = key
+        return self._heatmap_raster
+
+    def _draw_historical_heatmap(self, painter, min_ts, total_duration_ms, total_pixel_width, right_x, area):
+        """Vẽ heatmap lịch sử lên vùng nến (không đè lên vùng live bên phải right_x), chỉ trong area.
+        Tự lấy mẫu nearest theo lưới pixel thiết bị của cả widget (drawImage co giãn làm tròn theo vùng đích,
+        các ô cache ghép lại sẽ lệch cột) rồi blit 1:1."""
+        raster = self._historical_heatmap_pixels(min_ts, total_duration_ms)
+        if raster is None or right_x <= 0: return
+        pixels, covered_ms = raster
+        n_rows, n_cols = pixels.shape
+        target_width = covered_ms / total_duration_ms * total_pixel_width
+        target_height = n_rows * (self.effective_price_level_height() + 2)
+        area = QRectF(area).intersected(QRectF(0, 0, min(target_width, right_x), target_height))
+        if area.isEmpty(): return
+        dpr = painter.device().devicePixelRatioF()
+        # Pixel thiết bị được vẽ nếu tâm của nó nằm trong area
+        xs = np.arange(math.ceil(area.left() * dpr - 0.5), math.ceil(area.right() * dpr - 0.5))
+        ys = np.arange(math.ceil(area.top() * dpr - 0.5), math.ceil(area.bottom() * dpr - 0.5))
+        if not len(xs) or not len(ys): return
+        cols = np.minimum(((xs + 0.5) * (n_cols / (target_width * dpr))).astype(np.int64), n_cols - 1)
+        rows = np.minimum(((ys + 0.5) * (n_rows / (target_height * dpr))).astype(np.int64), n_rows - 1)
+        block = np.ascontiguousarray(pixels[rows[:, None], cols])
+        image = QImage(block.data, len(xs), len(ys), len(xs) * 4, QImage.Format_ARGB32); image.setDevicePixelRatio(dpr)
+        painter.drawImage(QPointF(xs[0] / dpr, ys[0] / dpr), image)
+
+    def _heatmap_geometry(self):
+        """Thông số trục thời gian của heatmap: (min_ts, total_duration_ms, total_pixel_width, live_heatmap_x, chart_area_width) hoặc None."""
         if self.current_tf not in ['1M', '5M'] or not self.chart_data: 
-            return
+            return None
             
         min_ts = self.chart_data[0]['timestamp']
         
@@ -956,20 +1325,18 @@ class FootprintChartWidget(QWidget):
         candle_plus_gap = eff_total_width + eff_gap
         total_pixel_width = (len(self.chart_data) * candle_plus_gap) - eff_gap 
         
-        if total_pixel_width <= 0: return
+        if total_pixel_width <= 0: return None
 
         tf_duration_ms = TIMEFRAME_MS.get(self.current_tf, 300000) 
         
         max_ts = self.chart_data[-1]['timestamp'] + tf_duration_ms
         total_duration_ms = max_ts - min_ts
-        if total_duration_ms <= 0: return
+        if total_duration_ms <= 0: return None
             
         def time_to_x(ts):
             relative_pos = (ts - min_ts) / total_duration_ms
             return relative_pos * total_pixel_width
 
-        eff_pl_height = self.effective_price_level_height()
-        
         current_time_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
         is_auto_scroll_active = self.parent_window.is_auto_scroll_active 
         
@@ -980,6 +1347,16 @@ class FootprintChartWidget(QWidget):
             live_heatmap_x = (len(self.chart_data) * candle_plus_gap) - eff_gap
         else:
             live_heatmap_x = time_to_x(current_time_ms)
+        return min_ts, total_duration_ms, total_pixel_width, live_heatmap_x, chart_area_width
+
+    def _draw_liquidity_heatmap(self, painter, price_y_map, visible=None):
+        """Vẽ dải heatmap live (order book hiện tại, mờ dần theo thời gian) bên phải nến cuối.
+        visible (QRect): chỉ vẽ các giá nằm trong vùng đang thấy."""
+        geometry = self._heatmap_geometry()
+        if geometry is None: return
+        min_ts, total_duration_ms, total_pixel_width, live_heatmap_x, chart_area_width = geometry
+        eff_pl_height = self.effective_price_level_height()
+        current_time_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
         
         live_heatmap_width = chart_area_width - live_heatmap_x
         
@@ -989,86 +1366,83 @@ class FootprintChartWidget(QWidget):
         group_by = self.settings.LIQ_PRICE_GROUPING
         if group_by <= 0: group_by = 1
             
-        # Vẽ Live Bids (Dùng FILTERED book)
-        prices_to_remove = []
-        sorted_bids = sorted(self.live_order_book['bid'].items(), key=lambda item: item[0], reverse=True)
-        current_block = [] 
-        
-        for (price, (qty, timestamp)) in sorted_bids:
-            time_elapsed = current_time_ms - timestamp
-            if time_elapsed > HEATMAP_FADE_DURATION_MS:
-                prices_to_remove.append(price)
-                continue
-            if price not in price_y_map:
-                continue
-            if not current_block or price == current_block[-1][0] - group_by:
-                current_block.append((price, qty, timestamp))
-            else:
-                self._draw_merged_block_helper(painter, current_block, price_y_map, None, current_time_ms, live_heatmap_x, live_heatmap_width, eff_pl_height)
-                current_block = [(price, qty, timestamp)]
-        if current_block:
-            self._draw_merged_block_helper(painter, current_block, price_y_map, None, current_time_ms, live_heatmap_x, live_heatmap_width, eff_pl_height)
-        for price in prices_to_remove: 
-            if price in self.live_order_book['bid']:
-                del self.live_order_book['bid'][price]
-
-        # Vẽ Live Asks (Dùng FILTERED book)
-        prices_to_remove = []
-        sorted_asks = sorted(self.live_order_book['ask'].items(), key=lambda item: item[0], reverse=True)
-        current_block = [] 
-        for (price, (qty, timestamp)) in sorted_asks:
-            time_elapsed = current_time_ms - timestamp
-            if time_elapsed > HEATMAP_FADE_DURATION_MS:
-                prices_to_remove.append(price)
-                continue
-            if price not in price_y_map:
-                continue
-            if not current_block or price == current_block[-1][0] - group_by:
-                current_block.append((price, qty, timestamp))
-            else:
-                self._draw_merged_block_helper(painter, current_block, price_y_map, None, current_time_ms, live_heatmap_x, live_heatmap_width, eff_pl_height)
-                current_block = [(price, qty, timestamp)]
-        if current_block:
-            self._draw_merged_block_helper(painter, current_block, price_y_map, None, current_time_ms, live_heatmap_x, live_heatmap_width, eff_pl_height)
-        for price in prices_to_remove: 
-            if price in self.live_order_book['ask']:
-                del self.live_order_book['ask'][price]
-
-    def _draw_candle(self, painter, candle_data, start_x, price_y_map):
+        # Bỏ các mức đã mờ hẳn (dùng FILTERED book), rồi chỉ duyệt các giá trong vùng đang thấy
+        for side in self.live_order_book.values(): side.expire_before(current_time_ms - HEATMAP_FADE_DURATION_MS)
+        low = high = None
+        scale = self._aggregated_price_scale
+        if visible is not None and scale:
+            row_height = eff_pl_height + 2
+            high = scale[min(len(scale) - 1, max(0, int(visible.top() // row_height)))]
+            low = scale[min(len(scale) - 1, max(0, int(visible.bottom() // row_height) + 1))]
+        
+        for side in (self.live_order_book['bid'], self.live_order_book['ask']):
+            # Block = các mức liền nhau (bước group_by) có trên thang giá
+            blocks = []
+            for price, qty, timestamp in side.iter_desc(low, high):
+                if price not in price_y_map: continue
+                if blocks and price == blocks[-1][-1][0] - group_by: blocks[-1].append((price, qty, timestamp))
+                else: blocks.append([(price, qty, timestamp)])
+            if not blocks: continue
+            # Block cắt ngang mép vùng nhìn: nối tiếp phần ngoài vùng để gộp / ghi số giống khi vẽ toàn bộ
+            head, price = [], blocks[0][0][0] + group_by
+            while price in side and price in price_y_map: head.append((price,) + side[price]); price += group_by
+            blocks[0][:0] = head[::-1]
+            price = blocks[-1][-1][0] - group_by
+            while price in side and price in price_y_map: blocks[-1].append((price,) + side[price]); price -= group_by
+            for block in blocks:
+                self._draw_merged_block_helper(painter, block, price_y_map, None, current_time_ms, live_heatmap_x, live_heatmap_width, eff_pl_height)
+        painter.setFont(self.settings.MAIN_FONT) # TEXT_CACHE.draw để lại font đậm trên painter
+
+    def _row_range(self, price_min_excl, price_max_excl, group_by):
+        """Chỉ số hàng (trên, dưới) của thang giá có price_min_excl < giá < price_max_excl (có thể rỗng: trên > dưới)."""
+        top_price = self._aggregated_price_scale[0]
+        top = math.floor((top_price - price_max_excl) / group_by) + 1
+        bottom = math.ceil((top_price - price_min_excl) / group_by) - 1
+        return max(top, 0), min(bottom, len(self._aggregated_price_scale) - 1)
+
+    def _draw_candle(self, painter, candle_data, start_x, price_y_map, visible=None):
+        """Vẽ 1 nến. Thân / râu là 1 hình chữ nhật mỗi đoạn; profile chỉ duyệt các level của nến
+        và bỏ qua hàng nằm ngoài visible (QRect vùng đang thấy, None = không giới hạn)."""
+        if not self._aggregated_price_scale: return
         open_p, close_p, high_p, low_p = candle_data.get('open',0), candle_data.get('close',0), candle_data.get('high',0), candle_data.get('low',0)
         levels, is_bullish = candle_data.get('levels', []), close_p > open_p
         group_by = self.settings.PRICE_GROUPING.get(self.current_tf, 1)
         if group_by <= 0: group_by = 1 
         
         poc_price, max_vol_in_candle = None, 0
-        if levels:
-            levels_map = {p: {'b': b, 'a': a} for p, b, a in levels}
-            for p, v in levels_map.items():
-                total_vol = v['b'] + v['a']
-                if total_vol > max_vol_in_candle: max_vol_in_candle, poc_price = total_vol, p
-        else: levels_map = {}
+        for p, b, a in levels:
+            if b + a > max_vol_in_candle: max_vol_in_candle, poc_price = b + a, p
             
         eff_pl_height = self.effective_price_level_height(); eff_body_width = self.effective_candle_body_width()
         eff_profile_width = self.effective_profile_width(); eff_body_profile_gap = self.effective_body_profile_gap()
+        row_height = eff_pl_height + 2
         
         body_min_p = min(open_p, close_p)
         body_max_p = max(open_p, close_p)
         wick_min_p = low_p
         wick_max_p = high_p
         
-        for price, y_pos in price_y_map.items():
-            price_end = price + group_by
-            
-            if self.settings.SHOW_CANDLE_BODY and (body_min_p < price_end and price < body_max_p):
-                painter.fillRect(QRectF(start_x, y_pos, eff_body_width, eff_pl_height), self.settings.BULL_COLOR if is_bullish else self.settings.BEAR_COLOR)
-            
-            elif self.settings.SHOW_CANDLE_WICK and (wick_min_p < price_end and price < wick_max_p):
-                if not (body_min_p < price_end and price < body_max_p):
-                    painter.fillRect(QRectF(start_x + (eff_body_width - 2) / 2, y_pos, 2, eff_pl_height), self.settings.WICK_COLOR)
-            
-            if self.settings.SHOW_CANDLE_PROFILE and price in levels_map:
-                profile_x = start_x + eff_body_width + eff_body_profile_gap
-                bid_vol, ask_vol = levels_map[price]['b'], levels_map[price]['a']
+        # Hàng giá p (bước group_by) thuộc thân nếu body_min < p + group_by và p < body_max
+        body_top, body_bottom = self._row_range(body_min_p - group_by, body_max_p, group_by)
+        if self.settings.SHOW_CANDLE_BODY and body_top <= body_bottom:
+            painter.fillRect(QRectF(start_x, body_top * row_height, eff_body_width, (body_bottom - body_top) * row_height + eff_pl_height), self.settings.BULL_COLOR if is_bullish else self.settings.BEAR_COLOR)
+        
+        if self.settings.SHOW_CANDLE_WICK:
+            wick_top, wick_bottom = self._row_range(wick_min_p - group_by, wick_max_p, group_by)
+            wick_x = start_x + (eff_body_width - 2) / 2
+            # Râu trên / dưới = đoạn râu trừ các hàng của thân
+            segments = [(wick_top, min(wick_bottom, body_top - 1)), (max(wick_top, body_bottom + 1), wick_bottom)] if body_top <= body_bottom else [(wick_top, wick_bottom)]
+            for top, bottom in segments:
+                if top <= bottom:
+                    painter.fillRect(QRectF(wick_x, top * row_height, 2, (bottom - top) * row_height + eff_pl_height), self.settings.WICK_COLOR)
+        
+        if self.settings.SHOW_CANDLE_PROFILE and levels:
+            profile_x = start_x + eff_body_width + eff_body_profile_gap; text_color = self.settings.TEXT_COLOR
+            y_min = visible.top() - row_height if visible is not None else None
+            y_max = visible.bottom() if visible is not None else None
+            for price, bid_vol, ask_vol in levels:
+                y_pos = price_y_map.get(price)
+                if y_pos is None or (visible is not None and not (y_min <= y_pos <= y_max)): continue
                 total_vol, delta = bid_vol + ask_vol, ask_vol - bid_vol
                 bar_width = (total_vol / max_vol_in_candle * eff_profile_width) if max_vol_in_candle > 0 else 0
                 bar_rect = QRectF(profile_x, y_pos, bar_width, eff_pl_height)
@@ -1079,36 +1453,44 @@ class FootprintChartWidget(QWidget):
                 
                 painter.fillRect(bar_rect, bar_color)
                 
-                combined_text = f"{bid_vol:.1f} x {ask_vol:.1f}"; painter.setPen(self.settings.TEXT_COLOR)
-                original_font = painter.font(); bold_font = QFont(original_font); bold_font.setBold(True)
-                painter.setFont(bold_font); painter.drawText(QRectF(profile_x, y_pos, eff_profile_width, eff_pl_height), Qt.AlignCenter, combined_text); painter.setFont(original_font)
+                TEXT_CACHE.draw(painter, QRectF(profile_x, y_pos, eff_profile_width, eff_pl_height), Qt.AlignCenter, f"{bid_vol:.1f} x {ask_vol:.1f}", self._bold_font, text_color)
                 
                 if price == poc_price: 
                     painter.setPen(QPen(self.settings.POC_HIGHLIGHT_COLOR, 1))
                     painter.drawRect(bar_rect)
                     painter.setPen(Qt.NoPen)
+            painter.setFont(self.settings.MAIN_FONT)
             
-    def _draw_last_price_highlight(self, painter, price_y_map):
+    def _draw_last_price_highlight(self, painter, price_y_map, area=None):
+        """Dải + đường nét đứt ở ô giá cuối; area: chỉ vẽ phần trong vùng này (vùng đang vẽ lại)."""
         if self.last_price > 0:
             group_by = self.settings.PRICE_GROUPING.get(self.current_tf, 1) 
             if group_by <= 0: group_by = 1 
             last_price_bucket = int(self.last_price / group_by) * group_by
             if last_price_bucket in price_y_map:
                 y = price_y_map[last_price_bucket]; eff_height = self.effective_price_level_height()
-                painter.fillRect(QRectF(0, y, self.width(), eff_height + 2), self.last_price_highlight_color)
-                pen = QPen(self.settings.LAST_PRICE_LINE_COLOR, 1, Qt.DashLine); painter.setPen(pen)
-                center_y = y + eff_height / 2; painter.drawLine(QPointF(0, center_y), QPointF(self.width(), center_y))
+                x0, x1 = (area.left(), area.right() + 1) if area is not None else (0, self.width())
+                painter.fillRect(QRectF(x0, y, x1 - x0, eff_height + 2), self.last_price_highlight_color)
+                # Nét đứt 4 + 2 pixel tự vẽ, tính từ x = 0 (bộ dash của Qt bắt đầu lại ở mép clip nên vẽ lại từng phần bị lệch nét)
+                center_y = y + eff_height / 2
+                for x in range(int(x0) - int(x0) % 6, int(math.ceil(x1)), 6):
+                    painter.fillRect(QRectF(x, center_y - 0.5, 4, 1), self.settings.LAST_PRICE_LINE_COLOR)
                 
-    def _draw_crosshair(self, painter):
+    def _crosshair_lines(self, pos):
+        """(y, x) của đường ngang / dọc crosshair đã bám theo hàng giá và nến."""
         eff_pl_height = self.effective_price_level_height(); total_row_height = eff_pl_height + 2
-        index = int(self.crosshair_pos.y() / total_row_height); snapped_y = (index * total_row_height) + (eff_pl_height / 2)
-        pen = QPen(self.settings.CROSSHAIR_LINE_COLOR, 1, Qt.DashLine); painter.setPen(pen)
-        painter.drawLine(0, snapped_y, self.width(), snapped_y)
+        index = int(pos.y() / total_row_height); snapped_y = (index * total_row_height) + (eff_pl_height / 2)
         eff_total_width = self.effective_candle_total_width(); eff_gap = self.effective_candle_gap(); candle_plus_gap = eff_total_width + eff_gap
-        scroll_x = 0; parent_scroll_area = self.parent().parent() 
+        scroll_x = 0; parent_scroll_area = self.parent().parent() if self.parent() else None
         if isinstance(parent_scroll_area, QScrollArea): scroll_x = parent_scroll_area.horizontalScrollBar().value()
-        absolute_x = self.crosshair_pos.x() + scroll_x; candle_index = int(absolute_x / candle_plus_gap)
+        absolute_x = pos.x() + scroll_x; candle_index = int(absolute_x / candle_plus_gap)
         snapped_absolute_x = (candle_index * candle_plus_gap) + (eff_total_width / 2)
+        return snapped_y, snapped_absolute_x
+
+    def _draw_crosshair(self, painter):
+        snapped_y, snapped_absolute_x = self._crosshair_lines(self.crosshair_pos)
+        pen = QPen(self.settings.CROSSHAIR_LINE_COLOR, 1, Qt.DashLine); painter.setPen(pen)
+        painter.drawLine(0, snapped_y, self.width(), snapped_y)
         painter.drawLine(QPointF(snapped_absolute_x, 0), QPointF(snapped_absolute_x, self.height()))
 
 class PannableScrollArea(QScrollArea):
@@ -1139,7 +1521,6 @@ class PannableScrollArea(QScrollArea):
 # CỬA SỔ CHÍNH
 # ==============================================================================
 class MainWindow(QMainWindow):
-    requestProcessData = Signal(list, str, dict, float)
     
     def __init__(self, db_queue_ref, db_thread_ref):
         super().__init__(); 
@@ -1153,6 +1534,12 @@ class MainWindow(QMainWindow):
         self.setWindowTitle("Footprint Chart V22.5 - Sửa lỗi Scaling COB") 
         self.resize(1920, 1080)
         self.is_auto_scroll_active = True 
+        self.use_delta_updates = True # Nhận 'update_delta' (chỉ level thay đổi) thay vì cả nến
+        self.use_binary_frames = True # Nhận frame nhị phân (binary_frames.py) thay vì JSON
+        self._update_seq = None # seq của update cuối đã áp dụng (None = đang chờ full_data)
+        self._book_update_id = None # update_id của sổ lệnh live (None = đang chờ book_snapshot)
+        self._heatmap_stream_id = None # Luồng heatmap_chunk đang nhận (None = chờ chunk 0 mới)
+        self._data_generation_floor = 0; self._data_generation_applied = 0 # Generation của kết quả DataProcessor (xem _on_data_ready)
         self.current_tf = self.settings.timeframe; self._initial_sizes_set = False;
         
         self._setup_data_thread(); self._setup_ui(); self._setup_websocket(); self._update_stylesheet()
@@ -1279,8 +1666,12 @@ class MainWindow(QMainWindow):
         self.chart_widget.crosshairMoved.connect(self._on_crosshair_moved)
         self.chart_scroll_area.panned.connect(self._disable_auto_scroll) 
         self.chart_scroll_area.zoomRequested.connect(self.chart_widget.apply_zoom)
-        self.requestProcessData.connect(self.data_processor.process_data)
-        self.data_processor.dataReady.connect(self.chart_widget.on_data_processed)
+        self.data_processor.dataReady.connect(self._on_data_ready)
+        
+        # Mọi lần vẽ lại của các pane đi qua 1 bộ điều phối khung hình chung
+        self.frame_scheduler = FrameScheduler(self.settings.MAX_FPS, self)
+        for widget in (self.chart_widget, self.cob_widget, self.price_axis_widget, self.volume_profile_axis_widget, self.detailed_info_data_widget):
+            widget.frame_scheduler = self.frame_scheduler
         
         self.chart_widget.liveLiquidityChanged.connect(self.cob_widget.on_live_liquidity_updated)
 
@@ -1296,6 +1687,7 @@ class MainWindow(QMainWindow):
         v_bar_cob = self.cob_scroll_area.verticalScrollBar() 
         
         v_bars = [v_bar_chart, v_bar_price, v_bar_vp, v_bar_cob]
+        v_bar_cob.valueChanged.connect(lambda _: request_repaint(self.cob_widget)) # COB co giãn theo các hàng đang thấy
         for i in range(len(v_bars)):
             for j in range(len(v_bars)):
                 if i != j: v_bars[i].valueChanged.connect(v_bars[j].setValue)
@@ -1366,6 +1758,7 @@ class MainWindow(QMainWindow):
 
     def _apply_settings_deferred(self):
         self.save_settings()
+        self.frame_scheduler.set_max_fps(self.settings.MAX_FPS)
         self._update_stylesheet()
         
         if self.websocket.isValid():
@@ -1398,11 +1791,12 @@ class MainWindow(QMainWindow):
             self.chart_widget.chart_data.extend(old_data)
         
         self.chart_widget.set_historical_heatmap([]) 
+        self.chart_widget.invalidate_layers()
         self._request_timeframe_data(self.current_tf) 
         
     @Slot()
     def _process_pane_updates(self):
-        QTimer.singleShot(0, self._deferred_process_pane_updates)
+        self.frame_scheduler.schedule('panes', self._deferred_process_pane_updates)
 
     def _deferred_process_pane_updates(self):
         if not self.chart_widget: return 
@@ -1423,6 +1817,7 @@ class MainWindow(QMainWindow):
     def _setup_websocket(self):
         self.websocket = QWebSocket(); self.websocket.connected.connect(self._on_websocket_connected)
         self.websocket.disconnected.connect(self._on_websocket_disconnected); self.websocket.textMessageReceived.connect(self._on_websocket_message)
+        self.websocket.binaryMessageReceived.connect(self._on_websocket_binary_message)
         self.reconnect_timer = QTimer(self); self.reconnect_timer.setInterval(3000); self.reconnect_timer.timeout.connect(self._connect_websocket); self._connect_websocket()
         
     def _connect_websocket(self): 
@@ -1432,8 +1827,13 @@ class MainWindow(QMainWindow):
     def _on_websocket_connected(self): 
         self.status_label.setText(f"<span style='color: {self.settings.BULL_COLOR.name()};'>●</span> Đã kết nối"); 
         self.reconnect_timer.stop(); 
+        self._book_update_id = None # Backend gửi book_snapshot ngay khi kết nối
         if self.websocket.isValid():
             print("Kết nối thành công. Đang gửi cài đặt cho Backend...")
+            if self.use_delta_updates:
+                self.websocket.sendTextMessage(json.dumps({ "type": "set_protocol", "updates": "delta" }))
+            if self.use_binary_frames:
+                self.websocket.sendTextMessage(json.dumps({ "type": "set_protocol", "frames": "binary" }))
             self.websocket.sendTextMessage(json.dumps({ "type": "update_settings", "price_grouping": self.settings.PRICE_GROUPING }))
         self._request_timeframe_data(self.current_tf)
 
@@ -1442,6 +1842,8 @@ class MainWindow(QMainWindow):
     
     def _request_timeframe_data(self, tf):
         max_candles = self.settings.get_max_candles(tf)
+        self._update_seq = None # Bỏ qua delta cho tới khi nhận full_data mới
+        self._heatmap_stream_id = None # Bỏ các heatmap_chunk còn sót của yêu cầu trước
         self.websocket.sendTextMessage(json.dumps({
             "type": "request_timeframe", 
             "timeframe": tf,
@@ -1486,30 +1888,75 @@ class MainWindow(QMainWindow):
             self.chart_widget.chart_data.extend(old_data) 
             
             self.chart_widget.chart_data.clear()
+            self._data_generation_floor = self.data_processor.invalidate() # Bỏ kết quả của timeframe cũ còn trên đường tới
             self.chart_widget.on_data_processed({}) 
             self.chart_widget.set_historical_heatmap([]) 
             
-            self.cob_widget.on_live_liquidity_updated({}, 1.0)
+            self.cob_widget.on_live_liquidity_updated({}, None)
             
             if self.websocket.isValid():
                 self._request_timeframe_data(self.current_tf)
             else:
                  pass 
             
+    def _request_process_data(self):
+        self.data_processor.submit(self.chart_widget.chart_data, self.current_tf, self.settings.PRICE_GROUPING, self.chart_widget.last_price)
+
+    @Slot(object)
+    def _on_data_ready(self, processed_data):
+        """Chỉ áp dụng kết quả mới hơn kết quả đã vẽ và không thuộc lần invalidate() trước."""
+        generation = processed_data.get('generation', 0)
+        if generation < self._data_generation_floor or generation <= self._data_generation_applied: return
+        self._data_generation_applied = generation
+        self.chart_widget.on_data_processed(processed_data)
+
     @Slot(str)
     def _on_websocket_message(self, msg):
         try: message = json.loads(msg)
         except json.JSONDecodeError: return
+        self._handle_message(message)
+
+    @Slot(QByteArray)
+    def _on_websocket_binary_message(self, data):
+        try: message = decode_message(data.data())
+        except ValueError: return
+        if message.get('type') in ('update', 'update_delta'):
+            # Nến được cache/xử lý dạng list như bản JSON
+            for candle in message.get('data', {}).values(): candle['levels'] = candle['levels'].tolist()
+            for candles in message.get('closed', {}).values():
+                for candle in candles: candle['levels'] = candle['levels'].tolist()
+        self._handle_message(message)
+
+    def _handle_message(self, message):
         msg_type = message.get('type')
         
         if msg_type == 'full_data' and message.get('timeframe') == self.current_tf:
+            self._update_seq = message.get('seq')
             self.chart_widget.chart_data.clear()
             self.chart_widget.chart_data.extend(message.get('data', [])) 
             if self.chart_widget.chart_data: self.chart_widget.last_price = self.chart_widget.chart_data[-1].get('close', 0)
             
-            self.requestProcessData.emit(list(self.chart_widget.chart_data), self.current_tf, self.settings.PRICE_GROUPING, self.chart_widget.last_price)
-        
+            self._request_process_data()
+        
+        elif msg_type == 'update_delta':
+            if self._update_seq is None: return # Đang chờ full_data (resync)
+            seq = message.get('seq', 0)
+            if seq <= self._update_seq: return # Đã có trong snapshot
+            if seq != self._update_seq + 1:
+                print(f"Mất update (seq {self._update_seq} -> {seq}). Đang đồng bộ lại {self.current_tf}...")
+                self._request_timeframe_data(self.current_tf); return
+            self._update_seq = seq
+            self._apply_closed_candles(message.get('closed', {}).get(self.current_tf, []))
+            delta = message.get('data', {}).get(self.current_tf)
+            if delta:
+                if not self._apply_candle_delta(delta):
+                    print(f"Không ghép được delta cho {self.current_tf}. Đang đồng bộ lại...")
+                    self._request_timeframe_data(self.current_tf); return
+                self.chart_widget.last_price = self.chart_widget.chart_data[-1].get('close', 0)
+                self._request_process_data()
+
         elif msg_type == 'update':
+            self._apply_closed_candles(message.get('closed', {}).get(self.current_tf, []))
             update = message.get('data', {}).get(self.current_tf)
             if update:
                 if self.chart_widget.chart_data and self.chart_widget.chart_data[-1]['timestamp'] == update['timestamp']:
@@ -1518,15 +1965,66 @@ class MainWindow(QMainWindow):
                     self.chart_widget.chart_data.append(update) 
                 self.chart_widget.last_price = self.chart_widget.chart_data[-1].get('close', 0)
                 
-                self.requestProcessData.emit(list(self.chart_widget.chart_data), self.current_tf, self.settings.PRICE_GROUPING, self.chart_widget.last_price)
+                self._request_process_data()
         
         elif msg_type == 'full_heatmap' and message.get('timeframe') == self.current_tf:
-            print(f"Nhận được {len(message.get('data', []))} điểm heatmap lịch sử.")
             self.chart_widget.set_historical_heatmap(message.get('data', []))
+            print(f"Nhận được {len(self.chart_widget.historical_heatmap_data['time_bucket'])} điểm heatmap lịch sử.")
+
+        elif msg_type == 'heatmap_chunk' and message.get('timeframe') == self.current_tf:
+            # Chunk 0 mở đầu 1 luồng mới (mới nhất trước); bỏ các chunk còn sót của luồng cũ
+            if message.get('chunk') == 0:
+                self._heatmap_stream_id = message.get('stream_id')
+                self.chart_widget.set_historical_heatmap(message.get('data', []))
+            elif message.get('stream_id') == self._heatmap_stream_id:
+                self.chart_widget.append_historical_heatmap(message.get('data', []))
+            else: return
+            if message.get('final'):
+                print(f"Nhận được {len(self.chart_widget.historical_heatmap_data['time_bucket'])} điểm heatmap lịch sử.")
+
+        elif msg_type == 'book_snapshot':
+            if message.get('update_id') == self._book_update_id: return # Sổ đang khớp (snapshot định kỳ)
+            self._book_update_id = message.get('update_id')
+            self.chart_widget.set_live_book(message)
 
         elif msg_type == 'liquidity_raw':
+            update_id = message.get('update_id')
+            if update_id is not None: # Delta có đánh số: chỉ áp dụng khi nối tiếp sổ hiện tại
+                if self._book_update_id is None or update_id <= self._book_update_id: return
+                if message.get('prev_update_id') != self._book_update_id:
+                    print(f"Mất delta sổ lệnh (update_id {self._book_update_id} -> {message.get('prev_update_id')}). Đang lấy lại snapshot...")
+                    self._book_update_id = None
+                    self.websocket.sendTextMessage(json.dumps({ "type": "request_book_snapshot" })); return
+                self._book_update_id = update_id
             self.chart_widget.add_live_liquidity(message)
                 
+    def _apply_closed_candles(self, closed_candles):
+        """Ghi trạng thái cuối của các nến vừa đóng (gửi kèm trong 'closed')."""
+        chart_data = self.chart_widget.chart_data
+        for closed_candle in closed_candles:
+            if chart_data and chart_data[-1]['timestamp'] == closed_candle['timestamp']:
+                chart_data[-1] = closed_candle
+            elif not chart_data or chart_data[-1]['timestamp'] < closed_candle['timestamp']:
+                chart_data.append(closed_candle)
+
+    def _apply_candle_delta(self, delta):
+        """Vá nến cuối bằng delta (OHLC + level đã đổi). Trả về False nếu không vá được (cần resync).
+        Tạo dict mới thay vì sửa dict cũ vì DataProcessor có thể đang đọc nó ở luồng khác."""
+        chart_data = self.chart_widget.chart_data
+        candle = {k: v for k, v in delta.items() if k != 'full'}
+        if delta.get('full'):
+            if chart_data and chart_data[-1]['timestamp'] == delta['timestamp']: chart_data[-1] = candle
+            elif not chart_data or chart_data[-1]['timestamp'] < delta['timestamp']: chart_data.append(candle)
+            else: return False
+            return True
+        if not chart_data or chart_data[-1]['timestamp'] != delta['timestamp']:
+            return False
+        levels = {p: [p, b, a] for p, b, a in chart_data[-1].get('levels', [])}
+        for p, b, a in delta.get('levels', []): levels[p] = [p, b, a]
+        candle['levels'] = sorted(levels.values(), key=lambda x: x[0], reverse=True)
+        chart_data[-1] = candle
+        return True
+
     def closeEvent(self, event): 
         print("Bắt đầu quá trình tắt máy...")
         self.save_settings()
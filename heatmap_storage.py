@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+# FILE: heatmap_storage.py
+# Lưu trữ Heatmap thanh khoản trong DuckDB: schema, bảng rollup gộp sẵn và câu truy vấn.
+#
+# Bảng thô 'liquidity_updates' giữ từng level của từng depth event. Các bảng rollup
+# giữ SUM(quantity) theo (ô thời gian, ô giá, side) ở độ phân giải cố định và được
+# luồng ghi CSDL cập nhật dần theo từng lô. Truy vấn heatmap đọc từ rollup THÔ NHẤT
+# còn đáp ứng được yêu cầu, cộng với phần đuôi thô chưa được gộp (sau watermark).
+
+import os
+import glob
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+RAW_TABLE = 'liquidity_updates'
+# View đọc toàn bộ dữ liệu thô: bảng nóng + các phân vùng Parquet theo ngày đã lưu trữ
+RAW_VIEW = 'liquidity_all'
+# Các file Parquet đã lưu trữ (1 file mỗi ngày). Chỉ file có trong bảng này mới được đọc qua view.
+ARCHIVE_FILES_TABLE = 'liquidity_archive_files'
+
+# (tên bảng, độ phân giải thời gian ms, bước giá). Bước giá nhỏ nhất = price grouping nhỏ nhất mà giao diện cho chọn (1).
+HEATMAP_ROLLUPS = [
+    ('liquidity_rollup_1s', 1000, 1.0),
+    ('liquidity_rollup_10s', 10000, 10.0),
+]
+
+SIDE_CATEGORIES = ['bid', 'ask']
+
+# --- Phân vùng & lưu giữ dữ liệu ---
+DAY_MS = 24 * 60 * 60 * 1000
+ARCHIVE_DIR = 'heatmap_archive' # Thư mục chứa các file Parquet thô theo ngày (UTC)
+HOT_DAYS = 2 # Số ngày (tính cả hôm nay) giữ trong bảng nóng
+RAW_RETENTION_DAYS = 7 # Xóa file Parquet thô cũ hơn số ngày này
+# Thời gian giữ từng bảng rollup (ngày). Rollup 1s hết hạn thì vẫn còn bản 10s (downsample).
+ROLLUP_RETENTION_DAYS = {'liquidity_rollup_1s': 7, 'liquidity_rollup_10s': 90}
+
+
+def init_schema(db_conn, archive_dir=ARCHIVE_DIR):
+    """Tạo bảng thô, các bảng rollup, bảng watermark và bảng file lưu trữ (nếu chưa có)."""
+    db_conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {RAW_TABLE} (
+            timestamp_ms BIGINT,
+            price REAL,
+            quantity REAL,
+            side VARCHAR
+        )
+    """)
+    # Bảng nóng được ghi theo thứ tự thời gian nên zonemap (min/max từng row group) là đủ để lọc;
+    # index ART cũ chỉ làm chậm việc ghi -> bỏ đi.
+    db_conn.execute("DROP INDEX IF EXISTS idx_timestamp")
+    for table, _, _ in HEATMAP_ROLLUPS:
+        db_conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                time_bucket BIGINT,
+                price_bucket DOUBLE,
+                side VARCHAR,
+                quantity DOUBLE
+            )
+        """)
+    # watermark_ms: mọi dữ liệu có ô thời gian < watermark đã nằm trong bảng rollup
+    db_conn.execute("""
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            table_name VARCHAR PRIMARY KEY,
+            watermark_ms BIGINT
+        )
+    """)
+    has_archive_table = db_conn.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_name = ?", [ARCHIVE_FILES_TABLE]).fetchone()[0]
+    db_conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {ARCHIVE_FILES_TABLE} (
+            file_name VARCHAR PRIMARY KEY,
+            day BIGINT,
+            row_count BIGINT
+        )
+    """)
+    if not has_archive_table:
+        # Kho tạo trước khi có bảng ghi nhận: mọi file đang có là hợp lệ (các phần _N là dữ liệu đến muộn)
+        for path in list_archive_files(archive_dir):
+            name = os.path.basename(path)
+            row_count = db_conn.execute("SELECT COUNT(*) FROM read_parquet(?)", [path]).fetchone()[0]
+            db_conn.execute(f"INSERT INTO {ARCHIVE_FILES_TABLE} VALUES (?, ?, ?)", [name, _day_index(name[len('liquidity_'):len('liquidity_') + 10]), row_count])
+    db_conn.execute(f"CREATE VIEW IF NOT EXISTS {RAW_VIEW} AS SELECT * FROM {RAW_TABLE}")
+
+
+class LiquidityRollup:
+    """Duy trì 1 bảng rollup. Ô thời gian đang mở (>= watermark) được giữ trong bộ nhớ
+    cho tới khi có dữ liệu mới hơn, nên mỗi ô chỉ ghi ~1 lần thay vì 1 dòng mỗi lô."""
+
+    def __init__(self, table, time_ms, price_step, watermark_ms=0):
+        self.table = table; self.time_ms = time_ms; self.price_step = price_step
+        self.watermark_ms = watermark_ms
+        self.pending = None # DataFrame các ô chưa đóng (đã gộp)
+
+    def aggregate(self, frame):
+        """Gộp 1 lô thô (timestamp_ms, price, quantity, side) về độ phân giải của rollup."""
+        side = frame['side']
+        side_codes = side.cat.codes.to_numpy() if hasattr(side, 'cat') else (side.to_numpy() == 'ask').astype(np.int8)
+        df = pd.DataFrame({
+            'time_bucket': (frame['timestamp_ms'].to_numpy(dtype=np.int64) // self.time_ms) * self.time_ms,
+            'price_bucket': np.floor(frame['price'].to_numpy(dtype=np.float64) / self.price_step) * self.price_step,
+            'side': side_codes,
+            'quantity': frame['quantity'].to_numpy(dtype=np.float64),
+        })
+        return df.groupby(['time_bucket', 'price_bucket', 'side'], as_index=False, sort=False)['quantity'].sum()
+
+    def add(self, db_conn, frame):
+        """Thêm 1 lô đã ghi vào bảng thô; ghi các ô đã đóng vào rollup và tiến watermark."""
+        if frame.empty: return
+        agg = self.aggregate(frame)
+        if self.pending is not None and not self.pending.empty:
+            agg = pd.concat([self.pending, agg], ignore_index=True)
+            agg = agg.groupby(['time_bucket', 'price_bucket', 'side'], as_index=False, sort=False)['quantity'].sum()
+        new_watermark = max(self.watermark_ms, (int(frame['timestamp_ms'].max()) // self.time_ms) * self.time_ms)
+        is_done = agg['time_bucket'].to_numpy() < new_watermark
+        done = agg[is_done]; self.pending = agg[~is_done]
+        if done.empty and new_watermark == self.watermark_ms: return
+        done = done.assign(side=pd.Categorical.from_codes(done['side'].to_numpy(), SIDE_CATEGORIES))
+        db_conn.begin()
+        try:
+            if not done.empty: db_conn.append(self.table, done[['time_bucket', 'price_bucket', 'side', 'quantity']])
+            db_conn.execute("INSERT OR REPLACE INTO rollup_state VALUES (?, ?)", [self.table, new_watermark])
+            db_conn.commit()
+        except Exception:
+            db_conn.rollback(); raise
+        self.watermark_ms = new_watermark
+
+
+def load_rollups(db_conn):
+    """Khởi tạo các rollup khi luồng ghi khởi động: gộp nốt phần thô sau watermark cũ
+    (dữ liệu cũ / lần chạy trước tắt ngang) rồi trả về các đối tượng LiquidityRollup."""
+    rollups = []
+    max_ts = db_conn.execute(f"SELECT MAX(timestamp_ms) FROM {RAW_TABLE}").fetchone()[0]
+    for table, time_ms, price_step in HEATMAP_ROLLUPS:
+        row = db_conn.execute("SELECT watermark_ms FROM rollup_state WHERE table_name = ?", [table]).fetchone()
+        watermark = row[0] if row else 0
+        if max_ts is not None and max_ts >= watermark:
+            # Ô chứa max_ts cũng được đóng luôn: dữ liệu mới hơn (nếu rơi vào ô này) sẽ được cộng thêm dòng
+            new_watermark = (max_ts // time_ms) * time_ms + time_ms
+            db_conn.begin()
+            db_conn.execute(f"""
+                INSERT INTO {table}
+                SELECT (timestamp_ms // {time_ms}) * {time_ms}, FLOOR(CAST(price AS DOUBLE) / {price_step}) * {price_step}, side, SUM(quantity)
+                FROM {RAW_TABLE}
+                WHERE timestamp_ms >= {watermark}
+                GROUP BY 1, 2, 3
+            """)
+            db_conn.execute("INSERT OR REPLACE INTO rollup_state VALUES (?, ?)", [table, new_watermark])
+            db_conn.commit()
+            watermark = new_watermark
+        rollups.append(LiquidityRollup(table, time_ms, price_step, watermark))
+    return rollups
+
+
+def choose_rollup(time_bucket_ms, price_grouping):
+    """Rollup thô nhất mà vẫn chia hết yêu cầu (thời gian & giá); None = phải đọc bảng thô."""
+    best = None
+    for table, time_ms, price_step in HEATMAP_ROLLUPS:
+        if time_bucket_ms % time_ms != 0: continue
+        ratio = price_grouping / price_step
+        if abs(ratio - round(ratio)) > 1e-9 or round(ratio) < 1: continue
+        if best is None or time_ms * price_step > best[1] * best[2]:
+            best = (table, time_ms, price_step)
+    return best
+
+
+def build_heatmap_query(start_time_ms, price_grouping, min_liquidity, time_bucket_ms=1000, use_rollups=True, end_time_ms=None):
+    """Câu SQL heatmap lịch sử + tham số (dạng $tên): trả về (sql, params).
+    Kết quả: (time_bucket, price_bucket, side, total_quantity) trong [start, end), sắp theo thời gian.
+    end_time_ms nên là bội số của time_bucket_ms để ô thời gian cuối không bị cắt.
+    Ngưỡng min_liquidity áp dụng trên tổng đã gộp của từng ô (rollup không còn giữ từng dòng thô).
+    use_rollups=False: luôn quét bảng thô (dùng để đối chiếu / đo hiệu năng).
+    Chỉ tên bảng (hằng số trong module) được ghép vào chuỗi SQL, mọi giá trị đều là tham số."""
+    params = {
+        'start_ms': int(start_time_ms), 'g': float(price_grouping),
+        'min_liq': float(min_liquidity), 'tb': int(time_bucket_ms),
+        'end_ms': int(end_time_ms) if end_time_ms is not None else 2**62,
+    }
+    rollup = choose_rollup(time_bucket_ms, price_grouping) if use_rollups else None
+    if rollup is None:
+        source = f"""
+            SELECT timestamp_ms AS time_bucket, CAST(price AS DOUBLE) AS price_bucket, side, quantity
+            FROM {RAW_VIEW} WHERE timestamp_ms >= $start_ms AND timestamp_ms < $end_ms
+        """
+    else:
+        table, time_ms, price_step = rollup
+        params.update({'rollup_table': table, 'rollup_ms': time_ms, 'rollup_step': price_step,
+                       'rollup_start': (int(start_time_ms) // time_ms) * time_ms})
+        watermark = "COALESCE((SELECT watermark_ms FROM rollup_state WHERE table_name = $rollup_table), 0)"
+        source = f"""
+            SELECT time_bucket, price_bucket, side, quantity
+            FROM {table}
+            WHERE time_bucket >= $rollup_start AND time_bucket < {watermark} AND time_bucket < $end_ms
+            UNION ALL
+            SELECT (timestamp_ms // $rollup_ms) * $rollup_ms, FLOOR(CAST(price AS DOUBLE) / $rollup_step) * $rollup_step, side, quantity
+            FROM {RAW_TABLE}
+            WHERE timestamp_ms >= GREATEST($start_ms, {watermark}) AND timestamp_ms < $end_ms
+        """
+    sql = f"""
+        SELECT
+            (time_bucket // $tb) * $tb AS time_bucket,
+            FLOOR(price_bucket / $g) * $g AS price_bucket,
+            side,
+            SUM(quantity) AS total_quantity
+        FROM ({source}) AS src
+        GROUP BY 1, 2, 3
+        HAVING SUM(quantity) >= $min_liq
+        ORDER BY time_bucket, price_bucket, side
+    """
+    return sql, params
+
+
+# ==============================================================================
+# PHÂN VÙNG THEO NGÀY & LƯU GIỮ (chạy trên luồng ghi CSDL)
+# ==============================================================================
+def _day_str(day_index):
+    return datetime.fromtimestamp(day_index * DAY_MS / 1000, tz=timezone.utc).strftime('%Y-%m-%d')
+
+def _day_index(day_str):
+    return int(datetime.strptime(day_str, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp() * 1000) // DAY_MS
+
+def _sql_file_list(paths):
+    return ", ".join("'" + path.replace("'", "''") + "'" for path in paths)
+
+def list_archive_files(archive_dir=ARCHIVE_DIR):
+    """Các file phân vùng có trên đĩa (kể cả file chưa ghi nhận), sắp theo ngày. Tên: liquidity_YYYY-MM-DD[_N].parquet"""
+    return sorted(glob.glob(os.path.join(archive_dir, 'liquidity_*.parquet')))
+
+def recorded_archive_files(db_conn, days=None):
+    """{tên file: ngày} của các file đã ghi nhận (chỉ các ngày trong days nếu có)."""
+    rows = db_conn.execute(f"SELECT file_name, day FROM {ARCHIVE_FILES_TABLE} ORDER BY day, file_name").fetchall()
+    return {name: day for name, day in rows if days is None or day in days}
+
+def refresh_raw_view(db_conn, archive_dir=ARCHIVE_DIR):
+    """Dựng lại view thô = bảng nóng + các file Parquet ĐÃ GHI NHẬN (file lạ trên đĩa bị bỏ qua)."""
+    files = [os.path.join(archive_dir, name) for name in recorded_archive_files(db_conn)]
+    if files:
+        db_conn.execute(f"CREATE OR REPLACE VIEW {RAW_VIEW} AS SELECT * FROM {RAW_TABLE} UNION ALL SELECT * FROM read_parquet([{_sql_file_list(files)}])")
+    else:
+        db_conn.execute(f"CREATE OR REPLACE VIEW {RAW_VIEW} AS SELECT * FROM {RAW_TABLE}")
+
+def remove_unrecorded_archive_files(db_conn, archive_dir=ARCHIVE_DIR):
+    """Chạy lúc khởi động: xóa file Parquet / .tmp không có trong bảng ghi nhận (phần sót lại của lần lưu trữ
+    chết giữa chừng: dữ liệu của nó vẫn còn trong bảng nóng / file cũ), bỏ bản ghi của file đã mất rồi dựng lại view.
+    Trả về {'removed_files': số file lạ đã xóa, 'missing_files': số file ghi nhận nhưng không còn trên đĩa}."""
+    recorded = recorded_archive_files(db_conn)
+    removed = 0
+    for path in list_archive_files(archive_dir) + glob.glob(os.path.join(archive_dir, 'liquidity_*.parquet.tmp')):
+        if os.path.basename(path) not in recorded:
+            os.remove(path); removed += 1
+    missing = [name for name in recorded if not os.path.exists(os.path.join(archive_dir, name))]
+    db_conn.begin()
+    try:
+        for name in missing: db_conn.execute(f"DELETE FROM {ARCHIVE_FILES_TABLE} WHERE file_name = ?", [name])
+        refresh_raw_view(db_conn, archive_dir)
+        db_conn.commit()
+    except Exception:
+        db_conn.rollback(); raise
+    return {'removed_files': removed, 'missing_files': len(missing)}
+
+def _remove_file(path):
+    try: os.remove(path)
+    except FileNotFoundError: pass
+
+def _new_archive_name(archive_dir, day, taken):
+    base = f"liquidity_{_day_str(day)}"; name = base + '.parquet'; part = 1
+    while name in taken or os.path.exists(os.path.join(archive_dir, name)):
+        name = f"{base}_{part}.parquet"; part += 1
+    return name
+
+def archive_raw_partitions(db_conn, rollups, now_ms, archive_dir=ARCHIVE_DIR, hot_days=HOT_DAYS):
+    """Chuyển các ngày cũ (ngoài cửa sổ nóng VÀ đã được mọi rollup gộp xong) từ bảng nóng
+    sang file Parquet nén ZSTD (1 file mỗi ngày), rồi xóa khỏi bảng nóng. Trả về danh sách file đã ghi.
+    Dữ liệu đến muộn của ngày đã lưu trữ được gộp với file cũ thành file MỚI (thay file cũ, không thêm bản sao).
+    Ghi nhận file mới, bỏ file cũ, xóa dòng khỏi bảng nóng và dựng lại view nằm trong 1 transaction:
+    chết trước commit thì file mới chỉ là file lạ (bị xóa khi khởi động), dữ liệu không bị đếm 2 lần."""
+    cutoff = (now_ms // DAY_MS - (hot_days - 1)) * DAY_MS
+    if rollups: cutoff = min(cutoff, (min(r.watermark_ms for r in rollups) // DAY_MS) * DAY_MS)
+    days = [row[0] for row in db_conn.execute(
+        f"SELECT DISTINCT timestamp_ms // {DAY_MS} FROM {RAW_TABLE} WHERE timestamp_ms < ? ORDER BY 1", [cutoff]).fetchall()]
+    written = []
+    if not days: return written
+    os.makedirs(archive_dir, exist_ok=True)
+    for day in days:
+        old_names = list(recorded_archive_files(db_conn, {day}))
+        name = _new_archive_name(archive_dir, day, old_names)
+        path = os.path.join(archive_dir, name); tmp_path = path + '.tmp'
+        day_start, day_end = day * DAY_MS, (day + 1) * DAY_MS
+        source = f"SELECT * FROM {RAW_TABLE} WHERE timestamp_ms >= {day_start} AND timestamp_ms < {day_end}"
+        if old_names: source += f" UNION ALL SELECT * FROM read_parquet([{_sql_file_list([os.path.join(archive_dir, n) for n in old_names])}])"
+        row_count = db_conn.execute(f"""
+            COPY (SELECT * FROM ({source}) ORDER BY timestamp_ms)
+            TO '{tmp_path.replace("'", "''")}' (FORMAT PARQUET, COMPRESSION ZSTD)
+        """).fetchone()[0]
+        os.replace(tmp_path, path)
+        db_conn.begin()
+        try:
+            db_conn.execute(f"DELETE FROM {ARCHIVE_FILES_TABLE} WHERE day = ?", [day])
+            db_conn.execute(f"INSERT INTO {ARCHIVE_FILES_TABLE} VALUES (?, ?, ?)", [name, day, row_count])
+            db_conn.execute(f"DELETE FROM {RAW_TABLE} WHERE timestamp_ms >= ? AND timestamp_ms < ?", [day_start, day_end])
+            refresh_raw_view(db_conn, archive_dir)
+            db_conn.commit()
+        except Exception:
+            db_conn.rollback(); os.remove(path); raise
+        for old_name in old_names: _remove_file(os.path.join(archive_dir, old_name))
+        written.append(path)
+    return written
+
+def expired_archive_files(db_conn, now_ms, raw_retention_days=RAW_RETENTION_DAYS):
+    """Tên các file Parquet thô đã ghi nhận có ngày cũ hơn hạn lưu giữ."""
+    oldest_kept = now_ms // DAY_MS - raw_retention_days + 1
+    return [name for name, day in recorded_archive_files(db_conn).items() if day < oldest_kept]
+
+def apply_rollup_retention(db_conn, now_ms, rollup_retention_days=None):
+    """Xóa các dòng rollup quá hạn (rollup mịn hết hạn sớm, rollup thô giữ lâu). Trả về số dòng đã xóa."""
+    rollup_retention_days = ROLLUP_RETENTION_DAYS if rollup_retention_days is None else rollup_retention_days
+    today = now_ms // DAY_MS
+    removed_rows = 0
+    for table, _, _ in HEATMAP_ROLLUPS:
+        days = rollup_retention_days.get(table)
+        if days is None: continue
+        removed_rows += db_conn.execute(f"DELETE FROM {table} WHERE time_bucket < ?", [(today - days + 1) * DAY_MS]).fetchone()[0]
+    return removed_rows
+
+def run_storage_maintenance(db_conn, rollups, now_ms=None, archive_dir=ARCHIVE_DIR):
+    """Lưu trữ phân vùng cũ + áp dụng hạn lưu giữ + dựng lại view. Trả về dict tóm tắt."""
+    if now_ms is None: now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+    written = archive_raw_partitions(db_conn, rollups, now_ms, archive_dir)
+    expired = expired_archive_files(db_conn, now_ms)
+    if expired:
+        # Bỏ ghi nhận + view phải bỏ các file sắp xóa TRƯỚC khi xóa, nếu không truy vấn qua view sẽ lỗi
+        db_conn.begin()
+        try:
+            for name in expired: db_conn.execute(f"DELETE FROM {ARCHIVE_FILES_TABLE} WHERE file_name = ?", [name])
+            refresh_raw_view(db_conn, archive_dir)
+            db_conn.commit()
+        except Exception:
+            db_conn.rollback(); raise
+        for name in expired: _remove_file(os.path.join(archive_dir, name))
+    removed_rows = apply_rollup_retention(db_conn, now_ms)
+    return {'archived_files': written, 'removed_files': len(expired), 'removed_rollup_rows': removed_rows}
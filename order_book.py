@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# FILE: order_book.py
+# Cấu trúc 1 phía sổ lệnh live (giá -> (khối lượng, thời điểm)) cho frontend.
+# Giá giữ trong list đã sắp xếp (bisect), max khối lượng và mức cũ nhất lấy từ heap
+# xóa lười (entry cũ bị bỏ qua khi nổi lên đỉnh), nên mỗi level của 1 message depth
+# tốn O(log n) thay vì quét lại toàn bộ sổ.
+# ScaleBuckets: tổng khối lượng của sổ theo từng hàng của thang giá (cho pane COB),
+# cập nhật theo delta + cây max theo đoạn để lấy max của các hàng đang thấy.
+
+from bisect import bisect_left, bisect_right, insort
+from heapq import heapify, heappop, heappush
+
+import numpy as np
+
+# Heap được dựng lại khi số entry cũ vượt quá số level thật quá nhiều
+HEAP_COMPACT_FACTOR = 4
+HEAP_COMPACT_MIN = 1024
+
+
+class OrderBookSide:
+    """1 phía (bid hoặc ask) của sổ lệnh live.
+    Hỗ trợ: cập nhật / xóa 1 giá, max khối lượng, xóa theo khoảng giá, xóa mức cũ hơn 1 mốc thời gian
+    và duyệt theo giá giảm dần trong 1 khoảng. items() giữ dạng (giá, (khối lượng, thời điểm)) như dict cũ."""
+
+    def __init__(self):
+        self._levels = {}       # giá -> (khối lượng, thời điểm)
+        self._prices = []       # giá tăng dần
+        self._qty_heap = []     # (-khối lượng, giá)
+        self._time_heap = []    # (thời điểm, giá)
+
+    def __len__(self): return len(self._levels)
+    def __bool__(self): return bool(self._levels)
+    def __contains__(self, price): return price in self._levels
+    def __getitem__(self, price): return self._levels[price]
+    def get(self, price, default=None): return self._levels.get(price, default)
+    def items(self): return self._levels.items()
+    def values(self): return self._levels.values()
+
+    def set(self, price, qty, timestamp):
+        if price not in self._levels: insort(self._prices, price)
+        self._levels[price] = (qty, timestamp)
+        heappush(self._qty_heap, (-qty, price)); heappush(self._time_heap, (timestamp, price))
+        if len(self._qty_heap) > max(HEAP_COMPACT_MIN, HEAP_COMPACT_FACTOR * len(self._levels)): self._compact()
+
+    def discard(self, price):
+        if self._levels.pop(price, None) is None: return False
+        del self._prices[bisect_left(self._prices, price)]
+        return True
+
+    def clear(self):
+        self._levels.clear(); self._prices.clear(); self._qty_heap.clear(); self._time_heap.clear()
+
+    def _compact(self):
+        self._qty_heap = [(-qty, p) for p, (qty, _) in self._levels.items()]; heapify(self._qty_heap)
+        self._time_heap = [(ts, p) for p, (_, ts) in self._levels.items()]; heapify(self._time_heap)
+
+    def max_qty(self):
+        """Khối lượng lớn nhất hiện có (0 nếu trống)."""
+        heap = self._qty_heap
+        while heap:
+            neg_qty, price = heap[0]
+            level = self._levels.get(price)
+            if level is not None and level[0] == -neg_qty: return -neg_qty
+            heappop(heap)
+        return 0
+
+    def remove_range(self, low, high):
+        """Xóa mọi giá trong [low, high]. Trả về list (giá, khối lượng, thời điểm) đã xóa."""
+        i, j = bisect_left(self._prices, low), bisect_right(self._prices, high)
+        removed = [(p,) + self._levels.pop(p) for p in self._prices[i:j]]
+        if removed: del self._prices[i:j]
+        return removed
+
+    def expire_before(self, cutoff_ts):
+        """Xóa các mức có thời điểm cập nhật cuối < cutoff_ts. Trả về list giá đã xóa."""
+        heap = self._time_heap; removed = []
+        while heap and heap[0][0] < cutoff_ts:
+            ts, price = heappop(heap)
+            level = self._levels.get(price)
+            if level is not None and level[1] == ts:
+                self.discard(price); removed.append(price)
+        return removed
+
+    def iter_desc(self, low=None, high=None):
+        """Duyệt (giá, khối lượng, thời điểm) theo giá giảm dần, chỉ trong [low, high] nếu có."""
+        prices = self._prices
+        start = bisect_left(prices, low) if low is not None else 0
+        i = (bisect_right(prices, high) if high is not None else len(prices)) - 1
+        while i >= start:
+            price = prices[i]; qty, ts = self._levels[price]
+            yield price, qty, ts
+            i -= 1
+
+
+def new_live_book():
+    """Sổ lệnh live 2 phía: {'bid': OrderBookSide, 'ask': OrderBookSide}."""
+    return {'bid': OrderBookSide(), 'ask': OrderBookSide()}
+
+
+class RangeMax:
+    """Cây phân đoạn (segment tree) lấy max: đổi 1 phần tử O(log n), max của đoạn [lo, hi] O(log n)."""
+
+    def __init__(self, values):
+        n = len(values); size = 1
+        while size < n: size *= 2
+        tree = np.zeros(2 * size, dtype=np.float64); tree[size:size + n] = values
+        level = size
+        while level > 1:
+            half = level // 2
+            tree[half:level] = np.maximum(tree[level:2 * level:2], tree[level + 1:2 * level:2])
+            level = half
+        self._size = size; self._tree = tree.tolist() # list Python: cập nhật từng phần tử nhanh hơn ndarray
+
+    def update(self, i, value):
+        tree = self._tree; i += self._size; tree[i] = value; i //= 2
+        while i:
+            best = tree[2 * i] if tree[2 * i] > tree[2 * i + 1] else tree[2 * i + 1]
+            if tree[i] == best: break # Tổ tiên không đổi nữa
+            tree[i] = best; i //= 2
+
+    def query(self, lo, hi):
+        """Max của phần tử lo..hi (bao gồm 2 đầu); 0 nếu đoạn rỗng."""
+        tree = self._tree; best = 0.0
+        lo += self._size; hi += self._size + 1
+        while lo < hi:
+            if lo & 1:
+                if tree[lo] > best: best = tree[lo]
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                if tree[hi] > best: best = tree[hi]
+            lo //= 2; hi //= 2
+        return best
+
+
+class ScaleBuckets:
+    """Tổng khối lượng bid / ask của sổ lệnh theo từng hàng của thang giá (giá giảm dần, bước group_by).
+    Giá p của sổ rơi vào hàng int(p / group_by) * group_by (như COB cũ). rebuild() tính lại toàn bộ bằng NumPy
+    (khi thang giá đổi), apply() cộng delta của 1 mức giá, max_in_rows() trả max của 1 đoạn hàng."""
+
+    def __init__(self):
+        self.top_price = None; self.group_by = 1; self.n_rows = 0
+        self.qty = {'bid': np.zeros(0), 'ask': np.zeros(0)}
+        self._max = {'bid': RangeMax([]), 'ask': RangeMax([])}
+
+    def row_of(self, price):
+        return int(round((self.top_price - int(price / self.group_by) * self.group_by) / self.group_by))
+
+    def rebuild(self, book, top_price, group_by, n_rows):
+        self.top_price, self.group_by, self.n_rows = top_price, group_by, n_rows
+        for side in ('bid', 'ask'):
+            levels = book.get(side) if book else None
+            count = len(levels) if levels else 0
+            prices = np.fromiter((p for p, _ in levels.items()) if count else (), dtype=np.float64, count=count)
+            qtys = np.fromiter((v[0] for v in levels.values()) if count else (), dtype=np.float64, count=count)
+            rows = np.round((top_price - np.trunc(prices / group_by) * group_by) / group_by).astype(np.int64)
+            inside = (rows >= 0) & (rows < n_rows)
+            self.qty[side] = np.bincount(rows[inside], weights=qtys[inside], minlength=n_rows)[:n_rows]
+            self._max[side] = RangeMax(self.qty[side])
+
+    def apply(self, side, price, delta):
+        if self.top_price is None: return
+        row = self.row_of(price)
+        if not 0 <= row < self.n_rows: return
+        qty = self.qty[side]; value = qty[row] + delta
+        if abs(value) < 1e-9: value = 0.0 # Tránh sai số cộng / trừ dồn lại thành số âm / rất nhỏ
+        qty[row] = value; self._max[side].update(row, value)
+
+    def max_in_rows(self, side, first_row, last_row):
+        first_row, last_row = max(0, first_row), min(self.n_rows - 1, last_row)
+        return self._max[side].query(first_row, last_row) if first_row <= last_row else 0.0
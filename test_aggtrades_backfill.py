@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# FILE: test_aggtrades_backfill.py
+# Kiểm tra AggTradesBackfill với server aggTrades giả lập chạy ở máy (aiohttp): chạy bằng `python -m pytest -q`.
+# FakeAggTradesServer cũng được benchmarks.py dùng để đo tốc độ tải (bench_backfill).
+
+import os
+import json
+import time
+import asyncio
+
+import numpy as np
+import pytest
+from aiohttp import web
+
+from trade_archive import TradeArchive, records_to_trades
+from aggtrades_backfill import AggTradesBackfill, WeightBudget, STATE_NAME
+
+
+class FakeAggTradesServer:
+    """Server giả lập /api/v3/aggTrades: phân trang theo fromId / startTime, header X-MBX-USED-WEIGHT-1M,
+    trả 429 + Retry-After khi vượt weight_limit trong 1 cửa sổ window_s.
+    requests_log: (thời điểm, query, status) của mọi request; fail_after: trả 400 từ request thứ fail_after + 1;
+    fail_from_ids: trả 400 cho request có fromId thuộc tập này (chỉ 1 shard lỗi, các shard khác vẫn tải được)."""
+    def __init__(self, n_trades, latency_s=0.02, weight_limit=400, window_s=1.0, first_id=10_000_000, retry_after='1'):
+        rng = np.random.default_rng(5)
+        self.ids = np.arange(first_id, first_id + n_trades, dtype=np.int64)
+        self.times = 1_700_000_000_000 + np.cumsum(rng.integers(0, 40, n_trades))
+        self.prices = np.round(60000 + np.cumsum(rng.normal(0, 2, n_trades)), 2); self.qtys = np.round(rng.exponential(0.05, n_trades), 5)
+        self.makers = rng.random(n_trades) < 0.5
+        self.latency_s = latency_s; self.weight_limit = weight_limit; self.window_s = window_s; self.retry_after = retry_after
+        self.window = None; self.used = 0; self.requests = 0; self.rejected = 0
+        self.fail_after = None; self.fail_from_ids = set(); self.requests_log = []
+        self.runner = None; self.url = None
+
+    def page(self, lo, hi):
+        return [{'a': a, 'p': f"{p:.2f}", 'q': f"{q:.5f}", 'f': a, 'l': a, 'T': T, 'm': m, 'M': True} for a, p, q, T, m in zip(
+            self.ids[lo:hi].tolist(), self.prices[lo:hi].tolist(), self.qtys[lo:hi].tolist(), self.times[lo:hi].tolist(), self.makers[lo:hi].tolist())]
+
+    async def handle(self, request):
+        self.requests += 1
+        query = request.query
+        if (self.fail_after is not None and self.requests > self.fail_after) or int(query.get('fromId', -1)) in self.fail_from_ids:
+            self.requests_log.append((time.time(), dict(query), 400))
+            return web.Response(status=400, text='{"code":-1000}')
+        window = int(time.time() // self.window_s)
+        if window != self.window: self.window = window; self.used = 0
+        self.used += 2
+        headers = {'X-MBX-USED-WEIGHT-1M': str(self.used)}
+        if self.used > self.weight_limit:
+            self.rejected += 1; self.requests_log.append((time.time(), dict(query), 429))
+            return web.Response(status=429, text='{"code":-1003}', headers=dict(headers, **{'Retry-After': self.retry_after}))
+        self.requests_log.append((time.time(), dict(query), 200))
+        await asyncio.sleep(self.latency_s)
+        limit = min(int(query.get('limit', 500)), 1000)
+        if 'fromId' in query: lo = int(np.searchsorted(self.ids, int(query['fromId'])))
+        elif 'startTime' in query:
+            lo = int(np.searchsorted(self.times, int(query['startTime'])))
+            limit = min(limit, int(np.searchsorted(self.times, int(query['endTime']), side='right')) - lo)
+        else: lo = max(len(self.ids) - limit, 0)
+        return web.json_response(self.page(lo, lo + max(limit, 0)), headers=headers)
+
+    async def start(self):
+        app = web.Application(); app.router.add_get('/api/v3/aggTrades', self.handle)
+        self.runner = web.AppRunner(app); await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0); await site.start()
+        self.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def _with_server(server, scenario):
+    """Chạy coroutine scenario(server) trong 1 event loop, server giả lập bật trong suốt thời gian đó."""
+    async def run():
+        await server.start()
+        try: return await scenario(server)
+        finally: await server.stop()
+    return asyncio.run(run())
+
+
+def _backfill(server, archive, **kwargs):
+    kwargs.setdefault('budget', WeightBudget(10_000, safety=1.0))
+    return AggTradesBackfill('BTCUSDT', archive, base_url=server.url, log=lambda m: None, **kwargs)
+
+
+def _archived_ids(archive):
+    trades, _, _ = TradeArchive(archive.archive_dir).read_since(None)
+    return trades['a']
+
+
+def test_weight_budget_waits_out_pause():
+    budget = WeightBudget(100, safety=1.0)
+
+    async def run():
+        budget.pause(0.2); started = time.perf_counter()
+        await budget.acquire(2)
+        return time.perf_counter() - started
+    assert asyncio.run(run()) >= 0.19
+    assert budget.waits == 1 and budget.used == 2
+
+
+def test_429_pauses_requests_for_retry_after(tmp_path):
+    server = FakeAggTradesServer(6_000, latency_s=0.0, weight_limit=6, window_s=0.2, retry_after='0.3')
+    archive = TradeArchive(str(tmp_path))
+
+    async def scenario(server):
+        backfill = _backfill(server, archive, concurrency=1, shard_pages=2)
+        await backfill.run(int(server.times[0]))
+        return backfill
+    backfill = _with_server(server, scenario)
+
+    assert server.rejected > 0 and backfill.stats['rate_limited'] == server.rejected
+    # 1 luồng: sau mỗi 429, request kế tiếp chỉ được gửi khi hết Retry-After
+    log = server.requests_log
+    for (t, _, status), (t_next, _, _) in zip(log, log[1:]):
+        if status == 429: assert t_next - t >= 0.29
+    assert np.array_equal(_archived_ids(archive), server.ids)
+
+
+def test_resume_from_state_after_failure(tmp_path):
+    server = FakeAggTradesServer(30_000, latency_s=0.0, weight_limit=10_000)
+    archive = TradeArchive(str(tmp_path))
+    state_path = os.path.join(str(tmp_path), STATE_NAME)
+
+    async def scenario(server):
+        first = _backfill(server, archive, concurrency=1, shard_pages=5, flush_rows=2_000)
+        server.fail_after = 15 # Chết giữa shard thứ 3 (lỗi 4xx không thử lại)
+        with pytest.raises(RuntimeError): await first.run(int(server.times[0]))
+        with open(state_path, 'r', encoding='utf-8') as f: state = json.load(f)
+        server.fail_after = None; n_logged = len(server.requests_log)
+        second = _backfill(server, archive, concurrency=1, shard_pages=5, flush_rows=2_000)
+        await second.run(int(server.times[0]))
+        return first, second, state, server.requests_log[n_logged:]
+    first, second, state, resumed_log = _with_server(server, scenario)
+
+    shards = state['shards']
+    assert state['first_id'] == server.ids[0] and state['last_id'] == server.ids[-1]
+    assert any(s['done'] for s in shards) and not all(s['done'] for s in shards)
+    # Lần sau chỉ tải từ con trỏ đã ghi xong của từng shard: không tải lại, không thiếu
+    resumed_from = {int(q['fromId']) for _, q, _ in resumed_log if 'fromId' in q}
+    for shard in shards:
+        if shard['done']: assert not any(shard['start'] <= i <= shard['end'] for i in resumed_from)
+        else: assert shard['cursor'] in resumed_from and not any(shard['start'] <= i < shard['cursor'] for i in resumed_from)
+    assert first.stats['rows'] > 0 and first.stats['rows'] + second.stats['rows'] == len(server.ids)
+    assert np.array_equal(_archived_ids(archive), server.ids)
+    assert not os.path.exists(state_path)
+
+
+def test_failed_shard_stops_other_workers(tmp_path):
+    """1 shard gặp lỗi 4xx: run() báo lỗi SAU KHI các luồng khác đã dừng hẳn - không còn request,
+    không ghi thêm vào kho / backfill_state.json; lần sau tiếp tục đúng từ đó."""
+    server = FakeAggTradesServer(40_000, latency_s=0.01, weight_limit=10_000)
+    archive = TradeArchive(str(tmp_path))
+    state_path = os.path.join(str(tmp_path), STATE_NAME)
+
+    def snapshot():
+        with open(state_path, 'rb') as f: state = f.read()
+        return state, TradeArchive(str(tmp_path)).manifest, len(server.requests_log)
+
+    async def scenario(server):
+        first = _backfill(server, archive, concurrency=4, shard_pages=2, flush_rows=1_000)
+        server.fail_from_ids = {int(server.ids[7_000])} # Trang thứ 2 của shard thứ 4 (id 6000..7999) lỗi
+        with pytest.raises(RuntimeError): await first.run(int(server.times[0]))
+        workers = [t for t in asyncio.all_tasks() if not t.done() and '_run_plan' in t.get_coro().__qualname__]
+        before = snapshot()
+        await asyncio.sleep(0.3)
+        after = snapshot()
+        server.fail_from_ids = set()
+        second = _backfill(server, archive, concurrency=4, shard_pages=2, flush_rows=1_000)
+        await second.run(int(server.times[0]))
+        return first, second, workers, before, after
+    first, second, workers, before, after = _with_server(server, scenario)
+
+    assert workers == [] and before == after
+    assert 0 < first.stats['rows'] < len(server.ids)
+    assert first.stats['rows'] + second.stats['rows'] == len(server.ids) # Không tải lại phần đã ghi
+    assert np.array_equal(_archived_ids(archive), server.ids)
+
+
+def test_plans_from_archived_last_id(tmp_path):
+    server = FakeAggTradesServer(12_000, latency_s=0.0, weight_limit=10_000)
+    archive = TradeArchive(str(tmp_path))
+    archive.append(records_to_trades(server.page(0, 7_500)))
+
+    async def scenario(server):
+        backfill = _backfill(server, archive, concurrency=4, shard_pages=1)
+        await backfill.run(int(server.times[0]))
+        return backfill
+    backfill = _with_server(server, scenario)
+
+    from_ids = [int(q['fromId']) for _, q, _ in server.requests_log if 'fromId' in q]
+    assert min(from_ids) == server.ids[7_500] # archive.last_id() + 1, không tìm lại theo thời gian
+    assert not any('startTime' in q for _, q, _ in server.requests_log)
+    assert backfill.stats['rows'] == 4_500
+    assert np.array_equal(_archived_ids(archive), server.ids)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# FILE: test_candle_engine.py
+# Kiểm tra FootprintCandleEngine (candle_engine.py): chạy bằng `python -m pytest -q`.
+# So khớp với logic process_trade cũ (benchmarks.LegacyCandleBuilder: pandas + dict lồng nhau).
+
+import pytest
+
+from candle_engine import FootprintCandleEngine
+from benchmarks import LegacyCandleBuilder, make_trades, TIMEFRAMES_MS, DEFAULT_PRICE_GROUPING
+
+MINUTE = 60 * 1000
+T0 = 1_700_000_100_000 # Đầu 1 nến 5 phút
+
+
+def _engine(grouping=None, history_limit=200):
+    return FootprintCandleEngine({'1M': MINUTE, '5M': 5 * MINUTE}, grouping or {'1M': 5, '5M': 10}, history_limit)
+
+
+def _add(engine, trades):
+    closed = []
+    for T, p, q, m in trades: closed += engine.add_trade(T, p, q, m)
+    return closed
+
+
+def test_bucket_rollover():
+    engine = _engine()
+    assert _add(engine, [(T0 + 100, 100.0, 1.0, True), (T0 + 30_000, 104.0, 2.0, False), (T0 + MINUTE - 1, 99.0, 0.5, True)]) == []
+    candle = engine.current_candle('1M')
+    assert candle['timestamp'] == T0 and candle['time'] == '22:15'
+    assert (candle['open'], candle['high'], candle['low'], candle['close'], candle['totalVolume']) == (100.0, 104.0, 99.0, 99.0, 3.5)
+    assert candle['levels'] == [[100, 1.0, 2.0], [95, 0.5, 0.0]] # Ô 5 USD, giá giảm dần: [giá, bid, ask]
+
+    # Trade đầu phút kế tiếp đóng nến 1M (5M vẫn mở); open = close nến trước, high/low từ trade đầu tiên
+    assert engine.add_trade(T0 + MINUTE, 101.0, 1.0, False) == ['1M']
+    candle = engine.current_candle('1M')
+    assert candle['timestamp'] == T0 + MINUTE and (candle['open'], candle['high'], candle['low']) == (99.0, 101.0, 101.0)
+    # Nhảy qua nhiều phút không có trade: nến mới bắt đầu ở mốc của trade, không sinh nến rỗng
+    assert engine.add_trade(T0 + 7 * MINUTE + 5, 102.0, 1.0, False) == ['1M', '5M']
+    assert [c['timestamp'] for c in engine.full_history('1M')] == [T0, T0 + MINUTE, T0 + 7 * MINUTE]
+    assert engine.current_candle('5M')['timestamp'] == T0 + 7 * MINUTE - (T0 + 7 * MINUTE) % (5 * MINUTE)
+
+
+def test_closed_candles_reported_once():
+    engine = _engine()
+    _add(engine, [(T0, 100.0, 1.0, True), (T0 + 10, 101.0, 1.0, False)])
+    updates, deltas, closed = engine.take_updates()
+    assert set(updates) == {'1M', '5M'} and deltas == {} and closed == {}
+    assert engine.take_updates() == ({}, {}, {}) # Không đổi gì -> không gửi
+
+    _add(engine, [(T0 + MINUTE, 102.0, 1.0, True), (T0 + 2 * MINUTE, 103.0, 1.0, True)])
+    updates, _, closed = engine.take_updates()
+    assert list(closed) == ['1M'] and [c['timestamp'] for c in closed['1M']] == [T0, T0 + MINUTE]
+    assert closed['1M'][0]['close'] == 101.0 and closed['1M'][1]['open'] == 101.0 # Trạng thái cuối của nến đã đóng
+    assert updates['1M']['timestamp'] == T0 + 2 * MINUTE
+    assert list(engine.recent_candles['1M']) == closed['1M']
+    assert engine.take_updates()[2] == {}
+
+
+def test_history_limit_keeps_latest_closed_candles():
+    engine = _engine(history_limit=3)
+    _add(engine, [(T0 + i * MINUTE, 100.0 + i, 1.0, True) for i in range(6)])
+    assert [c['timestamp'] for c in engine.full_history('1M')] == [T0 + i * MINUTE for i in (2, 3, 4, 5)]
+
+
+def test_delta_vs_full_after_regroup():
+    engine = _engine()
+    _add(engine, [(T0, 100.0, 1.0, True), (T0 + 1, 112.0, 2.0, False)])
+    _, deltas, _ = engine.take_updates(with_full=False, with_delta=True)
+    assert deltas['1M']['full'] is True and deltas['1M']['levels'] == [[110, 0.0, 2.0], [100, 1.0, 0.0]] # Nến mới: đầy đủ
+
+    engine.add_trade(T0 + 2, 113.0, 0.5, True)
+    updates, deltas, _ = engine.take_updates(with_full=True, with_delta=True)
+    assert deltas['1M']['full'] is False and deltas['1M']['levels'] == [[110, 0.5, 2.0]] # Chỉ ô đã đổi, giá trị tuyệt đối
+    assert updates['1M']['levels'] == [[110, 0.5, 2.0], [100, 1.0, 0.0]]
+
+    # Regroup: cả nến đang mở phải gửi lại đầy đủ theo grouping mới (kể cả khi không có trade mới)
+    engine.set_price_grouping({'1M': 25})
+    updates, deltas, _ = engine.take_updates(with_full=True, with_delta=True)
+    assert deltas['1M']['full'] is True and deltas['1M']['levels'] == updates['1M']['levels'] == [[100, 1.5, 2.0]]
+    assert '5M' not in deltas # Grouping 5M không đổi
+
+    engine.add_trade(T0 + 3, 126.0, 1.0, False)
+    _, deltas, _ = engine.take_updates(with_full=False, with_delta=True)
+    assert deltas['1M']['full'] is False and deltas['1M']['levels'] == [[125, 0.0, 1.0]]
+
+
+def test_take_updates_without_delta_resets_pending_changes():
+    engine = _engine()
+    engine.add_trade(T0, 100.0, 1.0, True)
+    engine.take_updates(with_full=True, with_delta=False)
+    engine.add_trade(T0 + 1, 120.0, 1.0, True)
+    _, deltas, _ = engine.take_updates(with_full=False, with_delta=True)
+    assert deltas['1M']['full'] is False and deltas['1M']['levels'] == [[120, 1.0, 0.0]]
+
+
+def test_matches_legacy_builder():
+    trades = make_trades(5_000)
+    legacy = LegacyCandleBuilder(DEFAULT_PRICE_GROUPING.copy())
+    engine = FootprintCandleEngine(TIMEFRAMES_MS, DEFAULT_PRICE_GROUPING.copy(), history_limit=None)
+    for trade in trades:
+        legacy.add_trade(trade)
+        engine.add_trade(int(trade['T']), float(trade['p']), float(trade['q']), trade['m'])
+    for tf in TIMEFRAMES_MS:
+        assert engine.full_history(tf) == legacy.recent_candles[tf] + [legacy.format_candle(legacy.current_candles[tf])], tf
+
+
+def test_regroup_matches_legacy_grouping():
+    """Regroup nến đang mở sang grouping thô hơn = dựng lại nến đó từ đầu với grouping mới."""
+    trades = make_trades(3_000, seed=7)
+    tf_trades = [t for t in trades if int(t['T']) // MINUTE == int(trades[-1]['T']) // MINUTE] # Các trade của nến 1M cuối
+    engine = FootprintCandleEngine(TIMEFRAMES_MS, DEFAULT_PRICE_GROUPING.copy())
+    for trade in trades: engine.add_trade(int(trade['T']), float(trade['p']), float(trade['q']), trade['m'])
+    engine.set_price_grouping({'1M': 25})
+    legacy = LegacyCandleBuilder(dict(DEFAULT_PRICE_GROUPING, **{'1M': 25}))
+    for trade in tf_trades: legacy.add_trade(trade)
+    expected = legacy.format_candle(legacy.current_candles['1M'])
+    candle = engine.current_candle('1M')
+    assert [level[0] for level in candle['levels']] == [level[0] for level in expected['levels']]
+    assert [level[1:] for level in candle['levels']] == [pytest.approx(level[1:], abs=1e-4) for level in expected['levels']]
+
+
+def _same_ms_trades():
+    """Trade có nhiều trade cùng mili giây (aggTrade khác id nhưng cùng T), trải qua vài nến 1M."""
+    trades = []
+    for i in range(400):
+        T = T0 + (i // 4) * 1_500 # 4 trade mỗi mốc thời gian
+        trades.append((T, 100.0 + (i * 7) % 23, 0.25 + (i % 5) * 0.5, i % 3 == 0))
+    return trades
+
+
+def _load(engine, trades):
+    ts, prices, qtys, makers = zip(*trades)
+    engine.load_history(ts, prices, qtys, makers)
+
+
+def _full_histories(engine):
+    return {tf: engine.full_history(tf) for tf in ('1M', '5M')}
+
+
+@pytest.mark.parametrize('cut, replay_from', [
+    (202, 190), # Cắt giữa nhóm cùng mili giây, trade live phát lại từ trước mốc
+    (202, 200), # Phát lại từ trade đầu tiên của nhóm ở mốc cắt
+    (200, 180), # Cắt đúng ranh giới giữa 2 mốc
+    (200, 200), # Không chồng lấn: trade live đầu tiên ngay sau lịch sử
+])
+def test_load_history_then_overlapping_live_trades(cut, replay_from):
+    """load_history + phát lại trade live chồng lấn (như 'history' của collector / trade nhận trong lúc dựng):
+    kết quả giống hệt add_trade mỗi trade đúng 1 lần - không đếm 2 lần, không bỏ sót trade ở mốc cắt."""
+    trades = _same_ms_trades()
+    expected = _engine(); _add(expected, trades)
+    engine = _engine(); _load(engine, trades[:cut])
+    _add(engine, trades[replay_from:])
+    assert _full_histories(engine) == _full_histories(expected)
+
+
+def test_new_trades_at_cutoff_ms_are_kept():
+    """Trade mới có cùng T với trade cuối của lịch sử (chưa có trong kho) vẫn được tính."""
+    trades = _same_ms_trades()[:200]
+    T = trades[-1][0]
+    extra = [(T, 130.0, 3.0, False), (T, 90.0, 2.0, True), (T + 1, 100.0, 1.0, False)]
+    expected = _engine(); _add(expected, trades + extra)
+    engine = _engine(); _load(engine, trades)
+    _add(engine, trades[-4:] + extra) # Nhóm ở mốc cắt được gửi lại, sau đó là trade mới cùng mili giây
+    assert _full_histories(engine) == _full_histories(expected)
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+# FILE: test_depth_sync.py
+# Kiểm tra sổ lệnh đầy đủ (depth_sync) với sàn giả lập: chạy bằng `python -m pytest -q`.
+# FakeDepthExchange cũng được benchmarks.py dùng để đo tốc độ (bench_depth_sync).
+
+import json
+import random
+import asyncio
+from collections import deque
+
+import pytest
+
+import depth_sync
+from depth_sync import DepthBook, OrderBookSync
+from binary_frames import encode_message, decode_message, json_default
+
+
+class FakeDepthExchange:
+    """Sàn giả lập cho sổ lệnh: giữ sổ thật, sinh event depthUpdate (U, u, b, a, E) như stream @depth,
+    snapshot() trả sổ hiện tại sau snapshot_latency_s (stream vẫn chạy trong lúc chờ, như REST thật)."""
+    def __init__(self, levels=2000, tick=0.1, snapshot_latency_s=0.005, seed=9):
+        self.rng = random.Random(seed)
+        self.levels = levels; self.tick = tick; self.mid = 60000.0
+        self.bids = {round(self.mid - i * tick, 2): round(self.rng.expovariate(2), 4) for i in range(1, levels + 1)}
+        self.asks = {round(self.mid + i * tick, 2): round(self.rng.expovariate(2), 4) for i in range(1, levels + 1)}
+        self.update_id = 1_000_000; self.time_ms = 1_700_000_000_000
+        self.snapshot_latency_s = snapshot_latency_s; self.snapshots = 0
+
+    def step(self):
+        rng = self.rng
+        first_id = self.update_id + 1; self.update_id += rng.randint(1, 5); self.time_ms += 100
+        changes = {'b': [], 'a': []}
+        for _ in range(rng.randint(1, 20)):
+            side = rng.choice('ba'); offset = rng.randint(1, self.levels + 200) * self.tick
+            book, price = (self.bids, round(self.mid - offset, 2)) if side == 'b' else (self.asks, round(self.mid + offset, 2))
+            qty = 0.0 if rng.random() < 0.3 else round(rng.expovariate(2), 4)
+            if qty == 0: book.pop(price, None)
+            else: book[price] = qty
+            changes[side].append([f"{price:.2f}", f"{qty:.8f}"])
+        return {'e': 'depthUpdate', 'E': self.time_ms, 's': 'BTCUSDT', 'U': first_id, 'u': self.update_id, 'b': changes['b'], 'a': changes['a']}
+
+    def snapshot_now(self):
+        self.snapshots += 1
+        return {'lastUpdateId': self.update_id,
+                'bids': [[f"{p:.2f}", f"{q:.8f}"] for p, q in sorted(self.bids.items(), reverse=True)],
+                'asks': [[f"{p:.2f}", f"{q:.8f}"] for p, q in sorted(self.asks.items())]}
+
+    async def snapshot(self):
+        await asyncio.sleep(self.snapshot_latency_s)
+        return self.snapshot_now()
+
+
+def same_book(book, exchange):
+    return book.update_id == exchange.update_id and book.bids == exchange.bids and book.asks == exchange.asks
+
+
+class Downstream:
+    """Bên nhận: dựng DepthBook từ các message của OrderBookSync (qua frame nhị phân hoặc JSON như websocket)."""
+    def __init__(self, wire='binary'):
+        self.book = DepthBook(); self.wire = wire; self.gaps = 0
+
+    def receive(self, message):
+        if self.wire == 'binary': message = decode_message(encode_message(message))
+        else: message = json.loads(json.dumps(message, default=json_default))
+        if message['type'] == 'book_snapshot':
+            self.book.load_snapshot(message['update_id'], message['bids'], message['asks'], message['timestamp'])
+        elif self.book.apply_delta_message(message) == 'gap': self.gaps += 1
+
+
+def _event(first_id, last_id, bids=(), asks=()):
+    return {'e': 'depthUpdate', 'E': 1_700_000_000_000 + last_id, 'U': first_id, 'u': last_id, 'b': list(bids), 'a': list(asks)}
+
+
+@pytest.fixture
+def no_resync_delay(monkeypatch):
+    monkeypatch.setattr(depth_sync, 'RESYNC_DELAY_S', 0.0)
+
+
+# --- DepthBook ---
+
+def test_apply_diff_needs_snapshot():
+    book = DepthBook()
+    assert book.apply_diff(1, 2, [["100.0", "1"]], []) == 'gap'
+    assert not book.synced and book.bids == {}
+
+
+def test_apply_diff_sequencing():
+    book = DepthBook()
+    book.load_snapshot(100, [["99.0", "1.5"], ["98.0", "2"]], [["101.0", "3"]])
+    assert book.apply_diff(90, 100, [["99.0", "9"]], []) == 'stale'
+    assert book.apply_diff(102, 105, [["99.0", "9"]], []) == 'gap'
+    assert book.update_id == 100 and book.bids == {99.0: 1.5, 98.0: 2.0} # stale / gap không đổi sổ
+    # Diff chồng lên snapshot (U <= update_id + 1 <= u) được áp dụng; khối lượng 0 xóa mức
+    assert book.apply_diff(95, 103, [["99.0", "0"], ["97.5", "4"]], [["101.0", "0.00000000"], ["102.0", "1"]], event_time=7) == 'applied'
+    assert book.update_id == 103 and book.event_time == 7
+    assert book.bids == {98.0: 2.0, 97.5: 4.0} and book.asks == {102.0: 1.0}
+    assert book.apply_diff(104, 104, [], [["102.0", "2"]]) == 'applied' and book.asks == {102.0: 2.0}
+
+
+def test_apply_delta_message_resets_on_gap():
+    book = DepthBook(); book.load_snapshot(10, [["99.0", "1"]], [])
+    assert book.apply_delta_message({'prev_update_id': 10, 'update_id': 12, 'bids': [["98.0", "1"]], 'asks': []}) == 'applied'
+    assert book.apply_delta_message({'prev_update_id': 11, 'update_id': 12, 'bids': [], 'asks': []}) == 'stale'
+    # Event phát lại khi collector đồng bộ lại (không đánh số): bỏ qua, sổ không đổi
+    assert book.apply_delta_message({'timestamp': 5, 'bids': [["97.0", "1"]], 'asks': []}) == 'stale'
+    assert book.update_id == 12 and book.bids == {99.0: 1.0, 98.0: 1.0}
+    assert book.apply_delta_message({'prev_update_id': 13, 'update_id': 15, 'bids': [], 'asks': []}) == 'gap'
+    assert not book.synced and book.bids == {} # Chờ book_snapshot kế tiếp
+
+
+def test_snapshot_message_round_trip():
+    book = DepthBook(); book.load_snapshot(42, [["99.0", "1"], ["99.5", "2"]], [["101.0", "3"], ["100.5", "4"]], event_time=5)
+    message = book.snapshot_message()
+    assert message['bids'][:, 0].tolist() == [99.5, 99.0] and message['asks'][:, 0].tolist() == [100.5, 101.0]
+    for wire in ('binary', 'json'):
+        downstream = Downstream(wire); downstream.receive(message)
+        assert downstream.book.update_id == 42 and downstream.book.bids == book.bids and downstream.book.asks == book.asks
+
+
+# --- OrderBookSync._replay ---
+
+def _sync_with_buffer(events):
+    async def unused(*args): raise AssertionError("không được gọi")
+    sync = OrderBookSync(unused, unused, log=lambda m: None)
+    sync.buffer.extend(events)
+    return sync
+
+
+def test_replay_applies_buffer_after_snapshot():
+    sync = _sync_with_buffer([_event(8, 9), _event(10, 12, bids=[["99.0", "5"]]), _event(13, 13, asks=[["101.0", "0"]])])
+    assert sync._replay({'lastUpdateId': 11, 'bids': [["99.0", "1"]], 'asks': [["101.0", "2"]]}) == 'synced'
+    assert sync.book.update_id == 13 and sync.book.bids == {99.0: 5.0} and sync.book.asks == {}
+    assert not sync.buffer
+
+
+def test_replay_rejects_snapshot_older_than_buffer():
+    sync = _sync_with_buffer([_event(20, 22)])
+    assert sync._replay({'lastUpdateId': 15, 'bids': [], 'asks': []}) == 'old'
+    assert not sync.book.synced and len(sync.buffer) == 1
+
+
+def test_replay_keeps_buffer_after_hole():
+    after_hole = [_event(16, 17), _event(18, 18)]
+    sync = _sync_with_buffer([_event(10, 12), _event(13, 14)] + after_hole)
+    assert sync._replay({'lastUpdateId': 11, 'bids': [], 'asks': []}) == 'gap'
+    assert not sync.book.synced and list(sync.buffer) == after_hole
+
+
+# --- OrderBookSync: hở -> _resync -> _replay, bên nhận ---
+
+def test_gap_resyncs_from_snapshot_and_replays_buffer():
+    exchange = FakeDepthExchange(levels=300)
+    downstream = Downstream()
+
+    async def run():
+        async def publish(message): downstream.receive(message)
+
+        async def fetch_snapshot():
+            # Stream vẫn chạy trong lúc chờ REST: các event này vào buffer và được áp dụng sau snapshot
+            snapshot = await exchange.snapshot()
+            for _ in range(3): await sync.on_event(exchange.step())
+            return snapshot
+
+        sync = OrderBookSync(fetch_snapshot, publish, log=lambda m: None)
+        for _ in range(5): await sync.on_event(exchange.step())
+        await sync._resync_task
+        assert same_book(sync.book, exchange) and same_book(downstream.book, exchange)
+
+        for _ in range(10): await sync.on_event(exchange.step())
+        exchange.step() # Event bị mất trên đường truyền
+        await sync.on_event(exchange.step())
+        assert sync.stats['gaps'] == 1 and not sync.book.synced and len(sync.buffer) == 1
+        await sync._resync_task
+        for _ in range(10): await sync.on_event(exchange.step())
+        return sync
+    sync = asyncio.run(run())
+
+    assert sync.stats['snapshots'] == 2 and exchange.snapshots == 2
+    assert same_book(sync.book, exchange)
+    assert downstream.gaps == 0 and same_book(downstream.book, exchange) # Bên nhận luôn thấy luồng liền mạch
+
+
+def test_resync_publishes_buffered_events_before_snapshot():
+    """Event buffer trong lúc đồng bộ (lúc khởi động + sau chỗ hở) được gửi 'liquidity_raw' không đánh số
+    ngay trước snapshot: bên nhận (heatmap) thấy mọi event collector nhận được, đúng 1 lần; sổ vẫn khớp."""
+    exchange = FakeDepthExchange(levels=300)
+    downstream = Downstream(); received = []; delivered = []
+
+    async def run():
+        async def publish(message): downstream.receive(message); received.append(message)
+
+        async def deliver():
+            event = exchange.step(); delivered.append(event['E'])
+            await sync.on_event(event)
+
+        async def fetch_snapshot():
+            snapshot = await exchange.snapshot()
+            for _ in range(3): await deliver()
+            return snapshot
+
+        sync = OrderBookSync(fetch_snapshot, publish, log=lambda m: None)
+        for _ in range(5): await deliver()
+        await sync._resync_task
+        for _ in range(10): await deliver()
+        exchange.step() # Event bị mất trên đường truyền
+        await deliver()
+        await sync._resync_task
+        for _ in range(5): await deliver()
+    asyncio.run(run())
+
+    kinds = ['snapshot' if m['type'] == 'book_snapshot' else 'delta' if m.get('update_id') is not None else 'replayed' for m in received]
+    assert kinds == ['replayed'] * 8 + ['snapshot'] + ['delta'] * 10 + ['replayed'] * 4 + ['snapshot'] + ['delta'] * 5
+    assert [m['timestamp'] for m in received if m['type'] == 'liquidity_raw'] == delivered
+    assert all('prev_update_id' not in m for m, kind in zip(received, kinds) if kind == 'replayed')
+    assert downstream.gaps == 0 and same_book(downstream.book, exchange)
+
+
+def test_resync_retries_old_snapshot(no_resync_delay):
+    exchange = FakeDepthExchange(levels=100)
+    stale = exchange.snapshot_now()
+    snapshots = deque([stale])
+
+    async def run():
+        async def fetch_snapshot():
+            return snapshots.popleft() if snapshots else exchange.snapshot_now()
+        async def publish(message): pass
+
+        sync = OrderBookSync(fetch_snapshot, publish, log=lambda m: None)
+        exchange.step(); exchange.step() # Mất đầu luồng: snapshot cũ không nối được với buffer
+        await sync.on_event(exchange.step())
+        await sync._resync_task
+        return sync
+    sync = asyncio.run(run())
+    assert exchange.snapshots == 2 and sync.stats['snapshots'] == 1 and same_book(sync.book, exchange)
+
+
+def test_late_joiner_syncs_from_book_snapshot():
+    exchange = FakeDepthExchange(levels=200)
+    late = Downstream('json'); joined = [False]
+
+    async def run():
+        async def publish(message):
+            if joined[0]: late.receive(message)
+
+        sync = OrderBookSync(exchange.snapshot, publish, log=lambda m: None)
+        for _ in range(3): await sync.on_event(exchange.step())
+        await sync._resync_task
+        for _ in range(20): await sync.on_event(exchange.step())
+        joined[0] = True # Vào giữa luồng: các delta trước snapshot kế tiếp bị bỏ
+        for _ in range(5): await sync.on_event(exchange.step())
+        assert late.gaps == 5 and not late.book.synced
+        async with sync.lock: await publish(sync.book.snapshot_message()) # Như 1 vòng publish_snapshots
+        for _ in range(20): await sync.on_event(exchange.step())
+    asyncio.run(run())
+    assert late.gaps == 5 and same_book(late.book, exchange)
+
+
+def test_lossy_stream_stays_in_sync(no_resync_delay):
+    """Stream mất event ngẫu nhiên và trễ vài event so với sàn: sổ collector, bên nhận từ đầu (nhị phân) và
+    bên nhận vào giữa luồng (JSON, chỉ từ book_snapshot định kỳ) đều khớp sổ thật ở mỗi lần so."""
+    exchange = FakeDepthExchange(levels=500, snapshot_latency_s=0.001)
+    downstream = Downstream('binary'); late = Downstream('json'); joined = [False]
+    rng = random.Random(1); n_events = 4000; wire_lag = 3
+
+    async def run():
+        async def publish(message):
+            downstream.receive(message)
+            if joined[0]: late.receive(message)
+
+        sync = OrderBookSync(exchange.snapshot, publish, log=lambda m: None)
+        snapshot_task = asyncio.create_task(sync.publish_snapshots(0.02))
+        wire = deque(); dropped = 0
+
+        async def check():
+            # 1 event chắc chắn tới nơi (lộ chỗ hở nếu event cuối bị mất), xả hết wire, chờ đồng bộ xong
+            wire.append(exchange.step())
+            while wire: await sync.on_event(wire.popleft())
+            while not sync.book.synced or sync.buffer: await asyncio.sleep(0.001)
+            assert same_book(sync.book, exchange) and same_book(downstream.book, exchange)
+
+        for i in range(n_events):
+            event = exchange.step()
+            if rng.random() < 0.01: dropped += 1
+            else: wire.append(event)
+            while len(wire) > wire_lag: await sync.on_event(wire.popleft())
+            if i == n_events // 2: joined[0] = True
+            if i % 1000 == 999: await check()
+            await asyncio.sleep(0)
+        await check()
+        await asyncio.sleep(0.03) # Chờ 1 snapshot định kỳ cho bên nhận vào giữa luồng
+        snapshot_task.cancel()
+        return sync, dropped
+    sync, dropped = asyncio.run(run())
+
+    assert dropped > 0 and sync.stats['gaps'] > 0
+    assert downstream.gaps == 0 and late.gaps > 0
+    assert same_book(late.book, exchange)
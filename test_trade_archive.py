@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# FILE: test_trade_archive.py
+# Kiểm tra kho Parquet phân vùng TradeArchive (trade_archive.py) trên thư mục tạm: chạy bằng `python -m pytest -q`.
+
+import os
+import glob
+
+import numpy as np
+import pytest
+
+import trade_archive
+from trade_archive import TradeArchive, HOUR_MS, DAY_MS, MANIFEST_NAME
+
+DAY0 = 1_699_920_000_000 # 2023-11-14 00:00 UTC
+
+
+def _trades(ids, times):
+    ids = np.asarray(ids, dtype=np.int64); times = np.asarray(times, dtype=np.int64)
+    return {'a': ids, 'T': times, 'p': 60000.0 + (ids % 97) * 0.5, 'q': 0.001 * (ids % 13 + 1), 'm': ids % 2 == 0}
+
+
+def _data_files(archive):
+    return sorted(os.path.basename(p) for p in glob.glob(os.path.join(archive.archive_dir, 'trades_*.parquet*')))
+
+
+def _listed_files(archive):
+    return sorted(e['file'] for e in archive.manifest['files'])
+
+
+def test_append_splits_batch_at_hour_boundary(tmp_path):
+    archive = TradeArchive(str(tmp_path))
+    times = [DAY0 + HOUR_MS - 2, DAY0 + HOUR_MS + 5, DAY0 + HOUR_MS - 1, DAY0 + HOUR_MS] # Chưa sắp, vắt qua 01:00
+    assert archive.append(_trades([1, 4, 2, 3], times)) == 4
+
+    entries = archive.files()
+    assert [(e['kind'], e['period'], e['rows']) for e in entries] == [('part', '2023-11-14T00', 2), ('part', '2023-11-14T01', 2)]
+    assert (entries[0]['min_T'], entries[0]['max_T'], entries[0]['max_a']) == (DAY0 + HOUR_MS - 2, DAY0 + HOUR_MS - 1, 2)
+    assert (entries[1]['min_T'], entries[1]['max_T'], entries[1]['max_a']) == (DAY0 + HOUR_MS, DAY0 + HOUR_MS + 5, 4)
+    assert (archive.last_time(), archive.last_id(), archive.manifest['rows']) == (DAY0 + HOUR_MS + 5, 4, 4)
+    assert _data_files(archive) == _listed_files(archive)
+
+    # Tiến trình khác mở lại kho: chỉ cần manifest
+    reopened = TradeArchive(str(tmp_path))
+    trades, _, _ = reopened.read_since(None)
+    assert trades['a'].tolist() == [1, 2, 3, 4] and trades['T'].tolist() == sorted(times)
+    assert reopened.last_time() == DAY0 + HOUR_MS + 5
+
+
+def test_compact_closed_hours_and_days_dedupes_by_id(tmp_path):
+    archive = TradeArchive(str(tmp_path))
+    day1 = DAY0 + DAY_MS
+    # Ngày đã đóng: 2 giờ, lô thứ 2 ghi lại 1 phần lô đầu (gửi lại sau khi kết nối lại)
+    archive.append(_trades(range(0, 100), DAY0 + np.arange(100) * 60_000))
+    archive.append(_trades(range(90, 150), DAY0 + np.arange(90, 150) * 60_000))
+    # Ngày hiện tại: giờ 00 đã đóng (2 part chồng id), giờ 01 đang mở
+    archive.append(_trades(range(1000, 1030), day1 + np.arange(30) * 1_000))
+    archive.append(_trades(range(1020, 1050), day1 + np.arange(20, 50) * 1_000))
+    archive.append(_trades(range(2000, 2010), day1 + HOUR_MS + np.arange(10)))
+    open_part = [e['file'] for e in archive.files() if e['period'] == '2023-11-15T01']
+
+    result = archive.compact(now_ms=day1 + HOUR_MS + 30 * 60_000)
+    entries = archive.files()
+    assert [(e['kind'], e['period'], e['rows']) for e in entries] == [
+        ('day', '2023-11-14', 150), ('hour', '2023-11-15T00', 50), ('part', '2023-11-15T01', 10)]
+    assert len(result['written_files']) == 2 and entries[2]['file'] == open_part[0] # Giờ đang mở không bị gộp
+    assert archive.manifest['rows'] == 210 and archive.last_id() == 2009
+    assert _data_files(archive) == _listed_files(archive) # File cũ đã xóa
+    trades, _, _ = archive.read_since(None)
+    assert trades['a'].tolist() == list(range(150)) + list(range(1000, 1050)) + list(range(2000, 2010))
+
+    # Part đến muộn cho giờ đã gộp: gộp chung với file 'hour' cũ; chạy lại khi không còn gì để gộp thì không đổi
+    archive.append(_trades([1040, 1050], [day1 + 40_000, day1 + 50_000]))
+    archive.compact(now_ms=day1 + HOUR_MS + 40 * 60_000)
+    assert [(e['kind'], e['period'], e['rows']) for e in archive.files()] == [
+        ('day', '2023-11-14', 150), ('hour', '2023-11-15T00', 51), ('part', '2023-11-15T01', 10)]
+    assert archive.compact(now_ms=day1 + HOUR_MS + 40 * 60_000) == {'written_files': [], 'removed_files': 0}
+
+    # Sang ngày mới: cả ngày 15 (file 'hour' + part) gộp thành 1 file 'day'
+    archive.compact(now_ms=day1 + DAY_MS)
+    assert [(e['kind'], e['period'], e['rows']) for e in archive.files()] == [('day', '2023-11-14', 150), ('day', '2023-11-15', 61)]
+    assert archive.manifest['rows'] == 211 and _data_files(archive) == _listed_files(archive)
+
+
+def test_remove_orphans_after_crash_before_manifest_save(tmp_path, monkeypatch):
+    archive = TradeArchive(str(tmp_path))
+    archive.append(_trades(range(100), DAY0 + np.arange(100) * 1_000))
+    listed = _listed_files(archive)
+
+    # Tắt giữa chừng: file dữ liệu đã ghi xong nhưng manifest chưa kịp ghi
+    def crash(): raise KeyboardInterrupt
+    monkeypatch.setattr(archive, '_save_manifest', crash)
+    with pytest.raises(KeyboardInterrupt): archive.append(_trades(range(100, 120), DAY0 + HOUR_MS + np.arange(20)))
+    with pytest.raises(KeyboardInterrupt): archive.compact(now_ms=DAY0 + DAY_MS)
+    open(os.path.join(str(tmp_path), 'trades_2023-11-14T02_000099.parquet.tmp'), 'wb').close() # File tạm dở dang
+    assert len(_data_files(archive)) == len(listed) + 3
+
+    # Lần chạy sau: manifest trên đĩa vẫn là bản cũ, nhất quán -> chỉ cần xóa file mồ côi
+    restarted = TradeArchive(str(tmp_path))
+    assert _listed_files(restarted) == listed and restarted.last_id() == 99
+    assert restarted.remove_orphans() == 3
+    assert _data_files(restarted) == listed and restarted.remove_orphans() == 0
+    trades, _, _ = restarted.read_since(None)
+    assert trades['a'].tolist() == list(range(100))
+    assert os.path.exists(os.path.join(str(tmp_path), MANIFEST_NAME))
+
+
+def test_read_since_prunes_row_groups(tmp_path, monkeypatch):
+    monkeypatch.setattr(trade_archive, 'COMPACT_ROW_GROUP_ROWS', 1_000)
+    archive = TradeArchive(str(tmp_path))
+    n = 10_000
+    times = DAY0 + np.arange(n) * 5_000
+    archive.append(_trades(range(n), times))
+    archive.compact(now_ms=DAY0 + DAY_MS)
+    archive.append(_trades(range(n, n + 50), DAY0 + DAY_MS + np.arange(50))) # Part của ngày hiện tại
+    assert [e['kind'] for e in archive.files()] == ['day', 'part']
+
+    trades, groups_read, groups_total = archive.read_since(int(times[7_500]))
+    assert (groups_read, groups_total) == (3 + 1, 10 + 1) # Chỉ row group 7..9 của file 'day' (+ row group duy nhất của part)
+    assert trades['a'].tolist() == list(range(7_500, n + 50))
+    assert np.array_equal(trades['T'][:n - 7_500], times[7_500:])
+
+    # Mốc nằm giữa 1 row group: đọc cả row group đó nhưng chỉ trả các trade có T >= mốc
+    trades, groups_read, _ = archive.read_since(int(times[7_500]) + 1)
+    assert groups_read == 4 and trades['a'][0] == 7_501
+
+    # Sau toàn bộ file 'day': bỏ qua cả file theo manifest, không mở
+    trades, groups_read, groups_total = archive.read_since(DAY0 + DAY_MS)
+    assert (groups_read, groups_total) == (1, 1) and len(trades['a']) == 50
+    assert archive.read_since(DAY0 + 2 * DAY_MS)[1:] == (0, 0)
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+# FILE: trade_archive.py
+# Kho lưu trữ aggTrades dạng Parquet phân vùng theo giờ / ngày (UTC), thay cho 1 file append mãi.
+#
+# Thư mục TRADE_ARCHIVE_DIR:
+#   manifest.json                       : danh sách file + min/max T, max id, số dòng; T và aggTrade id cuối cùng
+#   trades_YYYY-MM-DDTHH_<seq>.parquet  : 'part' (mỗi lần ghi buffer) hoặc 'hour' (đã gộp cả giờ)
+#   trades_YYYY-MM-DD_<seq>.parquet     : 'day' (đã gộp cả ngày)
+# data_collector ghi part nhỏ mỗi vài giây; compact() gộp các giờ / ngày đã đóng thành file lớn,
+# sắp theo (T, a), bỏ trùng aggTrade id, row group lớn. Manifest được ghi nguyên tử (file tạm + os.replace)
+# SAU khi file dữ liệu đã ghi xong và TRƯỚC khi xóa file cũ, nên người đọc luôn thấy bộ file nhất quán.
+# Khởi động chỉ đọc manifest (không phụ thuộc dung lượng kho).
+#
+# Bên đọc (backend) chỉ mở các file có max T trong khoảng cần và bỏ qua row group theo thống kê min/max của T.
+
+import os
+import json
+import glob
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+TRADE_ARCHIVE_DIR = 'aggtrades_archive'
+LEGACY_TRADE_FILE = 'btcusdt_aggtrades.parquet' # File cũ (1 file append bằng fastparquet), được chuyển vào kho 1 lần
+MANIFEST_NAME = 'manifest.json'
+TRADE_COLUMNS = ['a', 'T', 'p', 'q', 'm'] # a = aggTrade id (-1 nếu không rõ, vd. dữ liệu file cũ)
+HOUR_MS = 60 * 60 * 1000
+DAY_MS = 24 * HOUR_MS
+COMPACT_ROW_GROUP_ROWS = 1 << 18 # Số dòng mỗi row group của file đã gộp
+
+
+def _require_pyarrow():
+    if pq is None: raise RuntimeError("Chưa cài 'pyarrow' (cần để đọc/ghi kho Parquet lịch sử trade)")
+
+
+def _empty_trades():
+    return {'a': np.empty(0, dtype=np.int64), 'T': np.empty(0, dtype=np.int64), 'p': np.empty(0, dtype=np.float64),
+            'q': np.empty(0, dtype=np.float64), 'm': np.empty(0, dtype=bool)}
+
+
+def concat_trades(parts):
+    parts = [t for t in parts if len(t['T'])]
+    if not parts: return _empty_trades()
+    if len(parts) == 1: return parts[0]
+    return {k: np.concatenate([t[k] for t in parts]) for k in TRADE_COLUMNS}
+
+
+def take_trades(trades, index):
+    return {k: v[index] for k, v in trades.items()}
+
+
+def sort_trades(trades, dedupe=True):
+    """Sắp theo (T, a) và bỏ các dòng trùng aggTrade id (id >= 0). Không copy nếu đã đúng thứ tự."""
+    T, a = trades['T'], trades['a']
+    if len(T) > 1 and ((np.diff(T) < 0).any() or ((np.diff(T) == 0) & (np.diff(a) < 0)).any()):
+        trades = take_trades(trades, np.lexsort((a, T))); T, a = trades['T'], trades['a']
+    if dedupe and len(a) > 1:
+        duplicate = (a[1:] == a[:-1]) & (a[1:] >= 0)
+        if duplicate.any(): trades = take_trades(trades, np.r_[True, ~duplicate])
+    return trades
+
+
+def records_to_trades(records):
+    """List dict aggTrade ({'a', 'T', 'p', 'q', 'm'}, giá/khối lượng dạng chuỗi hoặc số) -> dict cột NumPy."""
+    n = len(records)
+    return {
+        'a': np.fromiter((r.get('a', -1) for r in records), dtype=np.int64, count=n),
+        'T': np.fromiter((r['T'] for r in records), dtype=np.int64, count=n),
+        'p': np.fromiter((float(r['p']) for r in records), dtype=np.float64, count=n),
+        'q': np.fromiter((float(r['q']) for r in records), dtype=np.float64, count=n),
+        'm': np.fromiter((bool(r['m']) for r in records), dtype=bool, count=n),
+    }
+
+
+def trades_to_records(trades):
+    """Dict cột -> list dict {'T', 'p', 'q', 'm'} như message trade của data_collector."""
+    return [{'T': T, 'p': p, 'q': q, 'm': m} for T, p, q, m in
+            zip(trades['T'].tolist(), trades['p'].tolist(), trades['q'].tolist(), trades['m'].tolist())]
+
+# ==============================================================================
+# ĐỌC 1 FILE PARQUET (lọc row group theo thống kê cột T)
+# ==============================================================================
+
+def row_group_time_ranges(parquet_file):
+    """(min T, max T) của từng row group; None nếu row group không có thống kê."""
+    metadata = parquet_file.metadata
+    t_index = parquet_file.schema_arrow.get_field_index('T')
+    ranges = []
+    for i in range(metadata.num_row_groups):
+        stats = metadata.row_group(i).column(t_index).statistics
+        ranges.append((int(stats.min), int(stats.max)) if stats is not None and stats.has_min_max else None)
+    return ranges
+
+
+def _read_row_groups(parquet_file, groups):
+    has_id = 'a' in parquet_file.schema_arrow.names
+    table = parquet_file.read_row_groups(groups, columns=TRADE_COLUMNS if has_id else TRADE_COLUMNS[1:])
+    trades = {
+        'T': table.column('T').to_numpy().astype(np.int64, copy=False),
+        'p': table.column('p').to_numpy().astype(np.float64, copy=False),
+        'q': table.column('q').to_numpy().astype(np.float64, copy=False),
+        'm': table.column('m').to_numpy().astype(bool, copy=False),
+    }
+    trades['a'] = table.column('a').to_numpy().astype(np.int64, copy=False) if has_id else np.full(len(trades['T']), -1, dtype=np.int64)
+    return trades
+
+
+def parquet_last_time(path):
+    """T lớn nhất trong 1 file theo thống kê row group (None nếu không có file / không có thống kê)."""
+    if pq is None or not os.path.exists(path) or os.path.getsize(path) == 0: return None
+    ranges = row_group_time_ranges(pq.ParquetFile(path))
+    if not ranges or None in ranges: return None
+    return max(r[1] for r in ranges)
+
+
+def _tail_threshold(parts, n):
+    """T của trade thứ n tính từ cuối trong các phần đã đọc (None nếu chưa đủ n)."""
+    times = np.concatenate([t['T'] for t in parts]) if parts else np.empty(0, dtype=np.int64)
+    return int(np.partition(times, len(times) - n)[len(times) - n]) if len(times) >= n else None
+
+
+def read_parquet_tail(path, n):
+    """n trade cuối của 1 file: chỉ đọc các row group cuối (theo thống kê T) đủ chứa n trade.
+    Trả về (dict cột, số row group đã đọc)."""
+    _require_pyarrow()
+    if n <= 0 or not os.path.exists(path) or os.path.getsize(path) == 0: return _empty_trades(), 0
+    parquet_file = pq.ParquetFile(path)
+    ranges = row_group_time_ranges(parquet_file)
+    order = sorted(range(len(ranges)), key=lambda i: ranges[i][1] if ranges[i] else float('inf'), reverse=True)
+    parts = []; threshold = None
+    for i in order:
+        if threshold is not None and ranges[i] is not None and ranges[i][1] < threshold: break # Row group cũ hơn hẳn phần đã có
+        parts.append(_read_row_groups(parquet_file, [i])); threshold = _tail_threshold(parts, n)
+    return _last_n(sort_trades(concat_trades(parts[::-1])), n), len(parts)
+
+
+def _last_n(trades, n):
+    return take_trades(trades, slice(max(len(trades['T']) - n, 0), None))
+
+
+def read_parquet_since(path, since_ms=None):
+    """Các trade có T >= since_ms trong 1 file, sắp theo T (ổn định: giữ thứ tự ghi của các trade cùng T).
+    Trả về (dict cột NumPy a/T/p/q/m, số row group đã đọc, tổng số row group)."""
+    _require_pyarrow()
+    if not os.path.exists(path) or os.path.getsize(path) == 0: return _empty_trades(), 0, 0
+    parquet_file = pq.ParquetFile(path)
+    ranges = row_group_time_ranges(parquet_file)
+    groups = [i for i, r in enumerate(ranges) if since_ms is None or r is None or r[1] >= since_ms]
+    if not groups: return _empty_trades(), 0, len(ranges)
+    trades = _read_row_groups(parquet_file, groups)
+    if since_ms is not None:
+        keep = trades['T'] >= since_ms
+        if not keep.all(): trades = take_trades(trades, keep)
+    if len(trades['T']) > 1 and (np.diff(trades['T']) < 0).any(): # Row group ghi chồng thời gian
+        trades = take_trades(trades, np.argsort(trades['T'], kind='stable'))
+    return trades, len(groups), len(ranges)
+
+# ==============================================================================
+# KHO PHÂN VÙNG + MANIFEST
+# ==============================================================================
+
+def _hour_period(ts_ms):
+    return datetime.fromtimestamp(ts_ms // HOUR_MS * HOUR_MS / 1000, tz=timezone.utc).strftime('%Y-%m-%dT%H')
+
+
+def _period_start_ms(period):
+    fmt = '%Y-%m-%dT%H' if 'T' in period else '%Y-%m-%d'
+    return int(datetime.strptime(period, fmt).replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+class TradeArchive:
+    """Kho aggTrades phân vùng theo giờ / ngày. Ghi (append / compact) chỉ từ 1 tiến trình (data_collector);
+    các tiến trình khác chỉ đọc (manifest được đọc lại mỗi lần read_since)."""
+
+    def __init__(self, archive_dir=TRADE_ARCHIVE_DIR):
+        self.archive_dir = archive_dir
+        self.manifest_path = os.path.join(archive_dir, MANIFEST_NAME)
+        self._lock = threading.Lock() # append (event loop) và compact (executor) chạy trên 2 luồng
+        self.manifest = self._load_manifest()
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f: return json.load(f)
+        except FileNotFoundError:
+            return {'version': 1, 'next_seq': 0, 'last_T': None, 'last_a': None, 'rows': 0, 'files': []}
+
+    def _save_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(self.manifest, f, separators=(',', ':'))
+        os.replace(tmp_path, self.manifest_path)
+
+    def reload(self):
+        with self._lock: self.manifest = self._load_manifest()
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    def last_time(self):
+        """T của trade mới nhất (None nếu kho trống). Chỉ đọc manifest."""
+        return self.manifest['last_T']
+
+    def last_id(self):
+        """aggTrade id lớn nhất đã lưu (None nếu không rõ). Chỉ đọc manifest."""
+        return self.manifest['last_a']
+
+    def files(self):
+        return list(self.manifest['files'])
+
+    # --- Ghi ---
+    def _write_file(self, seq, period, kind, trades, row_group_rows):
+        """Ghi 1 file mới (seq lấy từ _next_seq nên tên chưa từng dùng) và trả về entry cho manifest."""
+        _require_pyarrow()
+        os.makedirs(self.archive_dir, exist_ok=True)
+        name = f"trades_{period}_{seq:06d}.parquet"; path = os.path.join(self.archive_dir, name)
+        pq.write_table(pa.table({k: trades[k] for k in TRADE_COLUMNS}), path + '.tmp', row_group_size=row_group_rows, compression='zstd')
+        os.replace(path + '.tmp', path)
+        a = trades['a']
+        return {'file': name, 'kind': kind, 'period': period, 'rows': int(len(a)),
+                'min_T': int(trades['T'][0]), 'max_T': int(trades['T'][-1]), 'max_a': int(a.max()) if len(a) else -1}
+
+    def _next_seq(self):
+        seq = self.manifest['next_seq']; self.manifest['next_seq'] = seq + 1
+        return seq
+
+    def _add_entries(self, entries):
+        files = self.manifest['files']
+        for entry in entries:
+            files.append(entry)
+            self.manifest['rows'] += entry['rows']
+            if self.manifest['last_T'] is None or entry['max_T'] >= self.manifest['last_T']: self.manifest['last_T'] = entry['max_T']
+            if entry['max_a'] >= 0 and (self.manifest['last_a'] is None or entry['max_a'] > self.manifest['last_a']): self.manifest['last_a'] = entry['max_a']
+        files.sort(key=lambda e: (e['min_T'], e['max_T']))
+
+    def append(self, trades):
+        """Ghi 1 lô trade (dict cột hoặc list dict) thành các file 'part' theo giờ. Trả về số dòng đã ghi."""
+        if isinstance(trades, list): trades = records_to_trades(trades)
+        trades = sort_trades(trades)
+        n = len(trades['T'])
+        if not n: return 0
+        hours = trades['T'] // HOUR_MS
+        bounds = np.r_[0, np.flatnonzero(np.diff(hours)) + 1, n].tolist()
+        with self._lock:
+            entries = [self._write_file(self._next_seq(), _hour_period(int(trades['T'][lo])), 'part', take_trades(trades, slice(lo, hi)), hi - lo)
+                       for lo, hi in zip(bounds[:-1], bounds[1:])]
+            self._add_entries(entries)
+            self._save_manifest()
+        return n
+
+    def _compaction_plan(self, now_ms):
+        """Nhóm các entry cần gộp: ngày đã đóng -> 1 file 'day'; giờ đã đóng (của ngày chưa đóng) -> 1 file 'hour'."""
+        today_start = now_ms // DAY_MS * DAY_MS; hour_start = now_ms // HOUR_MS * HOUR_MS
+        groups = {}
+        for entry in self.manifest['files']:
+            period_start = _period_start_ms(entry['period'])
+            if period_start < today_start:
+                groups.setdefault((entry['period'][:10], 'day'), []).append(entry)
+            elif period_start < hour_start and entry['kind'] == 'part':
+                groups.setdefault((entry['period'], 'hour'), []).append(entry)
+        # Hour đã gộp mà lại có part đến muộn: gộp chung với file 'hour' cũ
+        for (period, kind), entries in groups.items():
+            if kind == 'hour':
+                entries.extend(e for e in self.manifest['files'] if e['period'] == period and e['kind'] == 'hour')
+        return [(period, kind, entries) for (period, kind), entries in sorted(groups.items())
+                if len(entries) > 1 or entries[0]['kind'] != kind]
+
+    def compact(self, now_ms=None):
+        """Gộp các giờ / ngày đã đóng thành file lớn (sắp theo T, bỏ trùng id, row group lớn).
+        Có thể chạy trên luồng khác song song với append(). Trả về dict tóm tắt."""
+        if now_ms is None: now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+        with self._lock: plan = self._compaction_plan(now_ms)
+        written = []; removed = 0
+        for period, kind, entries in plan:
+            trades = sort_trades(concat_trades([read_parquet_since(os.path.join(self.archive_dir, e['file']))[0] for e in entries]))
+            with self._lock: seq = self._next_seq() # Chỉ giữ khóa khi cấp tên file + đổi manifest; đọc / ghi dữ liệu nằm ngoài
+            entry = self._write_file(seq, period, kind, trades, COMPACT_ROW_GROUP_ROWS)
+            with self._lock:
+                old_names = {e['file'] for e in entries}
+                self.manifest['files'] = [e for e in self.manifest['files'] if e['file'] not in old_names]
+                self.manifest['rows'] -= sum(e['rows'] for e in entries)
+                self._add_entries([entry])
+                self._save_manifest()
+            for name in old_names:
+                try: os.remove(os.path.join(self.archive_dir, name)); removed += 1
+                except OSError: pass # Đang bị đọc (Windows): remove_orphans() dọn lần sau
+            written.append(entry['file'])
+        return {'written_files': written, 'removed_files': removed}
+
+    def remove_orphans(self):
+        """Xóa file dữ liệu không có trong manifest (tiến trình bị tắt giữa chừng khi ghi / gộp).
+        Dữ liệu của chúng luôn còn trong file khác hoặc sẽ được tải lại từ last_time()."""
+        listed = {e['file'] for e in self.manifest['files']}
+        removed = 0
+        for path in glob.glob(os.path.join(self.archive_dir, 'trades_*.parquet*')):
+            if os.path.basename(path) not in listed:
+                try: os.remove(path); removed += 1
+                except OSError: pass
+        return removed
+
+    def import_legacy_file(self, path=LEGACY_TRADE_FILE, now_ms=None):
+        """Chuyển file Parquet cũ (1 file append) vào kho rồi gộp; file cũ được đổi tên thành *.imported."""
+        trades, _, _ = read_parquet_since(path)
+        n = self.append(trades)
+        self.compact(now_ms)
+        os.replace(path, path + '.imported')
+        return n
+
+    # --- Đọc ---
+    def read_last(self, n):
+        """n trade mới nhất: duyệt file theo max T giảm dần (theo manifest), trong mỗi file chỉ đọc row group cuối,
+        dừng khi phần còn lại chắc chắn cũ hơn. Không phụ thuộc số ngày trong kho. Trả về (dict cột, số row group đã đọc)."""
+        for attempt in range(3):
+            self.reload()
+            files = sorted(self.manifest['files'], key=lambda e: e['max_T'], reverse=True)
+            try:
+                parts = []; threshold = None; groups_read = 0
+                for entry in files:
+                    if threshold is not None and entry['max_T'] < threshold: break
+                    path = os.path.join(self.archive_dir, entry['file'])
+                    if not os.path.exists(path): raise FileNotFoundError(path)
+                    trades, n_read = read_parquet_tail(path, n)
+                    parts.append(trades); groups_read += n_read; threshold = _tail_threshold(parts, n)
+                return _last_n(sort_trades(concat_trades(parts[::-1])), n), groups_read
+            except FileNotFoundError:
+                if attempt == 2: raise
+
+    def read_since(self, since_ms=None):
+        """Các trade có T >= since_ms (sắp theo T, không trùng id). Bỏ qua cả file theo manifest,
+        rồi bỏ qua row group theo thống kê. Trả về (dict cột, số row group đã đọc, tổng số row group của các file đã mở)."""
+        for attempt in range(3):
+            self.reload()
+            files = [e for e in self.manifest['files'] if since_ms is None or e['max_T'] >= since_ms]
+            try:
+                parts = []; groups_read = groups_total = 0
+                for entry in files:
+                    path = os.path.join(self.archive_dir, entry['file'])
+                    if not os.path.exists(path): raise FileNotFoundError(path)
+                    trades, n_read, n_total = read_parquet_since(path, since_ms)
+                    parts.append(trades); groups_read += n_read; groups_total += n_total
+                return sort_trades(concat_trades(parts)), groups_read, groups_total
+            except FileNotFoundError:
+                if attempt == 2: raise # File vừa bị compact() thay thế: đọc lại manifest rồi thử lại